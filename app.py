@@ -1,23 +1,51 @@
-from flask import Flask, redirect, url_for, render_template, session, request, jsonify
+from flask import Flask, Response, redirect, url_for, render_template, session, request, jsonify
+import click
 import os
+import calendar
+import csv
+import asyncio
+import bisect
 import re
+import random
 import base64
 import email
+import io
 import json
 import tempfile
-from datetime import datetime, timedelta
+import itertools
+import time
+import queue
+import shutil
+import copy
+import threading
+import fcntl
+import fnmatch
+import hashlib
+import hmac
+import multiprocessing
+import sqlite3
+import uuid
+import zipfile
+import weakref
+from functools import lru_cache, wraps
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta, timezone
 from email.utils import parsedate_to_datetime
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from html import unescape
+from importlib import import_module
+# google-auth, googleapiclient, httplib2 and apscheduler are imported where they
+# are used (see GOOGLE_MODULES) so a worker can serve its first request sooner
+from googleapiclient.errors import HttpError
 from dotenv import load_dotenv
 import traceback
 import logging
 
-# Setup logging
+# Setup logging; the log file is opened when the first record is written
 logging.basicConfig(
-    filename='app.log',
+    handlers=[logging.FileHandler('app.log', delay=True)],
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
@@ -29,6 +57,221 @@ load_dotenv()
 DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Largest page size accepted by Gmail's messages.list
+GMAIL_LIST_PAGE_SIZE = 500
+
+# Number of messages.get calls grouped into one HTTP batch request
+GMAIL_BATCH_SIZE = int(os.environ.get('GMAIL_BATCH_SIZE', 50))
+
+# How many times failed sub-requests of a batch are retried
+GMAIL_BATCH_MAX_RETRIES = int(os.environ.get('GMAIL_BATCH_MAX_RETRIES', 3))
+
+# Worker threads per stage of the fetch/download/upload/persist pipeline
+PIPELINE_FETCH_WORKERS = int(os.environ.get('PIPELINE_FETCH_WORKERS', 2))
+PIPELINE_DOWNLOAD_WORKERS = int(os.environ.get('PIPELINE_DOWNLOAD_WORKERS', 4))
+PIPELINE_UPLOAD_WORKERS = int(os.environ.get('PIPELINE_UPLOAD_WORKERS', 4))
+PIPELINE_PERSIST_WORKERS = int(os.environ.get('PIPELINE_PERSIST_WORKERS', 1))
+
+# New invoices are stored in batches of this size while a sync runs, so a crash loses at most one batch
+PERSIST_BATCH_SIZE = int(os.environ.get('PERSIST_BATCH_SIZE', 100))
+
+# Capacity of the queues between pipeline stages; a full queue blocks the stage feeding it
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 32))
+
+# How messages are fetched, downloaded and uploaded: 'threads' runs the googleapiclient
+# pipeline above, 'asyncio' sends the same calls with aiohttp on one event loop per process
+FETCH_ENGINE = os.environ.get('FETCH_ENGINE', 'threads')
+
+# asyncio engine: pooled connections shared by every sync in the process, requests in
+# flight per sync, messages being worked on per sync, attachment bytes held in memory per
+# sync while they download and upload, and seconds to wait on a socket
+ASYNC_MAX_CONNECTIONS = int(os.environ.get('ASYNC_MAX_CONNECTIONS', 256))
+ASYNC_REQUESTS_PER_SYNC = int(os.environ.get('ASYNC_REQUESTS_PER_SYNC', 64))
+ASYNC_MESSAGES_PER_SYNC = int(os.environ.get('ASYNC_MESSAGES_PER_SYNC', 128))
+ASYNC_ATTACHMENT_BYTES_PER_SYNC = int(os.environ.get('ASYNC_ATTACHMENT_BYTES_PER_SYNC', 32 * 1024 * 1024))
+ASYNC_SOCKET_TIMEOUT = 60
+
+# REST endpoints called by the asyncio engine
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1'
+DRIVE_API_URL = 'https://www.googleapis.com/drive/v3'
+DRIVE_UPLOAD_URL = 'https://www.googleapis.com/upload/drive/v3'
+
+# Subject keywords that mark an email as a possible invoice
+INVOICE_SUBJECT_KEYWORDS = ['invoice', 'receipt', 'bill', 'statement', 'payment']
+
+# Partial-response masks for messages.get. Only the headers read by
+# extract_email_data and the part fields read by list_attachments are requested.
+INVOICE_HEADERS = ['Subject', 'From', 'Date']
+_MESSAGE_PART_FIELDS = 'partId,mimeType,filename,body(attachmentId,size)'
+MESSAGE_PARTS_MASK = (f"parts({_MESSAGE_PART_FIELDS},parts({_MESSAGE_PART_FIELDS},"
+                      f"parts({_MESSAGE_PART_FIELDS})))")
+MESSAGE_METADATA_FIELDS = 'id,payload(mimeType,headers)'
+MESSAGE_STRUCTURE_FIELDS = f"id,payload(mimeType,{MESSAGE_PARTS_MASK})"
+MESSAGE_FULL_FIELDS = f"id,payload(mimeType,headers,{MESSAGE_PARTS_MASK})"
+# The mask stops three levels down; a message nested deeper is fetched
+# again with its whole part tree once parts_truncated() spots the cut
+MESSAGE_TREE_FIELDS = 'id,payload(mimeType,headers,parts)'
+
+# Attachment types that are treated as invoices
+INVOICE_MIME_TYPES = [
+    'application/pdf', 'image/jpeg', 'image/png',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/msword'
+]
+
+# Invoices per page on the invoice list, and how many listing counts SQLite keeps cached
+INVOICES_PER_PAGE = int(os.environ.get('INVOICES_PER_PAGE', 25))
+INVOICE_COUNT_CACHE_SIZE = int(os.environ.get('INVOICE_COUNT_CACHE_SIZE', 1024))
+
+# Optional JSON file of category rules replacing DEFAULT_CATEGORY_RULES; reloaded when it changes
+CATEGORY_RULES_PATH = os.environ.get('CATEGORY_RULES_PATH')
+
+# Invoice categories matched by sender domain (including subdomains), subject keyword or attachment filename
+DEFAULT_CATEGORY_RULES = [
+    {
+        'category': 'Cloud Services',
+        'domains': ['aws.amazon.com', 'cloud.google.com', 'azure.com', 'digitalocean.com', 'heroku.com',
+                    'vercel.com', 'cloudflare.com', 'linode.com', 'hetzner.com', 'ovhcloud.com'],
+        'keywords': ['aws', 'cloud', 'hosting', 'compute engine', 'server'],
+        'filenames': []
+    },
+    {
+        'category': 'Software',
+        'domains': ['github.com', 'atlassian.com', 'slack.com', 'notion.so', 'zoom.us', 'adobe.com',
+                    'jetbrains.com', 'figma.com', 'microsoft.com', 'dropbox.com', '1password.com'],
+        'keywords': ['subscription', 'license', 'licence', 'saas', 'seats'],
+        'filenames': []
+    },
+    {
+        'category': 'Hardware',
+        'domains': ['apple.com', 'dell.com', 'lenovo.com', 'hp.com', 'logitech.com', 'bestbuy.com'],
+        'keywords': ['laptop', 'monitor', 'keyboard', 'hardware'],
+        'filenames': []
+    },
+    {
+        'category': 'Travel',
+        'domains': ['uber.com', 'lyft.com', 'airbnb.com', 'booking.com', 'expedia.com', 'delta.com',
+                    'united.com', 'aa.com', 'lufthansa.com', 'ryanair.com', 'marriott.com', 'hilton.com'],
+        'keywords': ['flight', 'boarding pass', 'hotel', 'itinerary', 'your trip', 'e-ticket'],
+        'filenames': ['boarding*', 'itinerary*', 'eticket*', 'e-ticket*']
+    },
+    {
+        'category': 'Payment Services',
+        'domains': ['stripe.com', 'paypal.com', 'wise.com', 'squareup.com', 'adyen.com'],
+        'keywords': ['payout', 'payment receipt'],
+        'filenames': []
+    },
+    {
+        'category': 'Telecom',
+        'domains': ['verizon.com', 'att.com', 't-mobile.com', 'vodafone.com', 'twilio.com'],
+        'keywords': ['phone bill', 'mobile plan', 'internet service'],
+        'filenames': []
+    },
+    {
+        'category': 'Meals',
+        'domains': ['doordash.com', 'ubereats.com', 'grubhub.com', 'deliveroo.co.uk'],
+        'keywords': ['restaurant', 'meal', 'lunch', 'dinner'],
+        'filenames': []
+    }
+]
+
+# Storage backend for user records: 'json' (one file per user) or 'sqlite'
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'json')
+
+# SQLite database file, defaults to DATA_DIR/invoices.db
+SQLITE_DB_PATH = os.environ.get('SQLITE_DB_PATH')
+
+# How long a cached Drive folder ID is trusted before it is looked up again
+FOLDER_CACHE_TTL = int(os.environ.get('FOLDER_CACHE_TTL', 7 * 24 * 3600))
+
+# Maximum number of built Gmail/Drive service objects kept per process
+SERVICE_POOL_SIZE = int(os.environ.get('SERVICE_POOL_SIZE', 64))
+
+# Access tokens of active users are refreshed in the background this many seconds before they expire
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', 300))
+
+# Per-user request budgets for each process: Gmail in quota units per second, Drive in requests per second
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.environ.get('GMAIL_QUOTA_UNITS_PER_SECOND', 250))
+DRIVE_REQUESTS_PER_SECOND = float(os.environ.get('DRIVE_REQUESTS_PER_SECOND', 20))
+
+# Gmail quota units charged per API method; other Gmail methods are charged GMAIL_DEFAULT_METHOD_COST
+GMAIL_METHOD_COSTS = {
+    'gmail.users.getProfile': 1,
+    'gmail.users.history.list': 2,
+    'gmail.users.messages.list': 5,
+    'gmail.users.messages.get': 5,
+    'gmail.users.messages.attachments.get': 5,
+}
+GMAIL_DEFAULT_METHOD_COST = 5
+
+# Retries for a Google API call that failed with a transient error, and the longest backoff in seconds
+GOOGLE_API_MAX_RETRIES = int(os.environ.get('GOOGLE_API_MAX_RETRIES', 5))
+GOOGLE_API_MAX_BACKOFF = float(os.environ.get('GOOGLE_API_MAX_BACKOFF', 32))
+
+# Background job execution: total worker threads and concurrent jobs per user
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 4))
+JOB_MAX_PER_USER = int(os.environ.get('JOB_MAX_PER_USER', 1))
+
+# Progress events kept per job, how often job files are rewritten, and how long finished jobs are kept
+JOB_MAX_EVENTS = int(os.environ.get('JOB_MAX_EVENTS', 1000))
+JOB_FLUSH_INTERVAL = float(os.environ.get('JOB_FLUSH_INTERVAL', 1.0))
+JOB_RETENTION = int(os.environ.get('JOB_RETENTION', 7 * 24 * 3600))
+
+# Attachments up to this many bytes are kept in memory; larger ones spill to an anonymous temp file
+ATTACHMENT_MEMORY_LIMIT = int(os.environ.get('ATTACHMENT_MEMORY_LIMIT', 5 * 1024 * 1024))
+
+# Files larger than this are uploaded in resumable chunks, smaller ones in a single request
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+
+# Invoice exports: Drive downloads in flight for a ZIP, bytes per download request and
+# streamed chunk, and invoices read from storage per query
+EXPORT_DOWNLOAD_WORKERS = int(os.environ.get('EXPORT_DOWNLOAD_WORKERS', 4))
+EXPORT_CHUNK_SIZE = 1024 * 1024
+EXPORT_BATCH_SIZE = 500
+
+# Base64 characters decoded per step (a multiple of 4)
+BASE64_DECODE_CHUNK = 1024 * 1024
+
+# Processes parsing invoice attachments for amounts, and the largest attachment they are given
+EXTRACTION_WORKERS = int(os.environ.get('EXTRACTION_WORKERS', max(1, min(4, (os.cpu_count() or 2) - 1))))
+EXTRACTION_MAX_BYTES = int(os.environ.get('EXTRACTION_MAX_BYTES', 20 * 1024 * 1024))
+
+# Seconds the persist stage waits for an attachment's extraction before storing the invoice without it
+EXTRACTION_TIMEOUT = int(os.environ.get('EXTRACTION_TIMEOUT', 30))
+
+# Bump when the parsers change so cached results from older versions are parsed again
+EXTRACTION_VERSION = 2
+
+# How often each worker writes its metrics snapshot, and how long snapshots of exited workers count
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', 10))
+METRICS_RETENTION = int(os.environ.get('METRICS_RETENTION', 24 * 3600))
+
+# Bearer token required to read /metrics; without one the endpoint refuses every scrape
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Months of a backfill processed at once, shared by all backfills in this process
+BACKFILL_WORKERS = int(os.environ.get('BACKFILL_WORKERS', 4))
+
+# Longest date range, in months, accepted by a single backfill
+BACKFILL_MAX_MONTHS = int(os.environ.get('BACKFILL_MAX_MONTHS', 36))
+
+# Comma separated email domains whose members can see each other's invoices on the team pages
+TEAM_DOMAINS = {domain.strip().lower() for domain in os.environ.get('TEAM_DOMAINS', '').split(',') if domain.strip()}
+
+# Public mail providers are never a team, even when listed in TEAM_DOMAINS
+PUBLIC_MAIL_DOMAINS = frozenset({
+    'gmail.com', 'googlemail.com', 'outlook.com', 'hotmail.com', 'live.com', 'msn.com', 'yahoo.com',
+    'ymail.com', 'icloud.com', 'me.com', 'mac.com', 'aol.com', 'proton.me', 'protonmail.com',
+    'gmx.com', 'gmx.net', 'mail.com', 'yandex.com', 'zoho.com'
+})
+
+# Optional cap on the number of messages processed in a single fetch
+GMAIL_MAX_MESSAGES = int(os.environ['GMAIL_MAX_MESSAGES']) if os.environ.get('GMAIL_MAX_MESSAGES') else None
+
 # Enable insecure transport for OAuth only in development environment
 if os.environ.get('FLASK_ENV') == 'development':
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
@@ -49,55 +292,1034 @@ def get_user_data_path(user_email):
     safe_email = re.sub(r'[^\w\-_]', '_', user_email)
     return os.path.join(DATA_DIR, f"{safe_email}.json")
 
-def save_user_data(user_email, user_data):
-    """Save user data to file"""
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive fcntl lock on a sidecar lock file, shared across processes"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def atomic_write_json(path, data):
+    """Write JSON to a temp file in the same directory and rename it into place"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix='.json')
     try:
-        with open(get_user_data_path(user_email), 'w') as f:
-            json.dump(user_data, f)
-        logging.info(f"Saved data for user: {user_email}")
-    except Exception as e:
-        logging.error(f"Error saving user data: {str(e)}")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         raise
 
-def get_user_data(user_email):
-    """Get user data from file"""
-    data_path = get_user_data_path(user_email)
-    if os.path.exists(data_path):
-        try:
-            with open(data_path, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            logging.error(f"Error loading user data: {str(e)}")
-    return None
+class ReadOnlyDict(dict):
+    """A dict that refuses changes, for parsed records shared by every reader of a cache.
+    
+    copy.deepcopy() returns a plain, modifiable copy.
+    """
+    
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Cached records are read-only; modify a copy.deepcopy() of them instead")
+    
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+    
+    def __copy__(self):
+        return dict(self)
+    
+    def __deepcopy__(self, memo):
+        return {key: copy.deepcopy(value, memo) for key, value in self.items()}
+    
+    def __reduce__(self):
+        return (dict, (dict(self),))
 
-def update_user_credentials(user_email, credentials):
-    """Update user's Google credentials"""
-    user_data = get_user_data(user_email) or {
+class ReadOnlyList(list):
+    """A list that refuses changes; see ReadOnlyDict"""
+    
+    _read_only = ReadOnlyDict._read_only
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+    
+    def __copy__(self):
+        return list(self)
+    
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(value, memo) for value in self]
+    
+    def __reduce__(self):
+        return (list, (list(self),))
+
+def read_only_json(value):
+    """A read-only copy of parsed JSON"""
+    if isinstance(value, dict):
+        return ReadOnlyDict((key, read_only_json(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return ReadOnlyList(read_only_json(item) for item in value)
+    return value
+
+def new_user_record(user_email):
+    """Create the initial record for a user who signs in for the first time"""
+    return {
         "email": user_email,
         "name": user_email.split('@')[0],
         "google_credentials": None,
         "created_at": datetime.utcnow().isoformat(),
         "invoices": []
     }
+
+def assign_invoice_ids(invoices, existing_count):
+    """Add a unique ID and created timestamp to new invoice records"""
+    now = datetime.utcnow()
+    # The random suffix keeps IDs of different users unique when they import in the same second
+    suffix = uuid.uuid4().hex[:6]
+    for offset, invoice_data in enumerate(invoices):
+        invoice_data["id"] = f"inv_{int(now.timestamp())}_{existing_count + offset}_{suffix}"
+        invoice_data["created_at"] = now.isoformat()
+
+def attachment_key(attachment):
+    """Stable identifier of an attachment within its message.
+    
+    Gmail hands out a new attachmentId every time a message is fetched, so the
+    MIME part ID is used when available.
+    """
+    return attachment.get('part_id') or attachment['id']
+
+def merge_processed_entries(index, processed):
+    """Merge {message_id: {'attachments': [...], 'complete': bool}} entries into an index"""
+    for message_id, entry in processed.items():
+        current = index.setdefault(message_id, {'attachments': [], 'complete': False})
+        current['attachments'] = sorted(set(current['attachments']) | set(entry.get('attachments', [])))
+        current['complete'] = current['complete'] or entry.get('complete', False)
+    return index
+
+def invoice_period(invoice):
+    """The 'YYYY-MM' month an invoice was received in, or None if unknown"""
+    received_date = invoice.get('received_date') or ''
+    return received_date[:7] if len(received_date) >= 7 else None
+
+def new_rollup():
+    return {'invoice_count': 0, 'totals': {}, 'categories': {}}
+
+def add_to_totals(totals, invoice):
+    """Add an invoice's amount to {currency: total}; amounts found without a currency are totalled under ''"""
+    amount = float(invoice.get('amount') or 0)
+    if amount:
+        currency = (invoice.get('currency') or '').upper()
+        totals[currency] = totals.get(currency, 0) + amount
+    return totals
+
+def rollup_invoices(invoices):
+    """Summarize invoices per received month: count, total amount per currency and invoices per category"""
+    rollups = {}
+    for invoice in invoices:
+        period = invoice_period(invoice)
+        if not period:
+            continue
+        entry = rollups.setdefault(period, new_rollup())
+        entry['invoice_count'] += 1
+        add_to_totals(entry['totals'], invoice)
+        category = invoice.get('category') or 'Uncategorized'
+        entry['categories'][category] = entry['categories'].get(category, 0) + 1
+    return rollups
+
+def merge_rollups(rollups, deltas):
+    """Add per-month rollup deltas into a user's rollups in place"""
+    for period, delta in deltas.items():
+        entry = rollups.setdefault(period, new_rollup())
+        entry['invoice_count'] += delta['invoice_count']
+        for currency, amount in delta['totals'].items():
+            entry['totals'][currency] = round(entry['totals'].get(currency, 0) + amount, 2)
+        for category, count in delta['categories'].items():
+            entry['categories'][category] = entry['categories'].get(category, 0) + count
+    return rollups
+
+def sender_domain(sender):
+    """Lower-cased domain of an invoice sender such as 'Acme <billing@acme.com>'"""
+    address = email.utils.parseaddr(sender or '')[1]
+    return address.rsplit('@', 1)[-1].lower() if '@' in address else None
+
+def sender_name(sender):
+    """Display name of an email sender, falling back to the address"""
+    name, address = email.utils.parseaddr(sender or '')
+    return name or address or None
+
+def invoice_category(invoice):
+    return invoice.get('category') or 'Uncategorized'
+
+def invoice_sort_key(invoice):
+    """Listing order key: newest received first, ties broken by ID"""
+    return (invoice.get('received_date') or '', invoice.get('id') or '')
+
+def invoice_filters(start_date=None, end_date=None, category=None, domain=None):
+    """Normalize listing filters; dates are inclusive 'YYYY-MM-DD' strings"""
+    if start_date:
+        start_date = datetime.strptime(start_date, '%Y-%m-%d').strftime('%Y-%m-%d')
+    end_before = None
+    if end_date:
+        end_before = (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+    return {
+        'start_date': start_date or None,
+        'end_before': end_before,
+        'category': category if category and category != 'all' else None,
+        'sender_domain': domain.lower() if domain else None
+    }
+
+class InvoiceIndex:
+    """Sorted secondary indexes over one user's invoices for keyset pagination.
+    
+    Each index is an ascending list of (received_date, id, position) keys:
+    one over all invoices, one per category and one per sender domain.
+    Pages and counts are found by bisecting these lists, so their cost does
+    not grow with the number of invoices.
+    """
+    
+    def __init__(self, invoices):
+        self.invoices = invoices
+        self.all = []
+        self.by_category = {}
+        self.by_domain = {}
+        for position, invoice in enumerate(invoices):
+            key = invoice_sort_key(invoice) + (position,)
+            self.all.append(key)
+            self.by_category.setdefault(invoice_category(invoice), []).append(key)
+            domain = sender_domain(invoice.get('sender'))
+            if domain:
+                self.by_domain.setdefault(domain, []).append(key)
+        for keys in itertools.chain([self.all], self.by_category.values(), self.by_domain.values()):
+            keys.sort()
+        self._counts = {}
+    
+    def _candidates(self, filters):
+        """Pick the narrowest index for the filters, plus a check for a filter it does not cover"""
+        category, domain = filters['category'], filters['sender_domain']
+        category_keys = self.by_category.get(category, []) if category else None
+        domain_keys = self.by_domain.get(domain, []) if domain else None
+        if category_keys is not None and domain_keys is not None:
+            if len(category_keys) <= len(domain_keys):
+                return category_keys, lambda invoice: sender_domain(invoice.get('sender')) == domain
+            return domain_keys, lambda invoice: invoice_category(invoice) == category
+        if category_keys is not None:
+            return category_keys, None
+        if domain_keys is not None:
+            return domain_keys, None
+        return self.all, None
+    
+    def _bounds(self, keys, filters):
+        lo = bisect.bisect_left(keys, (filters['start_date'],)) if filters['start_date'] else 0
+        hi = bisect.bisect_left(keys, (filters['end_before'],)) if filters['end_before'] else len(keys)
+        return lo, hi
+    
+    def page(self, filters, cursor=None, direction='next', limit=25):
+        """Return up to limit invoices older ('next') or newer ('prev') than cursor, and whether more exist"""
+        keys, matches = self._candidates(filters)
+        lo, hi = self._bounds(keys, filters)
+        if cursor and direction == 'prev':
+            lo = max(lo, bisect.bisect_left(keys, tuple(cursor) + (len(self.invoices),)))
+        elif cursor:
+            hi = min(hi, bisect.bisect_left(keys, tuple(cursor)))
+        
+        positions = range(hi - 1, lo - 1, -1) if direction == 'next' else range(lo, hi)
+        page = []
+        for i in positions:
+            invoice = self.invoices[keys[i][2]]
+            if matches is None or matches(invoice):
+                page.append(invoice)
+                if len(page) > limit:
+                    break
+        
+        has_more = len(page) > limit
+        page = page[:limit]
+        if direction == 'prev':
+            page.reverse()
+        return page, has_more
+    
+    def count(self, filters):
+        key = tuple(sorted(filters.items()))
+        if key not in self._counts:
+            keys, matches = self._candidates(filters)
+            lo, hi = self._bounds(keys, filters)
+            if matches is None:
+                self._counts[key] = hi - lo
+            else:
+                self._counts[key] = sum(1 for i in range(lo, hi) if matches(self.invoices[keys[i][2]]))
+        return self._counts[key]
+
+class JsonUserStore:
+    """Stores each user, invoices included, as one JSON document in DATA_DIR.
+    
+    Writes hold a per-user thread lock and fcntl lock and replace the file by
+    atomic rename. Reads are served from an in-process cache validated against
+    the file's mtime, size and inode, so a file is only parsed again after it
+    changed. Returned records are shared with the cache and read-only
+    (ReadOnlyDict); use update_user to change a record.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_locks = {}
+        self._cache = {}
+        self._indexes = {}
+    
+    @contextmanager
+    def _locked_path(self, data_path):
+        """Hold a file's thread lock and fcntl lock"""
+        with self._lock:
+            path_lock = self._user_locks.setdefault(data_path, threading.Lock())
+        with path_lock, file_lock(data_path):
+            yield data_path
+    
+    def _locked(self, user_email):
+        """Hold the user's thread lock and file lock; yields the data file path"""
+        return self._locked_path(get_user_data_path(user_email))
+    
+    @staticmethod
+    def _signature(stat):
+        # Atomic rename gives every write a new inode, so this changes on each save
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    
+    def _load(self, data_path):
+        """Parse a user file into a fresh object that the caller may modify"""
+        try:
+            with open(data_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.error(f"Error loading user data: {str(e)}")
+            return None
+    
+    def _write(self, data_path, user_data):
+        # Rename into place so readers never see a half-written file
+        atomic_write_json(data_path, user_data)
+        # The caller may still hold user_data, so the next read parses the file again
+        self._cache.pop(data_path, None)
+    
+    def get_user(self, user_email):
+        return self.get_user_from_path(get_user_data_path(user_email))
+    
+    def get_user_from_path(self, data_path):
+        try:
+            signature = self._signature(os.stat(data_path))
+        except OSError:
+            return None
+        
+        cached = self._cache.get(data_path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        
+        # If the file is replaced between stat and open, the stale signature
+        # only causes one extra parse on the next read
+        user_data = self._load(data_path)
+        if user_data is not None:
+            user_data = read_only_json(user_data)
+            self._cache[data_path] = (signature, user_data)
+        return user_data
+    
+    def save_user(self, user_email, user_data):
+        if 'invoices' in user_data:
+            # The full record replaces the user's stored invoices
+            user_data = dict(user_data, rollups=rollup_invoices(user_data['invoices']))
+        with self._locked(user_email) as data_path:
+            self._write(data_path, user_data)
+    
+    def get_profile(self, user_email):
+        user_data = self.get_user(user_email)
+        if user_data is None:
+            return None
+        # A shallow projection of the cached record, which stays untouched
+        return {key: value for key, value in user_data.items()
+                if key not in ('invoices', 'processed_index', 'rollups')}
+    
+    def update_user(self, user_email, mutate):
+        with self._locked(user_email) as data_path:
+            user_data = self._load(data_path) or new_user_record(user_email)
+            mutate(user_data)
+            self._write(data_path, user_data)
+    
+    def add_invoices(self, user_email, invoices):
+        with self._locked(user_email) as data_path:
+            user_data = self._load(data_path)
+            if not user_data:
+                return False
+            
+            assign_invoice_ids(invoices, len(user_data['invoices']))
+            merge_rollups(self._rollups(user_data), rollup_invoices(invoices))
+            user_data["invoices"].extend(invoices)
+            self._write(data_path, user_data)
+        return True
+    
+    def iter_invoices(self, user_email):
+        user_data = self.get_user(user_email) or {}
+        return iter(user_data.get('invoices', []))
+    
+    def list_users(self):
+        return [user_data['email'] for user_data in self._iter_user_files()]
+    
+    def recategorize(self, user_email, categorize):
+        with self._locked(user_email) as data_path:
+            user_data = self._load(data_path)
+            if not user_data:
+                return 0
+            invoices = user_data.get('invoices', [])
+            before = [invoice_category(invoice) for invoice in invoices]
+            categorize(invoices)
+            changed = sum(1 for old, invoice in zip(before, invoices) if old != invoice_category(invoice))
+            if not changed:
+                return 0
+            user_data['rollups'] = rollup_invoices(invoices)
+            self._write(data_path, user_data)
+        return changed
+    
+    def _invoice_index(self, user_email):
+        data_path = get_user_data_path(user_email)
+        user_data = self.get_user_from_path(data_path) or {}
+        # Rebuilt only when the cached record changes, i.e. after the file changed
+        cached = self._indexes.get(data_path)
+        if cached and cached[0] is user_data:
+            return cached[1]
+        index = InvoiceIndex(user_data.get('invoices', []))
+        self._indexes[data_path] = (user_data, index)
+        return index
+    
+    def query_invoices(self, user_email, filters, cursor=None, direction='next', limit=25):
+        return self._invoice_index(user_email).page(filters, cursor, direction, limit)
+    
+    def count_invoices(self, user_email, filters):
+        return self._invoice_index(user_email).count(filters)
     
-    user_data["google_credentials"] = credentials
-    user_data["updated_at"] = datetime.utcnow().isoformat()
+    @staticmethod
+    def _processed_index(user_data):
+        # Records imported before the index existed count as fully processed
+        if 'processed_index' not in user_data:
+            user_data['processed_index'] = {
+                inv['message_id']: {'attachments': [], 'complete': True}
+                for inv in user_data.get('invoices', []) if inv.get('message_id')
+            }
+        return user_data['processed_index']
+    
+    def load_processed_index(self, user_email):
+        user_data = self.get_user(user_email)
+        # A legacy index is built on a shallow copy; the cached record is read-only
+        return self._processed_index(dict(user_data)) if user_data else {}
+    
+    def record_processed(self, user_email, invoices, processed):
+        # Concurrent month shards of a backfill write the same user file
+        with self._locked(user_email) as data_path:
+            user_data = self._load(data_path)
+            if not user_data:
+                return False
+            
+            merge_processed_entries(self._processed_index(user_data), processed)
+            assign_invoice_ids(invoices, len(user_data['invoices']))
+            merge_rollups(self._rollups(user_data), rollup_invoices(invoices))
+            user_data["invoices"].extend(invoices)
+            self._write(data_path, user_data)
+        return True
+    
+    def _iter_user_files(self):
+        for filename in sorted(os.listdir(DATA_DIR)) if os.path.isdir(DATA_DIR) else []:
+            if filename.endswith('.json'):
+                user_data = self.get_user_from_path(os.path.join(DATA_DIR, filename))
+                if isinstance(user_data, dict) and user_data.get('email'):
+                    yield user_data
+    
+    @staticmethod
+    def _rollups(user_data):
+        # Kept in the user file so they are written together with the invoices;
+        # records saved before rollups existed are summarized from their invoices
+        if 'rollups' not in user_data:
+            user_data['rollups'] = rollup_invoices(user_data.get('invoices', []))
+        return user_data['rollups']
+    
+    def load_rollups(self, user_emails=None):
+        if user_emails is None:
+            records = self._iter_user_files()
+        else:
+            records = filter(None, (self.get_user(user_email) for user_email in user_emails))
+        # A legacy record is summarized on a shallow copy; the cached record is read-only
+        return {user_data['email']: self._rollups(dict(user_data)) for user_data in records}
+    
+    def rebuild_rollups(self):
+        user_emails = self.list_users()
+        for user_email in user_emails:
+            with self._locked(user_email) as data_path:
+                user_data = self._load(data_path)
+                if user_data:
+                    user_data['rollups'] = rollup_invoices(user_data.get('invoices', []))
+                    self._write(data_path, user_data)
+        return len(user_emails)
+
+class SqliteUserStore:
+    """Stores users and invoices in SQLite tables, using WAL mode for concurrent readers.
+    
+    Invoices are inserted in bulk inside one transaction instead of rewriting
+    the whole user document, and writers are serialized by SQLite itself.
+    """
+    
+    USER_COLUMNS = ('email', 'name', 'google_credentials', 'created_at', 'updated_at')
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            email TEXT PRIMARY KEY,
+            name TEXT,
+            google_credentials TEXT,
+            created_at TEXT,
+            updated_at TEXT,
+            extra TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS invoices (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL,
+            user_email TEXT NOT NULL REFERENCES users(email),
+            message_id TEXT,
+            received_date TEXT,
+            sender_domain TEXT,
+            category TEXT,
+            data TEXT NOT NULL,
+            UNIQUE (user_email, id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_invoices_user ON invoices(user_email, seq);
+        CREATE INDEX IF NOT EXISTS idx_invoices_message_id ON invoices(user_email, message_id);
+        CREATE TABLE IF NOT EXISTS invoice_versions (
+            user_email TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            user_email TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            complete INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_email, message_id)
+        );
+        CREATE TABLE IF NOT EXISTS rollups (
+            user_email TEXT NOT NULL,
+            period TEXT NOT NULL,
+            invoice_count INTEGER NOT NULL DEFAULT 0,
+            totals TEXT NOT NULL DEFAULT '{}',
+            categories TEXT NOT NULL DEFAULT '{}',
+            PRIMARY KEY (user_email, period)
+        );
+        CREATE TABLE IF NOT EXISTS processed_attachments (
+            user_email TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            attachment_key TEXT NOT NULL,
+            PRIMARY KEY (user_email, message_id, attachment_key)
+        );
+    """
+    
+    # Listing indexes, created after older databases gained the columns they cover
+    LISTING_INDEXES = """
+        DROP INDEX IF EXISTS idx_invoices_received_date;
+        CREATE INDEX IF NOT EXISTS idx_invoices_listing ON invoices(user_email, received_date, id);
+        CREATE INDEX IF NOT EXISTS idx_invoices_category ON invoices(user_email, category, received_date, id);
+        CREATE INDEX IF NOT EXISTS idx_invoices_sender_domain ON invoices(user_email, sender_domain, received_date, id);
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        self._counts = OrderedDict()
+        self._counts_lock = threading.Lock()
+    
+    def _connection(self):
+        # Connections are per thread and never carried across a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(self.SCHEMA)
+                    self._add_listing_columns(conn)
+                    conn.executescript(self.LISTING_INDEXES)
+                    self._schema_ready = True
+        return conn
+    
+    def _add_listing_columns(self, conn):
+        """Add and fill the indexed listing columns on databases created before they existed"""
+        def missing_columns():
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(invoices)")}
+            return [column for column in ('sender_domain', 'category') if column not in columns]
+        
+        if not missing_columns():
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another worker may have added the columns while this one waited for the lock
+            missing = missing_columns()
+            for column in missing:
+                conn.execute(f"ALTER TABLE invoices ADD COLUMN {column} TEXT")
+            if missing:
+                rows = conn.execute("SELECT seq, data FROM invoices").fetchall()
+                conn.executemany(
+                    "UPDATE invoices SET received_date = ?, sender_domain = ?, category = ? WHERE seq = ?",
+                    [
+                        (inv.get('received_date') or '', sender_domain(inv.get('sender')), invoice_category(inv),
+                         row['seq'])
+                        for row, inv in ((row, json.loads(row['data'])) for row in rows)
+                    ]
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    @contextmanager
+    def transaction(self):
+        """Run statements in one write transaction, taking the write lock up front"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    
+    def _user_from_row(self, row):
+        user_data = json.loads(row['extra'])
+        for column in self.USER_COLUMNS:
+            user_data[column] = row[column]
+        user_data['google_credentials'] = json.loads(row['google_credentials']) if row['google_credentials'] else None
+        return user_data
+    
+    def _write_user(self, conn, user_email, user_data):
+        extra = {key: value for key, value in user_data.items()
+                 if key not in self.USER_COLUMNS and key not in ('invoices', 'rollups')}
+        conn.execute(
+            """INSERT INTO users (email, name, google_credentials, created_at, updated_at, extra)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(email) DO UPDATE SET
+                   name = excluded.name,
+                   google_credentials = excluded.google_credentials,
+                   created_at = excluded.created_at,
+                   updated_at = excluded.updated_at,
+                   extra = excluded.extra""",
+            (
+                user_email,
+                user_data.get('name'),
+                json.dumps(user_data['google_credentials']) if user_data.get('google_credentials') else None,
+                user_data.get('created_at'),
+                user_data.get('updated_at'),
+                json.dumps(extra)
+            )
+        )
+    
+    def _insert_invoices(self, conn, user_email, invoices):
+        conn.executemany(
+            """INSERT INTO invoices (id, user_email, message_id, received_date, sender_domain, category, data)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [
+                (inv['id'], user_email, inv.get('message_id'), inv.get('received_date') or '',
+                 sender_domain(inv.get('sender')), invoice_category(inv), json.dumps(inv))
+                for inv in invoices
+            ]
+        )
+        self._add_rollups(conn, user_email, invoices)
+        self._bump_invoices_version(conn, user_email)
+    
+    def _bump_invoices_version(self, conn, user_email):
+        # Cached counts are keyed by this version, so any change to a user's invoices retires them
+        conn.execute(
+            """INSERT INTO invoice_versions (user_email, version) VALUES (?, 1)
+               ON CONFLICT(user_email) DO UPDATE SET version = version + 1""",
+            (user_email,)
+        )
+    
+    def _add_rollups(self, conn, user_email, invoices):
+        # Updated in the same transaction as the invoices they summarize
+        for period, delta in rollup_invoices(invoices).items():
+            row = conn.execute(
+                "SELECT invoice_count, totals, categories FROM rollups WHERE user_email = ? AND period = ?",
+                (user_email, period)
+            ).fetchone()
+            entry = new_rollup()
+            if row:
+                entry = {
+                    'invoice_count': row['invoice_count'],
+                    'totals': json.loads(row['totals']),
+                    'categories': json.loads(row['categories'])
+                }
+            merge_rollups({period: entry}, {period: delta})
+            conn.execute(
+                """INSERT OR REPLACE INTO rollups (user_email, period, invoice_count, totals, categories)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (user_email, period, entry['invoice_count'], json.dumps(entry['totals']), json.dumps(entry['categories']))
+            )
+    
+    def get_user(self, user_email):
+        conn = self._connection()
+        row = conn.execute("SELECT * FROM users WHERE email = ?", (user_email,)).fetchone()
+        if row is None:
+            return None
+        user_data = self._user_from_row(row)
+        user_data['invoices'] = list(self.iter_invoices(user_email))
+        return user_data
+    
+    def get_profile(self, user_email):
+        # The users row alone, without loading the invoices
+        row = self._connection().execute("SELECT * FROM users WHERE email = ?", (user_email,)).fetchone()
+        return self._user_from_row(row) if row else None
     
-    save_user_data(user_email, user_data)
+    def save_user(self, user_email, user_data):
+        with self.transaction() as conn:
+            self._write_user(conn, user_email, user_data)
+            if 'invoices' in user_data:
+                # The full record replaces the stored invoices
+                conn.execute("DELETE FROM invoices WHERE user_email = ?", (user_email,))
+                conn.execute("DELETE FROM rollups WHERE user_email = ?", (user_email,))
+                self._bump_invoices_version(conn, user_email)
+                self._insert_invoices(conn, user_email, user_data['invoices'])
+    
+    def update_user(self, user_email, mutate):
+        with self.transaction() as conn:
+            row = conn.execute("SELECT * FROM users WHERE email = ?", (user_email,)).fetchone()
+            user_data = self._user_from_row(row) if row else new_user_record(user_email)
+            mutate(user_data)
+            self._write_user(conn, user_email, user_data)
+    
+    def add_invoices(self, user_email, invoices):
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE email = ?", (user_email,)).fetchone() is None:
+                return False
+            existing_count = conn.execute(
+                "SELECT COUNT(*) FROM invoices WHERE user_email = ?", (user_email,)
+            ).fetchone()[0]
+            assign_invoice_ids(invoices, existing_count)
+            self._insert_invoices(conn, user_email, invoices)
+        return True
+    
+    def iter_invoices(self, user_email):
+        cursor = self._connection().execute(
+            "SELECT data FROM invoices WHERE user_email = ? ORDER BY seq", (user_email,)
+        )
+        for row in cursor:
+            yield json.loads(row['data'])
+    
+    def list_users(self):
+        return [row['email'] for row in self._connection().execute("SELECT email FROM users ORDER BY email")]
+    
+    def recategorize(self, user_email, categorize):
+        with self.transaction() as conn:
+            rows = conn.execute(
+                "SELECT seq, category, data FROM invoices WHERE user_email = ? ORDER BY seq", (user_email,)
+            ).fetchall()
+            invoices = [json.loads(row['data']) for row in rows]
+            categorize(invoices)
+            updates = [
+                (invoice_category(invoice), json.dumps(invoice), row['seq'])
+                for row, invoice in zip(rows, invoices) if invoice_category(invoice) != row['category']
+            ]
+            if updates:
+                conn.executemany("UPDATE invoices SET category = ?, data = ? WHERE seq = ?", updates)
+                conn.execute("DELETE FROM rollups WHERE user_email = ?", (user_email,))
+                self._add_rollups(conn, user_email, invoices)
+                self._bump_invoices_version(conn, user_email)
+        return len(updates)
+    
+    @staticmethod
+    def _filter_clauses(user_email, filters):
+        clauses, params = ["user_email = ?"], [user_email]
+        for column, operator, key in (('received_date', '>=', 'start_date'), ('received_date', '<', 'end_before'),
+                                      ('category', '=', 'category'), ('sender_domain', '=', 'sender_domain')):
+            if filters[key]:
+                clauses.append(f"{column} {operator} ?")
+                params.append(filters[key])
+        return clauses, params
+    
+    def query_invoices(self, user_email, filters, cursor=None, direction='next', limit=25):
+        clauses, params = self._filter_clauses(user_email, filters)
+        if cursor:
+            clauses.append("(received_date, id) < (?, ?)" if direction == 'next' else "(received_date, id) > (?, ?)")
+            params.extend(cursor)
+        order = 'DESC' if direction == 'next' else 'ASC'
+        rows = self._connection().execute(
+            f"""SELECT data FROM invoices WHERE {' AND '.join(clauses)}
+                ORDER BY received_date {order}, id {order} LIMIT ?""",
+            params + [limit + 1]
+        ).fetchall()
+        
+        page = [json.loads(row['data']) for row in rows[:limit]]
+        if direction == 'prev':
+            page.reverse()
+        return page, len(rows) > limit
+    
+    def count_invoices(self, user_email, filters):
+        conn = self._connection()
+        row = conn.execute("SELECT version FROM invoice_versions WHERE user_email = ?", (user_email,)).fetchone()
+        key = (user_email, row['version'] if row else 0, tuple(sorted(filters.items())))
+        with self._counts_lock:
+            if key in self._counts:
+                self._counts.move_to_end(key)
+                return self._counts[key]
+        
+        clauses, params = self._filter_clauses(user_email, filters)
+        count = conn.execute(f"SELECT COUNT(*) FROM invoices WHERE {' AND '.join(clauses)}", params).fetchone()[0]
+        with self._counts_lock:
+            self._counts[key] = count
+            while len(self._counts) > INVOICE_COUNT_CACHE_SIZE:
+                self._counts.popitem(last=False)
+        return count
+    
+    def _seed_processed_index(self, conn, user_email):
+        # Records imported before the index existed count as fully processed
+        if conn.execute("SELECT 1 FROM processed_messages WHERE user_email = ? LIMIT 1", (user_email,)).fetchone():
+            return
+        conn.execute(
+            """INSERT OR IGNORE INTO processed_messages (user_email, message_id, complete)
+               SELECT DISTINCT user_email, message_id, 1 FROM invoices
+               WHERE user_email = ? AND message_id IS NOT NULL""",
+            (user_email,)
+        )
+    
+    def load_processed_index(self, user_email):
+        with self.transaction() as conn:
+            self._seed_processed_index(conn, user_email)
+            index = {
+                row['message_id']: {'attachments': [], 'complete': bool(row['complete'])}
+                for row in conn.execute(
+                    "SELECT message_id, complete FROM processed_messages WHERE user_email = ?", (user_email,)
+                )
+            }
+            for row in conn.execute(
+                "SELECT message_id, attachment_key FROM processed_attachments WHERE user_email = ?", (user_email,)
+            ):
+                index.setdefault(row['message_id'], {'attachments': [], 'complete': False})['attachments'].append(
+                    row['attachment_key']
+                )
+        return index
+    
+    def record_processed(self, user_email, invoices, processed):
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE email = ?", (user_email,)).fetchone() is None:
+                return False
+            self._seed_processed_index(conn, user_email)
+            
+            existing_count = conn.execute(
+                "SELECT COUNT(*) FROM invoices WHERE user_email = ?", (user_email,)
+            ).fetchone()[0]
+            assign_invoice_ids(invoices, existing_count)
+            self._insert_invoices(conn, user_email, invoices)
+            
+            conn.executemany(
+                """INSERT INTO processed_messages (user_email, message_id, complete) VALUES (?, ?, ?)
+                   ON CONFLICT(user_email, message_id) DO UPDATE SET complete = MAX(complete, excluded.complete)""",
+                [(user_email, message_id, int(entry.get('complete', False))) for message_id, entry in processed.items()]
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO processed_attachments (user_email, message_id, attachment_key) VALUES (?, ?, ?)",
+                [
+                    (user_email, message_id, key)
+                    for message_id, entry in processed.items()
+                    for key in entry.get('attachments', [])
+                ]
+            )
+        return True
+    
+    def load_rollups(self, user_emails=None):
+        conn = self._connection()
+        if (conn.execute("SELECT 1 FROM rollups LIMIT 1").fetchone() is None
+                and conn.execute("SELECT 1 FROM invoices LIMIT 1").fetchone() is not None):
+            # Databases created before rollups existed are summarized once
+            self.rebuild_rollups()
+        rollups = {}
+        if user_emails is None:
+            rows = conn.execute("SELECT * FROM rollups")
+        else:
+            user_emails = list(user_emails)
+            rows = conn.execute(
+                f"SELECT * FROM rollups WHERE user_email IN ({', '.join('?' * len(user_emails))})", user_emails
+            )
+        for row in rows:
+            rollups.setdefault(row['user_email'], {})[row['period']] = {
+                'invoice_count': row['invoice_count'],
+                'totals': json.loads(row['totals']),
+                'categories': json.loads(row['categories'])
+            }
+        return rollups
+    
+    def rebuild_rollups(self):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM rollups")
+            user_emails = [row['email'] for row in conn.execute("SELECT email FROM users")]
+            for user_email in user_emails:
+                invoices = (json.loads(row['data']) for row in conn.execute(
+                    "SELECT data FROM invoices WHERE user_email = ?", (user_email,)
+                ))
+                self._add_rollups(conn, user_email, invoices)
+        return len(user_emails)
+    
+    def import_user(self, user_data):
+        """Copy a complete user record into the database unless the user already exists"""
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM users WHERE email = ?", (user_data['email'],)).fetchone():
+                return False
+            # Legacy JSON files can repeat an ID; re-key the repeats rather than abort the migration
+            invoices = []
+            seen_ids = set()
+            for invoice_data in user_data.get('invoices', []):
+                if not invoice_data.get('id') or invoice_data['id'] in seen_ids:
+                    invoice_data = {**invoice_data, 'id': f"inv_{uuid.uuid4().hex}"}
+                seen_ids.add(invoice_data['id'])
+                invoices.append(invoice_data)
+            self._write_user(conn, user_data['email'], user_data)
+            self._insert_invoices(conn, user_data['email'], invoices)
+        return True
+
+_user_store = None
+_user_store_lock = threading.Lock()
+
+def get_user_store():
+    """Return the configured storage backend"""
+    global _user_store
+    with _user_store_lock:
+        if _user_store is None:
+            if STORAGE_BACKEND == 'sqlite':
+                _user_store = SqliteUserStore(SQLITE_DB_PATH or os.path.join(DATA_DIR, 'invoices.db'))
+            elif STORAGE_BACKEND == 'json':
+                _user_store = JsonUserStore()
+            else:
+                raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+        return _user_store
+
+def migrate_json_to_sqlite(store):
+    """One-shot copy of every DATA_DIR/<email>.json user file into a SQLite store"""
+    json_store = JsonUserStore()
+    migrated = 0
+    for filename in sorted(os.listdir(DATA_DIR)):
+        if not filename.endswith('.json'):
+            continue
+        user_data = json_store.get_user_from_path(os.path.join(DATA_DIR, filename))
+        if not user_data or not user_data.get('email'):
+            continue
+        if store.import_user(user_data):
+            migrated += 1
+            logging.info(f"Migrated user {user_data['email']} with {len(user_data.get('invoices', []))} invoices")
+    return migrated
+
+def save_user_data(user_email, user_data):
+    """Save user data to storage"""
+    try:
+        get_user_store().save_user(user_email, user_data)
+        logging.info(f"Saved data for user: {user_email}")
+    except Exception as e:
+        logging.error(f"Error saving user data: {str(e)}")
+        raise
+
+def get_user_data(user_email):
+    """Get user data from storage"""
+    return get_user_store().get_user(user_email)
+
+def get_user_profile(user_email):
+    """Get a user's record without their invoices, e.g. for their name and credentials"""
+    return get_user_store().get_profile(user_email)
+
+def update_user_fields(user_email, fields):
+    """Set top-level fields on a user's record, creating the user if needed"""
+    get_user_store().update_user(user_email, lambda user_data: user_data.update(fields))
+    logging.info(f"Saved data for user: {user_email}")
+
+def update_user_credentials(user_email, credentials):
+    """Update user's Google credentials"""
+    update_user_fields(user_email, {
+        "google_credentials": credentials,
+        "updated_at": datetime.utcnow().isoformat()
+    })
+
+def update_user_token(user_email, token_fields):
+    """Merge refreshed token fields into a user's stored Google credentials"""
+    def mutate(user_data):
+        user_data['google_credentials'] = dict(user_data.get('google_credentials') or {}, **token_fields)
+    get_user_store().update_user(user_email, mutate)
+
+def set_month_history_id(user_email, year, month, history_id):
+    """Remember the mailbox history ID a month was last synced at"""
+    def mutate(user_data):
+        user_data.setdefault('history_ids', {})[f"{year:04d}-{month:02d}"] = history_id
+    get_user_store().update_user(user_email, mutate)
+
+def add_invoices(user_email, invoices):
+    """Add several invoices to user's records in one write"""
+    if not invoices:
+        return True
+    return get_user_store().add_invoices(user_email, invoices)
 
 def add_invoice(user_email, invoice_data):
     """Add invoice data to user's records"""
-    user_data = get_user_data(user_email)
-    if not user_data:
-        return False
-        
-    # Add a unique ID and created timestamp
-    invoice_data["id"] = f"inv_{int(datetime.utcnow().timestamp())}_{len(user_data['invoices'])}"
-    invoice_data["created_at"] = datetime.utcnow().isoformat()
+    return add_invoices(user_email, [invoice_data])
+
+def iter_invoices(user_email):
+    """Iterate over a user's stored invoices in the order they were added"""
+    return get_user_store().iter_invoices(user_email)
+
+def encode_cursor(invoice):
+    """Opaque pagination cursor pointing at an invoice's position in the listing order"""
+    return base64.urlsafe_b64encode(json.dumps(invoice_sort_key(invoice)).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        received_date, invoice_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return (str(received_date), str(invoice_id))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def list_invoice_page(user_email, filters, cursor=None, direction='next', limit=INVOICES_PER_PAGE):
+    """One page of a user's invoices, newest first, with cursors for the neighbouring pages"""
+    position = decode_cursor(cursor) if cursor else None
+    direction = 'prev' if direction == 'prev' and position else 'next'
+    invoices, has_more = get_user_store().query_invoices(user_email, filters, position, direction, limit)
     
-    user_data["invoices"].append(invoice_data)
-    save_user_data(user_email, user_data)
-    return True
+    has_next = has_more if direction == 'next' else True
+    has_prev = has_more if direction == 'prev' else position is not None
+    return {
+        'invoices': invoices,
+        'next_cursor': encode_cursor(invoices[-1]) if invoices and has_next else None,
+        'prev_cursor': encode_cursor(invoices[0]) if invoices and has_prev else None
+    }
+
+def count_invoices(user_email, filters):
+    """Number of a user's invoices matching filters, cached until the invoices change"""
+    return get_user_store().count_invoices(user_email, filters)
+
+def list_users():
+    """Emails of all stored users"""
+    return get_user_store().list_users()
+
+def recategorize_user_invoices(user_email, engine=None):
+    """Re-run categorization over all of a user's invoices; returns how many changed category"""
+    engine = engine or get_category_engine()
+    changed = get_user_store().recategorize(user_email, engine.categorize)
+    logging.info(f"Recategorized {changed} invoices for user: {user_email}")
+    return changed
+
+def load_rollups(user_emails=None):
+    """Get per-user, per-month invoice rollups as {email: {'YYYY-MM': rollup}}, for every user by default"""
+    return get_user_store().load_rollups(user_emails)
+
+def rebuild_rollups():
+    """Recompute every rollup from the stored invoices; returns the number of users"""
+    return get_user_store().rebuild_rollups()
+
+def load_processed_index(user_email):
+    """Get the user's index of imported messages and attachments"""
+    return get_user_store().load_processed_index(user_email)
+
+def record_processed(user_email, invoices, processed):
+    """Save new invoices and mark messages/attachments as imported in one write"""
+    return get_user_store().record_processed(user_email, invoices, processed)
 
 #----------------
 # Google Authentication
@@ -119,6 +1341,8 @@ def create_oauth_flow(redirect_uri=None):
     
     scopes = os.environ.get("GOOGLE_SCOPES", "https://www.googleapis.com/auth/gmail.readonly https://www.googleapis.com/auth/drive").split()
     
+    from google_auth_oauthlib.flow import Flow
+    
     # Create flow with explicit redirect URI
     flow = Flow.from_client_config(
         client_config,
@@ -128,19 +1352,41 @@ def create_oauth_flow(redirect_uri=None):
     
     return flow
 
-def credentials_from_dict(credentials_dict):
-    """Create Credentials object from dictionary"""
+def parse_token_expiry(value):
+    """Parse a stored token expiry into the naive UTC datetime google-auth uses"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return None
+
+def credentials_from_dict(credentials_dict, user_email=None):
+    """Create Credentials object from dictionary.
+    
+    With user_email, the credentials refresh through token_manager, which
+    stores the new token so other threads and workers reuse it.
+    """
     if not credentials_dict:
         return None
-        
-    return Credentials(
+    
+    if user_email:
+        credentials_class = managed_credentials_class()
+    else:
+        from google.oauth2.credentials import Credentials as credentials_class
+    credentials = credentials_class(
         token=credentials_dict.get('token'),
         refresh_token=credentials_dict.get('refresh_token'),
         token_uri=credentials_dict.get('token_uri', "https://oauth2.googleapis.com/token"),
         client_id=os.environ.get("GOOGLE_CLIENT_ID"),
         client_secret=os.environ.get("GOOGLE_CLIENT_SECRET"),
-        scopes=credentials_dict.get('scopes')
+        scopes=credentials_dict.get('scopes'),
+        expiry=parse_token_expiry(credentials_dict.get('expiry'))
     )
+    if user_email:
+        credentials.user_email = user_email
+        token_manager.register(credentials)
+    return credentials
     
 def credentials_to_dict(credentials):
     """Convert Credentials object to dictionary for storage"""
@@ -153,54 +1399,1042 @@ def credentials_to_dict(credentials):
         'token_uri': credentials.token_uri,
         'client_id': credentials.client_id,
         'client_secret': credentials.client_secret,
-        'scopes': credentials.scopes
+        'scopes': credentials.scopes,
+        'expiry': credentials.expiry.isoformat() if credentials.expiry else None
     }
 
-#----------------
-# Gmail Service
-#----------------
-
-def build_gmail_service(credentials):
-    """Build Gmail API service"""
-    credentials_obj = credentials_from_dict(credentials)
-    if not credentials_obj:
-        return None
+@lru_cache(maxsize=None)
+def managed_credentials_class():
+    """Define ManagedCredentials on first use, so google-auth is not imported at startup"""
+    from google.oauth2.credentials import Credentials
     
-    return build('gmail', 'v1', credentials=credentials_obj)
+    class ManagedCredentials(Credentials):
+        """Credentials whose token refreshes are coordinated by token_manager"""
+        
+        user_email = None
+        
+        def before_request(self, request, method, url, headers):
+            token_manager.mark_used(self.user_email)
+            super().before_request(request, method, url, headers)
+        
+        def refresh(self, request):
+            # Copies made by google-auth (e.g. with_quota_project) carry no user
+            if not self.user_email:
+                return super().refresh(request)
+            token_manager.refresh(self, request)
+        
+        def refresh_now(self, request):
+            """Exchange the refresh token for a new access token"""
+            super().refresh(request)
+    
+    return ManagedCredentials
 
-def list_invoice_emails(service, start_date=None, end_date=None):
-    """List emails that potentially contain invoices"""
-    if not start_date:
-        start_date = datetime.utcnow() - timedelta(days=30)
+class TokenManager:
+    """Keeps users' access tokens fresh and shared across threads and workers.
     
-    if not end_date:
-        end_date = datetime.utcnow()
+    Refreshes are serialized per user by a thread lock plus an fcntl lock,
+    and the new token and expiry are written to the user's stored
+    credentials. A caller that waited for the lock picks up the token stored
+    by another thread or worker instead of refreshing again. Users whose
+    credentials were used since their last refresh are refreshed in the
+    background TOKEN_REFRESH_MARGIN seconds before the token expires.
+    """
     
-    # Format dates for Gmail query
-    after_date = start_date.strftime('%Y/%m/%d')
-    before_date = end_date.strftime('%Y/%m/%d')
+    def __init__(self, margin=TOKEN_REFRESH_MARGIN):
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._user_locks = {}
+        self._credentials = {}
+        self._last_used = {}
+        self._refreshed_at = {}
+        self._scheduler = None
     
-    # Query for emails with attachments that might be invoices
-    query = f"has:attachment after:{after_date} before:{before_date} " \
-            f"(subject:invoice OR subject:receipt OR subject:bill OR subject:statement OR subject:payment)"
+    def _lock_path(self, user_email):
+        return os.path.join(DATA_DIR, 'tokens', os.path.basename(get_user_data_path(user_email)))
     
-    try:
-        results = service.users().messages().list(userId='me', q=query, maxResults=100).execute()
-        messages = results.get('messages', [])
-        return messages
-    except Exception as e:
+    def _user_lock(self, user_email):
+        with self._lock:
+            return self._user_locks.setdefault(user_email, threading.Lock())
+    
+    def register(self, credentials):
+        """Track credentials so a refreshed token reaches every copy in this process"""
+        with self._lock:
+            self._credentials.setdefault(credentials.user_email, weakref.WeakSet()).add(credentials)
+    
+    def mark_used(self, user_email):
+        self._last_used[user_email] = time.time()
+    
+    def _share(self, user_email, token, expiry):
+        with self._lock:
+            copies = list(self._credentials.get(user_email, ()))
+        for credentials in copies:
+            credentials.token = token
+            credentials.expiry = expiry
+    
+    def refresh(self, credentials, request):
+        """Refresh credentials unless another thread or worker already stored a newer token"""
+        user_email = credentials.user_email
+        stale_token = credentials.token
+        
+        with self._user_lock(user_email), file_lock(self._lock_path(user_email)):
+            stored = (get_user_profile(user_email) or {}).get('google_credentials') or {}
+            if stored.get('token') and stored['token'] != stale_token:
+                credentials.token = stored['token']
+                credentials.expiry = parse_token_expiry(stored.get('expiry'))
+                if credentials.valid:
+                    self._share(user_email, credentials.token, credentials.expiry)
+                    return
+            
+            credentials.refresh_now(request)
+            token_fields = {
+                'token': credentials.token,
+                'expiry': credentials.expiry.isoformat() if credentials.expiry else None
+            }
+            if credentials.refresh_token and credentials.refresh_token != stored.get('refresh_token'):
+                token_fields['refresh_token'] = credentials.refresh_token
+            update_user_token(user_email, token_fields)
+            self._refreshed_at[user_email] = time.time()
+            logging.info(f"Refreshed access token for {user_email}")
+        
+        self._share(user_email, credentials.token, credentials.expiry)
+        self._schedule(user_email, credentials.expiry)
+    
+    def _get_scheduler(self):
+        # Started on first use so the scheduler thread is created after gunicorn forks
+        with self._lock:
+            if self._scheduler is None:
+                from apscheduler.schedulers.background import BackgroundScheduler
+                self._scheduler = BackgroundScheduler(daemon=True)
+                self._scheduler.start()
+            return self._scheduler
+    
+    def _schedule(self, user_email, expiry):
+        if not expiry:
+            return
+        run_at = (expiry - timedelta(seconds=self.margin)).replace(tzinfo=timezone.utc)
+        self._get_scheduler().add_job(
+            self._refresh_ahead,
+            'date',
+            run_date=run_at,
+            args=[user_email],
+            id=f"token:{user_email}",
+            replace_existing=True,
+            misfire_grace_time=self.margin
+        )
+    
+    def _refresh_ahead(self, user_email):
+        # Idle users are left alone; their next request refreshes on demand
+        if self._last_used.get(user_email, 0) < self._refreshed_at.get(user_email, 0):
+            return
+        try:
+            stored = (get_user_profile(user_email) or {}).get('google_credentials')
+            credentials = credentials_from_dict(stored, user_email)
+            if credentials and credentials.refresh_token:
+                from google_auth_httplib2 import Request
+                credentials.refresh(Request(build_http()))
+        except Exception as e:
+            logging.error(f"Background token refresh failed for {user_email}: {str(e)}")
+
+token_manager = TokenManager()
+
+#----------------
+# Metrics
+#----------------
+
+# Metric name -> (type, help text) for the /metrics exposition
+METRICS = {
+    'google_api_calls_total': ('counter', 'Google API calls by method, counting each batch sub-request'),
+    'google_api_request_seconds': ('histogram', 'Latency of Google API HTTP requests by method'),
+    'google_api_quota_units_total': ('counter', 'Quota units charged'),
+    'google_api_throttled_total': ('counter', 'Calls delayed by the per-user budget'),
+    'google_api_throttled_seconds_total': ('counter', 'Time spent waiting for the per-user budget'),
+    'google_api_rate_limited_total': ('counter', 'Calls rejected by Google with a rate limit'),
+    'google_api_retries_total': ('counter', 'Calls retried after a transient error'),
+    'google_api_failures_total': ('counter', 'Calls that failed for good'),
+    'operation_seconds': ('histogram', 'Latency of invoice processing operations'),
+    'pipeline_stage_seconds': ('histogram', 'Time a pipeline stage spends on one item'),
+    'pipeline_stage_errors_total': ('counter', 'Items a pipeline stage failed on'),
+    'attachment_bytes_downloaded_total': ('counter', 'Attachment bytes downloaded from Gmail'),
+    'attachment_bytes_uploaded_total': ('counter', 'Attachment bytes uploaded to Drive'),
+    'drive_bytes_downloaded_total': ('counter', 'File bytes downloaded from Drive for exports'),
+    'export_bytes_total': ('counter', 'Bytes streamed by invoice exports, by format'),
+    'invoices_processed_total': ('counter', 'Invoices uploaded and recorded'),
+    'messages_skipped_total': ('counter', 'Messages skipped because they were already imported'),
+    'invoices_failed_total': ('counter', 'Invoice attachments that failed to download, upload or persist'),
+    'messages_failed_total': ('counter', 'Messages that could not be fetched'),
+    'jobs_total': ('counter', 'Background jobs finished, by kind and status'),
+    'jobs_queued': ('gauge', 'Background jobs waiting to run'),
+    'jobs_in_flight': ('gauge', 'Background jobs running')
+}
+
+class MetricsRegistry:
+    """Counters, gauges and latency histograms for this worker process.
+    
+    Each worker writes a snapshot to DATA_DIR/metrics every
+    METRICS_FLUSH_INTERVAL seconds, and collect() merges the snapshots of all
+    workers: counters and histograms are summed, including workers that exited
+    recently, while gauges only count live workers. Labels must never carry
+    user data such as email addresses.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+        # A forked worker starts from zero instead of repeating its parent's numbers
+        os.register_at_fork(after_in_child=self._reset)
+    
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._instance = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._flusher = None
+    
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+    
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+        self._start_flusher()
+    
+    def gauge(self, name, delta, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + delta
+        self._start_flusher()
+    
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+            index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            if index < len(LATENCY_BUCKETS):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+        self._start_flusher()
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+    
+    @property
+    def snapshot_dir(self):
+        return os.path.join(DATA_DIR, 'metrics')
+    
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'updated_at': time.time(),
+                'counters': [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                'gauges': [[name, dict(labels), value] for (name, labels), value in self._gauges.items()],
+                'histograms': [[name, dict(labels), {**value, 'buckets': list(value['buckets'])}]
+                               for (name, labels), value in self._histograms.items()]
+            }
+    
+    def flush(self):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        atomic_write_json(os.path.join(self.snapshot_dir, f"{self._instance}.json"), self.snapshot())
+    
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is not None:
+                return
+            # Started on first use so each gunicorn worker gets its own thread
+            self._flusher = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+            self._flusher.start()
+    
+    def _flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Error writing metrics snapshot: {str(e)}")
+    
+    def collect(self):
+        """Merge this worker's numbers with the latest snapshots of the others"""
+        self.flush()
+        counters, gauges, histograms = {}, {}, {}
+        now = time.time()
+        for filename in os.listdir(self.snapshot_dir):
+            path = os.path.join(self.snapshot_dir, filename)
+            if filename.startswith('.tmp_'):
+                # Left behind by a worker killed mid-write; a live write takes well under a minute
+                try:
+                    if now - os.path.getmtime(path) > 60:
+                        os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path, 'r') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            
+            alive = is_process_alive(snapshot['pid'])
+            if not alive and now - snapshot['updated_at'] > METRICS_RETENTION:
+                os.remove(path)
+                continue
+            
+            for name, labels, value in snapshot['counters']:
+                key = self._key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot['gauges'] if alive else []:
+                key = self._key(name, labels)
+                gauges[key] = gauges.get(key, 0) + value
+            for name, labels, value in snapshot['histograms']:
+                key = self._key(name, labels)
+                merged = histograms.setdefault(key, {'buckets': [0] * len(LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+                merged['buckets'] = [a + b for a, b in zip(merged['buckets'], value['buckets'])]
+                merged['sum'] += value['sum']
+                merged['count'] += value['count']
+        return counters, gauges, histograms
+    
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format"""
+        counters, gauges, histograms = self.collect()
+        series = {}
+        for (name, labels), value in itertools.chain(counters.items(), gauges.items()):
+            series.setdefault(name, []).append(f"{name}{format_labels(labels)} {value:g}")
+        for (name, labels), value in histograms.items():
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, value['buckets']):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value['sum']:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+        
+        output = []
+        for name in sorted(series):
+            metric_type, help_text = METRICS.get(name, ('untyped', ''))
+            output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(sorted(series[name]))
+        return '\n'.join(output) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+metrics = MetricsRegistry()
+
+def timed(operation):
+    """Decorator recording a function's latency as operation_seconds{operation=...}"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer('operation_seconds', operation=operation):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+#----------------
+# Google API Quotas
+#----------------
+
+def is_rate_limit_error(exception):
+    """Check whether Google rejected a call because a quota or rate limit was hit"""
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.resp.status == 429:
+        return True
+    return exception.resp.status == 403 and (
+        'rateLimitExceeded' in str(exception) or 'userRateLimitExceeded' in str(exception)
+    )
+
+def is_retryable_error(exception, idempotent=True):
+    """Check whether a Google API error is transient and worth retrying.
+    
+    Google rejects a rate-limited call before doing any work, so every call may
+    be retried after one. A 5xx or a dropped connection can hide a call that
+    went through, so those are only retried for idempotent calls.
+    """
+    if is_rate_limit_error(exception):
+        return True
+    if not idempotent:
+        return False
+    if isinstance(exception, HttpError):
+        return exception.resp.status >= 500
+    # Connection resets, timeouts and similar transport errors
+    import httplib2
+    return isinstance(exception, (OSError, httplib2.HttpLib2Error))
+
+def retry_after_seconds(exception):
+    """Read the delay requested by a Retry-After header, if the response has one"""
+    resp = getattr(exception, 'resp', None)
+    value = resp.get('retry-after') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second, holding at most capacity.
+    
+    Callers reserve tokens up front and sleep off any shortfall, so waiting
+    threads are served in arrival order and a large request is never starved.
+    """
+    
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def reserve(self, tokens):
+        """Take tokens without waiting. Returns the seconds to wait before they may be used."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            return max(-self._tokens / self.rate, self._paused_until - now, 0.0)
+    
+    def acquire(self, tokens):
+        """Take tokens, blocking until they are available. Returns the seconds waited."""
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+        return delay
+    
+    def pause(self, seconds):
+        """Hold back every caller for a while, e.g. after Google reported a rate limit"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+class ApiQuota:
+    """Meters and retries Google API calls.
+    
+    Each (user, API) pair gets a token bucket: Gmail calls are charged their
+    quota units, Drive calls one token each. Calls that fail with a rate limit,
+    and idempotent calls that fail with a 5xx or a transport error, are retried
+    with jittered exponential backoff, waiting at least as long as a
+    Retry-After header asks. A rate limit also pauses the user's bucket so
+    concurrent threads back off together.
+    """
+    
+    COUNTERS = ('requests', 'quota_units', 'throttled', 'throttled_seconds', 'rate_limited', 'retries', 'failures')
+    
+    def __init__(self, rates=None, max_retries=GOOGLE_API_MAX_RETRIES, max_backoff=GOOGLE_API_MAX_BACKOFF):
+        # An API missing from rates is not throttled, so rates={} disables the budgets
+        if rates is None:
+            rates = {'gmail': GMAIL_QUOTA_UNITS_PER_SECOND, 'drive': DRIVE_REQUESTS_PER_SECOND}
+        self.rates = rates
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self._buckets = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def cost(api, method_id):
+        if api == 'gmail':
+            return GMAIL_METHOD_COSTS.get(method_id, GMAIL_DEFAULT_METHOD_COST)
+        return 1
+    
+    def _bucket(self, user_email, api):
+        key = (user_email, api)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None and api in self.rates:
+                bucket = self._buckets[key] = TokenBucket(self.rates[api])
+            return bucket
+    
+    def _count(self, api, name, amount=1):
+        with self._lock:
+            counters = self._counters.setdefault(api, dict.fromkeys(self.COUNTERS, 0))
+            counters[name] += amount
+        if name != 'requests':
+            metrics.inc(f"google_api_{name}_total", amount, api=api)
+    
+    def reserve(self, user_email, api, units):
+        """Take units from the user's budget for api; returns the seconds to wait before sending"""
+        self._count(api, 'requests')
+        self._count(api, 'quota_units', units)
+        bucket = self._bucket(user_email, api)
+        delay = bucket.reserve(units) if bucket else 0
+        if delay:
+            self._count(api, 'throttled')
+            self._count(api, 'throttled_seconds', delay)
+        return delay
+    
+    def acquire(self, user_email, api, units):
+        """Wait until the user's budget for api covers units"""
+        delay = self.reserve(user_email, api, units)
+        if delay:
+            time.sleep(delay)
+    
+    def charge(self, requests):
+        """Take budget for requests that are sent together, e.g. in an HTTP batch"""
+        units = {}
+        for http_request in requests:
+            quota_key = getattr(http_request, 'quota_key', None)
+            if quota_key:
+                units[quota_key] = units.get(quota_key, 0) + self.cost(quota_key[1], http_request.methodId)
+        for (user_email, api), total in units.items():
+            self.acquire(user_email, api, total)
+    
+    def backoff_delay(self, attempt, exception=None):
+        """Full-jitter exponential backoff, never shorter than a Retry-After header"""
+        delay = random.uniform(0, min(self.max_backoff, 2 ** attempt))
+        retry_after = retry_after_seconds(exception) if exception is not None else None
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+    
+    def record_failure(self, user_email, api, exception, attempt, retries=1):
+        """Count a transient failure and return how long to wait before retrying"""
+        delay = self.backoff_delay(attempt, exception)
+        if is_rate_limit_error(exception):
+            self._count(api, 'rate_limited')
+            bucket = self._bucket(user_email, api)
+            if bucket:
+                bucket.pause(delay)
+        self._count(api, 'retries', retries)
+        return delay
+    
+    def execute(self, user_email, api, method_id, send, idempotent=True, find_existing=None):
+        """Run send() within the user's budget, retrying transient failures.
+        
+        A call that is not idempotent is only retried after a 5xx or transport
+        error if find_existing() shows it did not go through: it returns the
+        call's result if it did, or None.
+        """
+        attempt = 0
+        while True:
+            self.acquire(user_email, api, self.cost(api, method_id))
+            metrics.inc('google_api_calls_total', api=api, method=method_id)
+            try:
+                with metrics.timer('google_api_request_seconds', api=api, method=method_id):
+                    return send()
+            except Exception as e:
+                retryable = is_retryable_error(e, idempotent)
+                if not retryable and find_existing and attempt < self.max_retries and is_retryable_error(e):
+                    existing = find_existing()
+                    if existing is not None:
+                        return existing
+                    retryable = True
+                if attempt >= self.max_retries or not retryable:
+                    self._count(api, 'failures')
+                    raise
+                delay = self.record_failure(user_email, api, e, attempt)
+                attempt += 1
+                logging.warning(f"Retrying {method_id} for {user_email} in {delay:.1f}s "
+                                f"(attempt {attempt}): {str(e)}")
+                time.sleep(delay)
+    
+    async def execute_async(self, user_email, api, method_id, send, idempotent=True, find_existing=None):
+        """execute() for coroutine functions; waits with asyncio.sleep so the event loop keeps running"""
+        attempt = 0
+        while True:
+            delay = self.reserve(user_email, api, self.cost(api, method_id))
+            if delay:
+                await asyncio.sleep(delay)
+            metrics.inc('google_api_calls_total', api=api, method=method_id)
+            try:
+                with metrics.timer('google_api_request_seconds', api=api, method=method_id):
+                    return await send()
+            except Exception as e:
+                retryable = is_retryable_error(e, idempotent)
+                if not retryable and find_existing and attempt < self.max_retries and is_retryable_error(e):
+                    existing = await find_existing()
+                    if existing is not None:
+                        return existing
+                    retryable = True
+                if attempt >= self.max_retries or not retryable:
+                    self._count(api, 'failures')
+                    raise
+                delay = self.record_failure(user_email, api, e, attempt)
+                attempt += 1
+                logging.warning(f"Retrying {method_id} for {user_email} in {delay:.1f}s "
+                                f"(attempt {attempt}): {str(e)}")
+                await asyncio.sleep(delay)
+    
+    def stats(self):
+        """Counters per API since the process started"""
+        with self._lock:
+            return {api: dict(counters) for api, counters in self._counters.items()}
+
+api_quota = ApiQuota()
+
+@lru_cache(maxsize=None)
+def quota_http_request_class():
+    """Define QuotaHttpRequest on first use, so googleapiclient is not imported at startup"""
+    from googleapiclient.http import HttpRequest
+    
+    class QuotaHttpRequest(HttpRequest):
+        """HttpRequest whose execute() goes through api_quota.
+        
+        Reads are retried freely. A resumable upload is retried within its
+        session, which carries on from the bytes Drive confirmed. Other writes
+        are only retried after a 5xx or transport error if find_existing is
+        set; see create_drive_file.
+        """
+        
+        quota_key = None
+        find_existing = None
+        
+        def execute(self, http=None, num_retries=0):
+            send = lambda: super(QuotaHttpRequest, self).execute(http=http, num_retries=num_retries)
+            if not self.quota_key:
+                return send()
+            user_email, api = self.quota_key
+            idempotent = self.method == 'GET' or self.resumable is not None
+            return api_quota.execute(user_email, api, self.methodId, send, idempotent=idempotent,
+                                     find_existing=self.find_existing)
+    
+    return QuotaHttpRequest
+
+#----------------
+# Google API Clients
+#----------------
+
+# Modules imported by warm_up() before gunicorn forks its workers
+GOOGLE_MODULES = (
+    'httplib2',
+    'google.oauth2.credentials',
+    'google_auth_httplib2',
+    'google_auth_oauthlib.flow',
+    'googleapiclient.discovery',
+    'googleapiclient.http',
+    'apscheduler.schedulers.background',
+)
+
+# Discovery documents parsed by warm_up()
+PRELOADED_DISCOVERY_DOCUMENTS = (('gmail', 'v1'), ('drive', 'v3'))
+
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+def build_http():
+    """Create the httplib2 transport googleapiclient would use by default"""
+    from googleapiclient.http import build_http as build_default_http
+    return build_default_http()
+
+def load_discovery_document(api, version):
+    """Load a discovery document from the static copies bundled with googleapiclient.
+    
+    Documents are parsed once per process, so building a service never fetches
+    or re-parses discovery JSON.
+    """
+    key = (api, version)
+    with _discovery_lock:
+        document = _discovery_documents.get(key)
+        if document is None:
+            from googleapiclient import discovery_cache
+            content = discovery_cache.get_static_doc(api, version)
+            if content is None:
+                raise ValueError(f"No bundled discovery document for {api} {version}")
+            document = json.loads(content)
+            _discovery_documents[key] = document
+    return document
+
+class ThreadLocalHttp:
+    """Give each thread its own keep-alive AuthorizedHttp for one set of credentials.
+    
+    httplib2 connections are not thread-safe, but the credentials object is
+    shared so a token refreshed by one thread is used by all of them.
+    """
+    
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._local = threading.local()
+    
+    def get(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            from google_auth_httplib2 import AuthorizedHttp
+            http = AuthorizedHttp(self.credentials, http=build_http())
+            self._local.http = http
+        return http
+
+def build_google_service(api, version, credentials_obj, user_email=None):
+    """Build a thread-safe service object from the bundled discovery document.
+    
+    Every request it creates is metered and retried by api_quota under
+    user_email's budget.
+    """
+    from googleapiclient.discovery import build_from_document
+    
+    transports = ThreadLocalHttp(credentials_obj)
+    request_class = quota_http_request_class()
+    
+    def request_builder(http, *args, **kwargs):
+        # Always send the request on the calling thread's connection
+        request = request_class(transports.get(), *args, **kwargs)
+        request.quota_key = (user_email, api)
+        return request
+    
+    return build_from_document(
+        load_discovery_document(api, version),
+        http=transports.get(),
+        requestBuilder=request_builder
+    )
+
+def warm_up():
+    """Import the Google client libraries and parse the discovery documents.
+    
+    gunicorn calls this in the master process before forking (see
+    gunicorn.conf.py), so every worker, including ones respawned later,
+    inherits them instead of loading them on its first Google request.
+    """
+    for module in GOOGLE_MODULES:
+        import_module(module)
+    managed_credentials_class()
+    quota_http_request_class()
+    for api, version in PRELOADED_DISCOVERY_DOCUMENTS:
+        load_discovery_document(api, version)
+
+class ServicePool:
+    """Process-wide LRU pool of built service objects keyed by user email and API.
+    
+    Entries are rebuilt when the user's refresh token or scopes change, e.g.
+    after signing in again.
+    """
+    
+    def __init__(self, max_size=SERVICE_POOL_SIZE):
+        self.max_size = max_size
+        self._services = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _fingerprint(credentials):
+        return (credentials.get('refresh_token'), tuple(credentials.get('scopes') or ()))
+    
+    def get(self, user_email, api, version, credentials):
+        key = (user_email, api, version)
+        fingerprint = self._fingerprint(credentials)
+        
+        with self._lock:
+            entry = self._services.get(key)
+            if entry and entry[0] == fingerprint:
+                self._services.move_to_end(key)
+                return entry[1]
+        
+        # Build outside the lock; a concurrent duplicate build is harmless
+        credentials_obj = credentials_from_dict(credentials, user_email)
+        if not credentials_obj:
+            return None
+        service = build_google_service(api, version, credentials_obj, user_email)
+        
+        with self._lock:
+            self._services[key] = (fingerprint, service)
+            self._services.move_to_end(key)
+            while len(self._services) > self.max_size:
+                self._services.popitem(last=False)
+        return service
+    
+    def evict(self, user_email):
+        with self._lock:
+            for key in [key for key in self._services if key[0] == user_email]:
+                del self._services[key]
+
+service_pool = ServicePool()
+
+def get_google_service(api, version, credentials, user_email=None):
+    """Return a pooled service for user_email, or a fresh one when no email is known"""
+    if not credentials:
+        return None
+    if user_email:
+        return service_pool.get(user_email, api, version, credentials)
+    
+    credentials_obj = credentials_from_dict(credentials)
+    if not credentials_obj:
+        return None
+    return build_google_service(api, version, credentials_obj)
+
+#----------------
+# Gmail Service
+#----------------
+
+def build_gmail_service(credentials, user_email=None):
+    """Build Gmail API service"""
+    return get_google_service('gmail', 'v1', credentials, user_email)
+
+def build_invoice_query(start_date, end_date):
+    """Build the Gmail search query for invoice emails in a date range"""
+    after_date = start_date.strftime('%Y/%m/%d')
+    before_date = end_date.strftime('%Y/%m/%d')
+    
+    # Query for emails with attachments that might be invoices
+    subjects = ' OR '.join(f"subject:{keyword}" for keyword in INVOICE_SUBJECT_KEYWORDS)
+    return f"has:attachment after:{after_date} before:{before_date} ({subjects})"
+
+_invoice_subject_pattern = re.compile(
+    r'\b(' + '|'.join(re.escape(keyword) for keyword in INVOICE_SUBJECT_KEYWORDS) + r')',
+    re.IGNORECASE
+)
+
+def matches_invoice_criteria(email_data, start_date, end_date):
+    """Apply the invoice search criteria locally, for messages not found by a search query"""
+    if not email_data or not email_data.get('has_attachments'):
+        return False
+    if not _invoice_subject_pattern.search(email_data['subject']):
+        return False
+    # Same bounds as the after:/before: search operators
+    return start_date.date() <= email_data['date'].date() < end_date.date()
+
+class MessagePager:
+    """Lazily enumerate Gmail messages matching a query, following page tokens.
+    
+    Pages are only requested as the caller consumes messages, so processing can
+    start on the first page while later pages have not been listed yet.
+    """
+    
+    def __init__(self, service, query, max_results=None, page_size=GMAIL_LIST_PAGE_SIZE,
+                 page_token=None, on_page=None):
+        self.service = service
+        self.query = query
+        self.max_results = max_results
+        self.page_size = min(page_size, GMAIL_LIST_PAGE_SIZE)
+        self.next_page_token = page_token
+        self.on_page = on_page
+        self.pages_fetched = 0
+        self.messages_listed = 0
+        self.messages_seen = 0
+        self.estimated_total = None
+        self.exhausted = False
+    
+    def _remaining(self):
+        if self.max_results is None:
+            return None
+        return self.max_results - self.messages_seen
+    
+    def __iter__(self):
+        while not self.exhausted:
+            remaining = self._remaining()
+            if remaining is not None and remaining <= 0:
+                break
+            
+            page_size = self.page_size if remaining is None else min(self.page_size, remaining)
+            results = self._list_page(page_size)
+            messages = self._page_messages(results)
+            
+            self.pages_fetched += 1
+            self.messages_listed += len(messages)
+            self.next_page_token = results.get('nextPageToken')
+            self.estimated_total = results.get('resultSizeEstimate', self.estimated_total)
+            if not self.next_page_token:
+                self.exhausted = True
+            
+            if self.on_page:
+                self.on_page(self.progress())
+            
+            for msg in messages:
+                if remaining is not None and self.messages_seen >= self.max_results:
+                    break
+                self.messages_seen += 1
+                yield msg
+    
+    @timed('list_messages_page')
+    def _list_page(self, page_size):
+        params = {
+            'userId': 'me',
+            'q': self.query,
+            'maxResults': page_size
+        }
+        if self.next_page_token:
+            params['pageToken'] = self.next_page_token
+        return self.service.users().messages().list(**params).execute()
+    
+    def _page_messages(self, results):
+        return results.get('messages', [])
+    
+    def progress(self):
+        """Return enumeration progress counters"""
+        return {
+            'pages_fetched': self.pages_fetched,
+            'messages_listed': self.messages_listed,
+            'messages_seen': self.messages_seen,
+            'estimated_total': self.estimated_total,
+            'exhausted': self.exhausted
+        }
+
+class HistoryPager(MessagePager):
+    """Lazily enumerate messages added to the mailbox since a history ID.
+    
+    history.list answers with 404 once the start history ID has expired, in
+    which case the caller should fall back to a full search.
+    """
+    
+    # Messages with these labels never show up in a normal search
+    EXCLUDED_LABELS = {'DRAFT', 'SPAM', 'TRASH'}
+    
+    def __init__(self, service, start_history_id, **kwargs):
+        super().__init__(service, None, **kwargs)
+        self.start_history_id = start_history_id
+        self._seen_ids = set()
+    
+    def _list_page(self, page_size):
+        params = {
+            'userId': 'me',
+            'startHistoryId': self.start_history_id,
+            'historyTypes': 'messageAdded',
+            'maxResults': page_size
+        }
+        if self.next_page_token:
+            params['pageToken'] = self.next_page_token
+        return self.service.users().history().list(**params).execute()
+    
+    def _page_messages(self, results):
+        messages = []
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                if message['id'] in self._seen_ids or self.EXCLUDED_LABELS & set(message.get('labelIds', [])):
+                    continue
+                self._seen_ids.add(message['id'])
+                messages.append({'id': message['id'], 'threadId': message.get('threadId')})
+        return messages
+
+def get_mailbox_history_id(service):
+    """Get the mailbox's current history ID"""
+    return service.users().getProfile(userId='me').execute().get('historyId')
+
+def list_invoice_emails(service, start_date=None, end_date=None, max_results=None):
+    """List emails that potentially contain invoices"""
+    if not start_date:
+        start_date = datetime.utcnow() - timedelta(days=30)
+    
+    if not end_date:
+        end_date = datetime.utcnow()
+    
+    query = build_invoice_query(start_date, end_date)
+    
+    try:
+        return list(MessagePager(service, query, max_results=max_results))
+    except Exception as e:
         logging.error(f"Error fetching invoice emails: {str(e)}")
         return []
 
+@timed('get_email_content')
 def get_email_content(service, msg_id):
-    """Get full content of an email message"""
+    """Get the headers and attachment structure of an email message"""
     try:
-        message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+        message = service.users().messages().get(
+            userId='me', id=msg_id, format='full', fields=MESSAGE_FULL_FIELDS
+        ).execute()
+        if parts_truncated(message):
+            message = service.users().messages().get(
+                userId='me', id=msg_id, format='full', fields=MESSAGE_TREE_FIELDS
+            ).execute()
         return message
     except Exception as e:
         logging.error(f"Error getting email content: {str(e)}")
         return None
 
+def chunked(iterable, size):
+    """Yield lists of up to size items from an iterable without materializing it"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def message_get_params(message_format='full', fields=None, metadata_headers=None):
+    """messages.get parameters, narrowed to fields and metadata_headers when given"""
+    params = {'format': message_format}
+    if fields:
+        params['fields'] = fields
+    if metadata_headers:
+        params['metadataHeaders'] = metadata_headers
+    return params
+
+def batch_get_messages(service, message_ids, callback, batch_size=GMAIL_BATCH_SIZE, message_format='full',
+                       max_retries=GMAIL_BATCH_MAX_RETRIES, fields=None, metadata_headers=None):
+    """Fetch messages through HTTP batch requests.
+    
+    callback(msg_id, message) is called once per message ID; message is None if
+    the fetch failed for good. Only the sub-requests that failed with a transient
+    error are retried, in a new batch. fields and metadata_headers narrow the
+    response to what the caller reads.
+    """
+    get_params = {'userId': 'me', **message_get_params(message_format, fields, metadata_headers)}
+    
+    pending = list(dict.fromkeys(message_ids))
+    attempt = 0
+    
+    while pending:
+        retry = []
+        errors = []
+        
+        for chunk in chunked(pending, batch_size):
+            answered = set()
+            
+            def handle_response(request_id, response, exception):
+                answered.add(request_id)
+                if exception is None:
+                    callback(request_id, response)
+                elif attempt < max_retries and is_retryable_error(exception):
+                    retry.append(request_id)
+                    errors.append(exception)
+                else:
+                    logging.error(f"Error getting email content for {request_id}: {str(exception)}")
+                    callback(request_id, None)
+            
+            batch = service.new_batch_http_request(callback=handle_response)
+            requests = [service.users().messages().get(id=msg_id, **get_params) for msg_id in chunk]
+            for msg_id, message_request in zip(chunk, requests):
+                batch.add(message_request, request_id=msg_id)
+            
+            # Each sub-request of a batch is charged against the quota on its own
+            api_quota.charge(requests)
+            metrics.inc('google_api_calls_total', len(requests), api='gmail', method='gmail.users.messages.get')
+            
+            try:
+                with metrics.timer('google_api_request_seconds', api='gmail', method='gmail.batch'):
+                    batch.execute()
+            except Exception as e:
+                # The batch itself failed, so every unanswered sub-request is retried
+                logging.error(f"Error executing Gmail batch request: {str(e)}")
+                errors.append(e)
+                for msg_id in chunk:
+                    if msg_id in answered:
+                        continue
+                    if attempt < max_retries:
+                        retry.append(msg_id)
+                    else:
+                        callback(msg_id, None)
+        
+        if retry:
+            # Rate limits take precedence so the user's whole budget is paused
+            quota_key = getattr(requests[0], 'quota_key', None) or (None, 'gmail')
+            error = next((error for error in errors if is_rate_limit_error(error)), errors[0])
+            delay = api_quota.record_failure(quota_key[0], quota_key[1], error, attempt, retries=len(retry))
+            attempt += 1
+            logging.info(f"Retrying {len(retry)} failed Gmail batch sub-requests in {delay:.1f}s (attempt {attempt})")
+            time.sleep(delay)
+        pending = retry
+
 def extract_email_data(message):
     """Extract relevant data from email message"""
     if not message or 'payload' not in message:
@@ -237,32 +2471,53 @@ def extract_email_data(message):
         'sender': sender,
         'sender_email': sender_email,
         'date': date,
-        'has_attachments': 'parts' in message['payload']
+        # Metadata-only responses carry the MIME type but not the parts
+        'has_attachments': 'parts' in message['payload'] or
+                           message['payload'].get('mimeType', '').startswith('multipart/')
     }
 
-def get_attachment(service, message_id, attachment_id, attachment_filename):
-    """Download an email attachment"""
+@timed('get_attachment')
+def decode_attachment(attachment):
+    """Decode a messages.attachments.get response into a spooled buffer.
+    
+    The buffer stays in memory up to ATTACHMENT_MEMORY_LIMIT bytes and then
+    rolls over to an anonymous temp file, so no two downloads share a path.
+    The caller must close it.
+    """
+    data = attachment['data']
+    buffer = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_MEMORY_LIMIT)
+    
+    # Decode in slices so a large attachment is never held twice in memory
+    for start in range(0, len(data), BASE64_DECODE_CHUNK):
+        buffer.write(base64.urlsafe_b64decode(data[start:start + BASE64_DECODE_CHUNK]))
+    metrics.inc('attachment_bytes_downloaded_total', buffer.tell())
+    buffer.seek(0)
+    return buffer
+
+def get_attachment(service, message_id, attachment_id):
+    """Download an email attachment into a spooled buffer; the caller must close it"""
     try:
         attachment = service.users().messages().attachments().get(
             userId='me', 
             messageId=message_id, 
             id=attachment_id
         ).execute()
-        
-        file_data = base64.urlsafe_b64decode(attachment['data'])
-        
-        # Create temporary file to store the attachment
-        temp_dir = tempfile.gettempdir()
-        file_path = os.path.join(temp_dir, attachment_filename)
-        
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
-            
-        return file_path
+        return decode_attachment(attachment)
     except Exception as e:
         logging.error(f"Error downloading attachment: {str(e)}")
         return None
 
+def parts_truncated(message):
+    """True if the parts mask cut a message's multipart tree off before its leaves"""
+    def truncated(part):
+        if part.get('mimeType', '').startswith('multipart/') and 'parts' not in part:
+            return True
+        return any(truncated(child) for child in part.get('parts', []))
+    
+    if not message or 'payload' not in message:
+        return False
+    return any(truncated(part) for part in message['payload'].get('parts', []))
+
 def list_attachments(message):
     """List all attachments in an email message"""
     if not message or 'payload' not in message:
@@ -274,10 +2529,11 @@ def list_attachments(message):
         if message_part.get('mimeType') == 'multipart/mixed' or message_part.get('mimeType') == 'multipart/related' or message_part.get('mimeType') == 'multipart/alternative':
             for part in message_part.get('parts', []):
                 extract_attachments(part)
-        elif message_part.get('mimeType') in ['application/pdf', 'image/jpeg', 'image/png', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 'application/msword']:
+        elif message_part.get('mimeType') in INVOICE_MIME_TYPES:
             if 'body' in message_part and 'attachmentId' in message_part['body']:
                 attachments.append({
                     'id': message_part['body']['attachmentId'],
+                    'part_id': message_part.get('partId'),
                     'filename': message_part.get('filename', f"attachment_{message_part['body']['attachmentId']}"),
                     'mimeType': message_part['mimeType'],
                     'size': message_part['body'].get('size', 0)
@@ -293,13 +2549,66 @@ def list_attachments(message):
 # Google Drive Service
 #----------------
 
-def build_drive_service(credentials):
+def build_drive_service(credentials, user_email=None):
     """Build Google Drive API service"""
-    credentials_obj = credentials_from_dict(credentials)
-    if not credentials_obj:
-        return None
-        
-    return build('drive', 'v3', credentials=credentials_obj)
+    return get_google_service('drive', 'v3', credentials, user_email)
+
+def build_media_upload(source, mime_type=None):
+    """Wrap a file path or an open binary file for upload.
+    
+    Small files are sent in a single request; only files above
+    RESUMABLE_UPLOAD_THRESHOLD use a resumable session.
+    """
+    from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
+    
+    if isinstance(source, str):
+        resumable = os.path.getsize(source) > RESUMABLE_UPLOAD_THRESHOLD
+        return MediaFileUpload(source, mimetype=mime_type, chunksize=UPLOAD_CHUNK_SIZE, resumable=resumable)
+    
+    source.seek(0, os.SEEK_END)
+    resumable = source.tell() > RESUMABLE_UPLOAD_THRESHOLD
+    source.seek(0)
+    return MediaIoBaseUpload(
+        source,
+        mimetype=mime_type or 'application/octet-stream',
+        chunksize=UPLOAD_CHUNK_SIZE,
+        resumable=resumable
+    )
+
+def tag_created_file(file_metadata):
+    """Tag file metadata with a random create_id app property; returns (create_id, tagged metadata)"""
+    create_id = uuid.uuid4().hex
+    return create_id, {**file_metadata, 'appProperties': {**file_metadata.get('appProperties', {}), 'create_id': create_id}}
+
+def created_file_query(create_id, drive_id=None, fields='id'):
+    """files.list parameters that find the file tagged with create_id"""
+    parameters = {
+        'q': f"appProperties has {{ key='create_id' and value='{create_id}' }} and trashed=false",
+        'fields': f"files({fields})",
+        'pageSize': 1,
+        'supportsAllDrives': True,
+        'includeItemsFromAllDrives': True
+    }
+    if drive_id:
+        parameters.update(corpora='drive', driveId=drive_id)
+    return parameters
+
+def find_created_file(service, create_id, drive_id=None, fields='id'):
+    """Find the file a create_drive_file call tagged with create_id made, or None"""
+    files = service.files().list(**created_file_query(create_id, drive_id, fields)).execute().get('files', [])
+    return files[0] if files else None
+
+def create_drive_file(service, file_metadata, drive_id=None, **params):
+    """Send files().create so that a retry after a lost response cannot create a duplicate.
+    
+    The file is tagged with a random create_id app property, and before the
+    create is sent again after a 5xx or transport error, the file is looked
+    up by that tag. Resumable uploads are retried within their session instead.
+    """
+    create_id, file_metadata = tag_created_file(file_metadata)
+    http_request = service.files().create(body=file_metadata, **params)
+    http_request.find_existing = lambda: find_created_file(service, create_id, drive_id, params.get('fields', 'id'))
+    return http_request.execute()
 
 def upload_file(service, file_path, folder_id, file_name=None):
     """Upload a file to Google Drive"""
@@ -312,12 +2621,13 @@ def upload_file(service, file_path, folder_id, file_name=None):
             'parents': [folder_id] if folder_id else []
         }
         
-        media = MediaFileUpload(file_path, resumable=True)
-        file = service.files().create(
-            body=file_metadata,
+        media = build_media_upload(file_path)
+        file = create_drive_file(
+            service,
+            file_metadata,
             media_body=media,
             fields='id,webViewLink'
-        ).execute()
+        )
         
         return {
             'file_id': file.get('id'),
@@ -327,35 +2637,76 @@ def upload_file(service, file_path, folder_id, file_name=None):
         logging.error(f"Error uploading file to Google Drive: {str(e)}")
         return None
 
-def upload_file_to_shared_drive(service, file_path, folder_id, drive_id, file_name=None):
-    """Upload a file to a shared Google Drive folder"""
+def upload_metadata(file_name, folder_id):
+    """Metadata of a file uploaded into folder_id"""
+    return {
+        'name': file_name,
+        'parents': [folder_id] if folder_id else []
+    }
+
+def uploaded_file(file):
+    """The upload result callers get from a created file's id and webViewLink"""
+    return {
+        'file_id': file.get('id'),
+        'web_link': file.get('webViewLink')
+    }
+
+def upload_failed(error, folder_id):
+    """Raise FolderNotFoundError if Drive lost the target folder; otherwise log the failed upload and return None"""
+    if isinstance(error, HttpError) and error.resp.status == 404 and folder_id:
+        raise FolderNotFoundError(folder_id) from error
+    logging.error(f"Error uploading file to Google Drive: {str(error)}")
+    return None
+
+@timed('upload_file_to_shared_drive')
+def upload_file_to_shared_drive(service, source, folder_id, drive_id, file_name=None, mime_type=None):
+    """Upload a file path or an open binary file to a shared Google Drive folder"""
     if not file_name:
-        file_name = os.path.basename(file_path)
+        file_name = os.path.basename(source)
         
     try:
         logging.info(f"Uploading file '{file_name}' to shared drive ID: {drive_id}, folder ID: {folder_id}")
-        file_metadata = {
-            'name': file_name,
-            'parents': [folder_id] if folder_id else []
-        }
-        
-        media = MediaFileUpload(file_path, resumable=True)
-        file = service.files().create(
-            body=file_metadata,
+        media = build_media_upload(source, mime_type)
+        file = create_drive_file(
+            service,
+            upload_metadata(file_name, folder_id),
+            drive_id,
             media_body=media,
             fields='id,webViewLink',
             supportsAllDrives=True
-        ).execute()
+        )
+        metrics.inc('attachment_bytes_uploaded_total', media.size() or 0)
         
-        result = {
-            'file_id': file.get('id'),
-            'web_link': file.get('webViewLink')
-        }
+        result = uploaded_file(file)
         logging.info(f"Successfully uploaded file '{file_name}' to Google Drive with ID: {result['file_id']}")
         return result
     except Exception as e:
-        logging.error(f"Error uploading file to Google Drive: {str(e)}")
-        return None
+        return upload_failed(e, folder_id)
+
+@timed('download_drive_file')
+def download_drive_file(service, file_id, user_email=None):
+    """Download a Drive file into a spooled buffer, EXPORT_CHUNK_SIZE bytes per request.
+
+    Each chunk is metered and retried by api_quota under user_email's budget.
+    The buffer stays in memory up to ATTACHMENT_MEMORY_LIMIT bytes and the
+    caller must close it.
+    """
+    from googleapiclient.http import MediaIoBaseDownload
+
+    buffer = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_MEMORY_LIMIT)
+    try:
+        request = service.files().get_media(fileId=file_id, supportsAllDrives=True)
+        downloader = MediaIoBaseDownload(buffer, request, chunksize=EXPORT_CHUNK_SIZE)
+        done = False
+        while not done:
+            _, done = api_quota.execute(user_email, 'drive', 'drive.files.get', downloader.next_chunk)
+        metrics.inc('drive_bytes_downloaded_total', buffer.tell())
+        buffer.seek(0)
+        return buffer
+    except Exception as e:
+        buffer.close()
+        logging.error(f"Error downloading file {file_id} from Google Drive: {str(e)}")
+        return None
 
 def find_or_create_folder(service, folder_name, parent_folder_id=None):
     """Find a folder by name or create if it doesn't exist"""
@@ -364,7 +2715,7 @@ def find_or_create_folder(service, folder_name, parent_folder_id=None):
         if parent_folder_id:
             query += f" and '{parent_folder_id}' in parents"
             
-        results = service.files().list(q=query, fields="files(id, name)").execute()
+        results = service.files().list(q=query, fields="files(id)", pageSize=1).execute()
         folders = results.get('files', [])
         
         if folders:
@@ -377,18 +2728,143 @@ def find_or_create_folder(service, folder_name, parent_folder_id=None):
                 'parents': [parent_folder_id] if parent_folder_id else []
             }
             
-            folder = service.files().create(
-                body=file_metadata,
+            folder = create_drive_file(
+                service,
+                file_metadata,
                 fields='id'
-            ).execute()
+            )
             
             return folder.get('id')
     except Exception as e:
         logging.error(f"Error finding or creating folder: {str(e)}")
         return None
 
+class FolderNotFoundError(Exception):
+    """Raised when Drive reports that a target folder no longer exists"""
+    
+    def __init__(self, folder_id):
+        super().__init__(f"Folder not found: {folder_id}")
+        self.folder_id = folder_id
+
+class FolderCache:
+    """Drive folder IDs keyed by (drive_id, parent_id, name) with TTL eviction.
+    
+    Entries are persisted to a JSON file in DATA_DIR so all gunicorn workers
+    share them. The file is re-read only when its mtime changes.
+    """
+    
+    def __init__(self, filename='drive_folders.json', ttl=FOLDER_CACHE_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self._entries = {}
+        self._mtime = None
+        self._lock = threading.Lock()
+        self._lookup_locks = {}
+    
+    @property
+    def path(self):
+        return os.path.join(DATA_DIR, 'cache', self.filename)
+    
+    @staticmethod
+    def _key(drive_id, parent_id, name):
+        return json.dumps([drive_id or '', parent_id or '', name])
+    
+    def _load(self):
+        """Refresh the in-memory copy if another process changed the file"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            self._entries, self._mtime = {}, None
+            return
+        if mtime != self._mtime:
+            try:
+                with open(self.path, 'r') as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"Error loading folder cache: {str(e)}")
+                self._entries = {}
+            self._mtime = mtime
+    
+    def _update(self, mutate):
+        """Apply a change under the cross-process lock and persist it"""
+        with self._lock, file_lock(self.path):
+            self._mtime = None
+            self._load()
+            now = time.time()
+            self._entries = {key: entry for key, entry in self._entries.items()
+                             if now - entry['cached_at'] < self.ttl}
+            mutate(self._entries)
+            atomic_write_json(self.path, self._entries)
+            self._mtime = os.path.getmtime(self.path)
+    
+    def get(self, drive_id, parent_id, name):
+        with self._lock:
+            self._load()
+            entry = self._entries.get(self._key(drive_id, parent_id, name))
+        if entry and time.time() - entry['cached_at'] < self.ttl:
+            return entry['id']
+        return None
+    
+    def lookup_lock(self, drive_id, parent_id, name):
+        """Lock that lets only one thread in this process look up or create a folder"""
+        with self._lock:
+            return self._lookup_locks.setdefault(self._key(drive_id, parent_id, name), threading.Lock())
+    
+    def set(self, drive_id, parent_id, name, folder_id):
+        entry = {'id': folder_id, 'parent_id': parent_id, 'cached_at': time.time()}
+        self._update(lambda entries: entries.__setitem__(self._key(drive_id, parent_id, name), entry))
+    
+    def invalidate(self, folder_id):
+        """Drop a folder along with its cached ancestors and descendants"""
+        def remove(entries):
+            by_id = {entry['id']: key for key, entry in entries.items()}
+            
+            # Walk up: a missing folder may mean a parent was deleted or trashed
+            stale_ids = set()
+            current = folder_id
+            while current and current not in stale_ids:
+                stale_ids.add(current)
+                key = by_id.get(current)
+                current = entries[key]['parent_id'] if key else None
+            
+            # Walk down: children of a stale folder are gone too
+            changed = True
+            while changed:
+                changed = False
+                for entry in entries.values():
+                    if entry['parent_id'] in stale_ids and entry['id'] not in stale_ids:
+                        stale_ids.add(entry['id'])
+                        changed = True
+            
+            for key in [key for key, entry in entries.items() if entry['id'] in stale_ids]:
+                del entries[key]
+        
+        logging.info(f"Invalidating cached folder ID: {folder_id}")
+        self._update(remove)
+
+folder_cache = FolderCache()
+
+@timed('find_or_create_folder_in_shared_drive')
 def find_or_create_folder_in_shared_drive(service, folder_name, drive_id, parent_folder_id=None):
     """Find a folder by name in a shared drive or create if it doesn't exist"""
+    cached_id = folder_cache.get(drive_id, parent_folder_id, folder_name)
+    if cached_id:
+        return cached_id
+    
+    # Months backfilled in parallel share their year folder: the first thread
+    # resolves it and the others pick it up from the cache instead of creating duplicates
+    with folder_cache.lookup_lock(drive_id, parent_folder_id, folder_name):
+        cached_id = folder_cache.get(drive_id, parent_folder_id, folder_name)
+        if cached_id:
+            return cached_id
+        
+        folder_id = _find_or_create_folder_in_shared_drive(service, folder_name, drive_id, parent_folder_id)
+        if folder_id:
+            folder_cache.set(drive_id, parent_folder_id, folder_name, folder_id)
+        return folder_id
+
+def _find_or_create_folder_in_shared_drive(service, folder_name, drive_id, parent_folder_id=None):
+    """Look up a folder through the Drive API, creating it if it doesn't exist"""
     try:
         logging.info(f"Finding folder '{folder_name}' in shared drive ID: {drive_id}, parent: {parent_folder_id}")
         query = f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
@@ -401,7 +2877,8 @@ def find_or_create_folder_in_shared_drive(service, folder_name, drive_id, parent
         if drive_id:
             parameters = {
                 'q': query,
-                'fields': 'files(id, name)',
+                'fields': 'files(id)',
+                'pageSize': 1,
                 'corpora': 'drive',
                 'driveId': drive_id,
                 'includeItemsFromAllDrives': True,
@@ -411,7 +2888,8 @@ def find_or_create_folder_in_shared_drive(service, folder_name, drive_id, parent
             # For regular folders
             parameters = {
                 'q': query,
-                'fields': 'files(id, name)',
+                'fields': 'files(id)',
+                'pageSize': 1,
                 'supportsAllDrives': True
             }
         
@@ -443,11 +2921,13 @@ def create_folder_in_shared_drive(service, folder_name, drive_id, parent_folder_
         elif drive_id:
             file_metadata['parents'] = [drive_id]
         
-        folder = service.files().create(
-            body=file_metadata,
+        folder = create_drive_file(
+            service,
+            file_metadata,
+            drive_id,
             supportsAllDrives=True,
             fields='id'
-        ).execute()
+        )
         
         folder_id = folder.get('id')
         logging.info(f"Created folder '{folder_name}' with ID: {folder_id}")
@@ -519,199 +2999,2207 @@ def create_drive_folder_structure(service, year, month, user_name):
             logging.error("Failed to create user folder in shared drive")
             return None
         
-        # Files will be placed directly into the user folder
+        # Files will be placed directly into the user folder
+        return {
+            'folder_id': user_folder_id,
+            'drive_id': shared_drive_id
+        }
+            
+    except Exception as e:
+        logging.error(f"Error creating folder structure: {str(e)}")
+        return None
+
+#----------------
+# Invoice Categorization
+#----------------
+
+class CategoryEngine:
+    """Assigns invoice categories from rules compiled once.
+    
+    Sender domains go into a dict looked up by domain suffix, so a rule for
+    'amazon.com' also matches 'billing.amazon.com'. Filename patterns and
+    subject keywords are each compiled into one alternation with a named
+    group per rule, so every rule is tried in a single regex search. The
+    sender domain wins over the filename, which wins over the subject.
+    """
+    
+    def __init__(self, rules):
+        self.domains = {}
+        self.rule_categories = {}
+        filename_groups = []
+        keyword_groups = []
+        for i, rule in enumerate(rules):
+            group = f"rule{i}"
+            self.rule_categories[group] = rule['category']
+            for domain in rule.get('domains', []):
+                self.domains.setdefault(domain.lower().strip('.'), rule['category'])
+            if rule.get('filenames'):
+                patterns = '|'.join(fnmatch.translate(pattern) for pattern in rule['filenames'])
+                filename_groups.append(f"(?P<{group}>{patterns})")
+            if rule.get('keywords'):
+                # Longest first so 'boarding pass' is preferred over a shorter keyword at the same spot
+                keywords = sorted(rule['keywords'], key=len, reverse=True)
+                keyword_groups.append(f"(?P<{group}>{'|'.join(re.escape(keyword) for keyword in keywords)})")
+        self.filename_re = re.compile('|'.join(filename_groups), re.I) if filename_groups else None
+        self.keyword_re = re.compile(rf"\b(?:{'|'.join(keyword_groups)})\b", re.I) if keyword_groups else None
+    
+    def match_domain(self, domain):
+        labels = domain.split('.') if domain else []
+        for i in range(len(labels) - 1):
+            category = self.domains.get('.'.join(labels[i:]))
+            if category:
+                return category
+        return None
+    
+    def match_text(self, invoice):
+        # Invoices stored before attachment_name was kept only have the date-prefixed upload name
+        filename = invoice.get('attachment_name') or re.sub(r'^\d{8}_', '', invoice.get('filename') or '')
+        match = self.filename_re.match(filename) if self.filename_re and filename else None
+        if not match and self.keyword_re and invoice.get('subject'):
+            match = self.keyword_re.search(invoice['subject'])
+        return self.rule_categories[match.lastgroup] if match else None
+    
+    def categorize(self, invoices):
+        """Set the category of every invoice in a batch, looking each sender domain up once"""
+        domain_categories = {}
+        for invoice in invoices:
+            domain = sender_domain(invoice.get('sender'))
+            if domain not in domain_categories:
+                domain_categories[domain] = self.match_domain(domain)
+            invoice['category'] = domain_categories[domain] or self.match_text(invoice) or 'Uncategorized'
+        return invoices
+
+_category_engine = (None, None)
+_category_engine_lock = threading.Lock()
+
+def load_category_rules():
+    if not CATEGORY_RULES_PATH:
+        return DEFAULT_CATEGORY_RULES
+    with open(CATEGORY_RULES_PATH, 'r') as f:
+        return json.load(f)
+
+def get_category_engine():
+    """Return the compiled engine, recompiling after the rules file changes"""
+    global _category_engine
+    try:
+        signature = os.stat(CATEGORY_RULES_PATH).st_mtime_ns if CATEGORY_RULES_PATH else None
+    except OSError as e:
+        logging.error(f"Error reading category rules, using the defaults: {str(e)}")
+        signature = None
+    with _category_engine_lock:
+        cached_signature, engine = _category_engine
+        if engine is None or cached_signature != signature:
+            rules = load_category_rules() if signature is not None else DEFAULT_CATEGORY_RULES
+            engine = CategoryEngine(rules)
+            _category_engine = (signature, engine)
+        return engine
+
+#----------------
+# Invoice Extraction
+#----------------
+
+# Labels that precede an invoice total, strongest first
+TOTAL_LABELS = [
+    r'grand\s+total', r'(?:total\s+)?amount\s+due', r'balance\s+due', r'total\s+due',
+    r'amount\s+paid', r'total(?:\s+\(?[a-z]{3}\)?)?'
+]
+CURRENCY_SYMBOLS = {'$': 'USD', '€': 'EUR', '£': 'GBP', '¥': 'JPY', '₹': 'INR'}
+CURRENCY_CODES = ['USD', 'EUR', 'GBP', 'JPY', 'INR', 'CAD', 'AUD', 'CHF', 'SEK', 'NOK', 'DKK', 'PLN', 'CZK']
+CURRENCY_PATTERN = '|'.join([re.escape(symbol) for symbol in CURRENCY_SYMBOLS] + CURRENCY_CODES)
+AMOUNT_PATTERN = r'\d{1,3}(?:[,. ]\d{3})+(?:[.,]\d{1,2})?|\d+(?:[.,]\d{1,2})?'
+TOTAL_RES = [
+    re.compile(
+        rf'\b(?:{label})\b[^\n\d]{{0,30}}?(?P<before>{CURRENCY_PATTERN})?\s*(?P<amount>{AMOUNT_PATTERN})'
+        rf'(?:\s*(?P<after>{CURRENCY_PATTERN}))?',
+        re.I
+    )
+    for label in TOTAL_LABELS
+]
+
+def pdf_text(data):
+    """Text of a PDF's pages as laid out by pypdf.
+    
+    Literal, hex and CID-keyed (e.g. Identity-H) strings are all decoded
+    through the fonts' encodings and ToUnicode maps; scanned PDFs yield no text.
+    """
+    from pypdf import PdfReader
+    from pypdf.errors import PyPdfError
+    
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        if reader.is_encrypted:
+            # Invoices are often locked against editing only, which leaves the user password empty
+            reader.decrypt('')
+        return '\n'.join(page.extract_text() or '' for page in reader.pages)
+    except PyPdfError as e:
+        # Damaged and password-protected files are stored without extracted fields
+        logging.warning(f"Could not read PDF text: {str(e)}")
+        return ''
+
+def docx_text(data):
+    """Paragraph text of a .docx document"""
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        xml = archive.read('word/document.xml').decode('utf-8', 'replace')
+    paragraphs = re.split(r'</w:p>', xml)
+    return '\n'.join(unescape(''.join(re.findall(r'<w:t[^>]*>([^<]*)</w:t>', p))) for p in paragraphs)
+
+def parse_amount(value):
+    """Turn '1,234.56', '1.234,56' or '1 234' into a float"""
+    value = re.sub(r'\s', '', value)
+    separators = [i for i, char in enumerate(value) if char in ',.']
+    if separators:
+        last = separators[-1]
+        # The last separator is a decimal point when one or two digits follow it
+        if len(value) - last - 1 in (1, 2):
+            return float(re.sub(r'[,.]', '', value[:last]) + '.' + value[last + 1:])
+    return float(re.sub(r'[,.]', '', value))
+
+def find_total(text):
+    """Find an invoice's total and currency code in its text, or (None, None)"""
+    for total_re in TOTAL_RES:
+        # Totals are usually printed last, after subtotals and line items
+        matches = list(total_re.finditer(text))
+        for match in reversed(matches):
+            amount = parse_amount(match.group('amount'))
+            if amount <= 0:
+                continue
+            symbol = match.group('before') or match.group('after')
+            currency = CURRENCY_SYMBOLS.get(symbol, symbol.upper() if symbol else None)
+            if not currency:
+                found = re.search(CURRENCY_PATTERN, text)
+                currency = CURRENCY_SYMBOLS.get(found.group(), found.group()) if found else None
+            return round(amount, 2), currency
+    return None, None
+
+def extract_invoice_fields(data, mime_type):
+    """Read total, currency and vendor from an attachment; runs in the extraction processes"""
+    if mime_type == 'application/pdf':
+        text = pdf_text(data)
+    elif mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+        text = docx_text(data)
+    else:
+        return {}
+    
+    amount, currency = find_total(text)
+    fields = {}
+    if amount is not None:
+        fields['amount'] = amount
+    if currency:
+        fields['currency'] = currency
+    
+    # The issuer's name is normally the first line of the document
+    first_line = next((line.strip() for line in text.splitlines() if line.strip()), None)
+    if first_line and not re.search(r'\d|invoice|receipt', first_line, re.I) and len(first_line) <= 60:
+        fields['vendor'] = first_line
+    return fields
+
+# Attachment types extract_invoice_fields can read; images would need OCR
+EXTRACTABLE_MIME_TYPES = {
+    'application/pdf',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+}
+
+def attachment_digest(content):
+    """SHA-256 of a downloaded attachment buffer, leaving it rewound"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: content.read(1024 * 1024), b''):
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+class InvoiceExtractor:
+    """Runs extract_invoice_fields on a process pool with results cached by content hash.
+    
+    Results are kept in DATA_DIR/extractions/<sha256>.json, so an attachment
+    that was parsed once, by any process, is never parsed again. Identical
+    attachments submitted while a parse is running share its future.
+    """
+    
+    def __init__(self, workers=EXTRACTION_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending = {}
+    
+    def _cache_path(self, digest):
+        return os.path.join(DATA_DIR, 'extractions', f"{digest}.json")
+    
+    def _get_pool(self):
+        # Created on first use, after gunicorn forks. Workers are spawned rather
+        # than forked so they don't inherit locks held by this process's threads
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+    
+    def cached(self, digest):
+        try:
+            with open(self._cache_path(digest), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry['fields'] if entry.get('version') == EXTRACTION_VERSION else None
+    
+    def submit(self, content, mime_type):
+        """Start extracting a downloaded attachment; returns (sha256, future of a fields dict)"""
+        digest = attachment_digest(content)
+        done = Future()
+        fields = self.cached(digest)
+        if fields is not None:
+            done.set_result(fields)
+            return digest, done
+        
+        size = content.seek(0, os.SEEK_END)
+        content.seek(0)
+        if mime_type not in EXTRACTABLE_MIME_TYPES or size > EXTRACTION_MAX_BYTES:
+            done.set_result({})
+            return digest, done
+        
+        with self._lock:
+            future = self._pending.get(digest)
+            if future:
+                return digest, future
+            future = self._pending[digest] = Future()
+        
+        try:
+            data = content.read()
+            content.seek(0)
+            try:
+                parse = self._get_pool().submit(extract_invoice_fields, data, mime_type)
+            except BrokenProcessPool:
+                with self._lock:
+                    self._pool = None
+                parse = self._get_pool().submit(extract_invoice_fields, data, mime_type)
+        except Exception as e:
+            # Release the digest so waiters and later submits are not left on a parse that never started
+            logging.error(f"Error starting invoice extraction: {str(e)}")
+            with self._lock:
+                self._pending.pop(digest, None)
+            future.set_result({})
+            return digest, future
+        parse.add_done_callback(lambda parse: self._finish(digest, future, parse))
+        return digest, future
+    
+    def _finish(self, digest, future, parse):
+        try:
+            fields = parse.result()
+            path = self._cache_path(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write_json(path, {'version': EXTRACTION_VERSION, 'fields': fields})
+        except Exception as e:
+            logging.error(f"Error extracting invoice fields: {str(e)}")
+            fields = {}
+        with self._lock:
+            self._pending.pop(digest, None)
+        future.set_result(fields)
+    
+    def result(self, future):
+        """Fields from a submitted extraction, or {} if it takes longer than EXTRACTION_TIMEOUT"""
+        try:
+            return future.result(timeout=EXTRACTION_TIMEOUT)
+        except Exception as e:
+            logging.warning(f"Invoice extraction did not finish: {str(e) or type(e).__name__}")
+            return {}
+
+invoice_extractor = InvoiceExtractor()
+
+#----------------
+# Processing Pipeline
+#----------------
+
+class PipelineStage:
+    """A pool of worker threads consuming items from a bounded queue.
+    
+    put() blocks while the queue is full, which throttles the stage feeding
+    this one. Errors raised by the handler are logged and counted per item
+    without stopping the stage.
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, name, handler, workers=1, queue_size=PIPELINE_QUEUE_SIZE, on_error=None):
+        self.name = name
+        self.handler = handler
+        self.on_error = on_error
+        self.workers = max(1, workers)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._threads = []
+    
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+    
+    def put(self, item):
+        self.queue.put(item)
+    
+    def close(self):
+        """Wait for queued items to drain and stop the workers"""
+        for _ in self._threads:
+            self.queue.put(self._STOP)
+        for thread in self._threads:
+            thread.join()
+    
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._STOP:
+                break
+            try:
+                with metrics.timer('pipeline_stage_seconds', stage=self.name):
+                    self.handler(item)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                logging.error(f"Error in {self.name} stage: {str(e)}")
+                metrics.inc('pipeline_stage_errors_total', stage=self.name)
+                with self._lock:
+                    self.errors += 1
+                if self.on_error:
+                    self.on_error(item, e)
+
+#----------------
+# Async Fetch Engine
+#----------------
+
+@lru_cache(maxsize=None)
+def fetch_engine():
+    """The configured FETCH_ENGINE, or 'threads' when the asyncio engine cannot run"""
+    if FETCH_ENGINE != 'asyncio':
+        return 'threads'
+    try:
+        import_module('aiohttp')
+    except ImportError:
+        logging.error("FETCH_ENGINE=asyncio needs the aiohttp package; using the threads engine")
+        return 'threads'
+    return 'asyncio'
+
+class AsyncLoop:
+    """One asyncio event loop per process, running on a daemon thread.
+
+    The loop and its pooled aiohttp session are created on first use, after
+    gunicorn forks. Syncs started from any thread run their coroutines here
+    and share the connection pool, so the number of concurrent syncs is not
+    bounded by the requests each of them keeps in flight.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # The loop thread does not survive a fork
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def run(self, coroutine):
+        """Run a coroutine on the loop, blocking the calling thread until it finishes"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='async-fetch', daemon=True).start()
+            loop = self._loop
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def session(self):
+        """The shared aiohttp session; only used from the loop"""
+        if self._session is None:
+            import aiohttp
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=ASYNC_MAX_CONNECTIONS),
+                timeout=aiohttp.ClientTimeout(sock_connect=ASYNC_SOCKET_TIMEOUT, sock_read=ASYNC_SOCKET_TIMEOUT)
+            )
+        return self._session
+
+async_loop = AsyncLoop()
+
+def google_http_error(status, reason, headers, content, uri):
+    """Build the HttpError googleapiclient would raise, so retry and rate-limit checks apply unchanged"""
+    import httplib2
+    resp = httplib2.Response({**headers, 'status': status})
+    resp.reason = reason
+    return HttpError(resp, content, uri=uri)
+
+class ByteBudget:
+    """Bounds the bytes held by coroutines on one loop.
+
+    A claim larger than the whole budget is let through once nothing else
+    holds any, so a single oversized attachment cannot stall a sync.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self._changed = asyncio.Condition()
+
+    @asynccontextmanager
+    async def claim(self, size):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.used == 0 or self.used + size <= self.limit)
+            self.used += size
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self.used -= size
+                self._changed.notify_all()
+
+class AsyncGoogleClient:
+    """Gmail and Drive REST calls for one user's sync on the async loop.
+
+    Calls are metered and retried by api_quota under the user's budget, like
+    the googleapiclient path, and at most ASYNC_REQUESTS_PER_SYNC are in
+    flight at once. Must be created on the loop.
+    """
+
+    def __init__(self, user_email, credentials):
+        self.user_email = user_email
+        self.credentials = credentials
+        self._requests = asyncio.Semaphore(ASYNC_REQUESTS_PER_SYNC)
+        self._refresh_lock = asyncio.Lock()
+
+    async def _authorize(self, headers, stale_token=None):
+        # Expired (or rejected) tokens are refreshed once through token_manager, off the loop
+        async with self._refresh_lock:
+            if not self.credentials.valid or (stale_token and self.credentials.token == stale_token):
+                from google_auth_httplib2 import Request
+                await asyncio.to_thread(self.credentials.refresh, Request(build_http()))
+        token_manager.mark_used(self.user_email)
+        self.credentials.apply(headers)
+        return headers['authorization']
+
+    async def send(self, api, method_id, method, url, params=None, data=None, headers=None, idempotent=None,
+                   find_existing=None):
+        """Send one call and return (status, headers, body); error statuses raise HttpError.
+        
+        GET and PUT calls are idempotent unless idempotent says otherwise. For
+        other calls, find_existing() returns the resource the call would have
+        returned if it already went through, or None; see ApiQuota.execute.
+        """
+        import aiohttp
+        session = async_loop.session()
+        query = self._query(params)
+
+        async def attempt():
+            request_headers = dict(headers or {})
+            stale_token = None
+            async with self._requests:
+                for _ in range(2):
+                    token = await self._authorize(request_headers, stale_token)
+                    try:
+                        async with session.request(method, url, params=query, data=data, headers=request_headers,
+                                                   allow_redirects=False) as response:
+                            status, reason = response.status, response.reason
+                            response_headers = {key.lower(): value for key, value in response.headers.items()}
+                            body = await response.read()
+                    except aiohttp.ClientError as e:
+                        # Retried by api_quota like any other connection error
+                        raise ConnectionError(f"{method} {url}: {str(e)}") from e
+                    if status != 401 or stale_token:
+                        break
+                    stale_token = token.split(' ', 1)[-1]
+            if status >= 400:
+                raise google_http_error(status, reason, response_headers, body, url)
+            return status, response_headers, body
+
+        async def find_response():
+            existing = await find_existing()
+            return None if existing is None else (200, {}, json.dumps(existing).encode())
+
+        if idempotent is None:
+            idempotent = method in ('GET', 'PUT')
+        return await api_quota.execute_async(self.user_email, api, method_id, attempt, idempotent=idempotent,
+                                             find_existing=find_response if find_existing else None)
+
+    @staticmethod
+    def _query(params):
+        # Encoded as googleapiclient does: booleans as 'true'/'false', lists as repeated keys
+        query = []
+        for key, value in (params or {}).items():
+            for item in value if isinstance(value, list) else [value]:
+                query.append((key, str(item).lower() if isinstance(item, bool) else str(item)))
+        return query
+
+    async def call(self, api, method_id, method, url, **kwargs):
+        """Send one call and return its decoded JSON response"""
+        _, _, body = await self.send(api, method_id, method, url, **kwargs)
+        return json.loads(body) if body else {}
+
+    async def get_message(self, msg_id, message_format='full', fields=None, metadata_headers=None):
+        """messages.get for one message, narrowed like batch_get_messages"""
+        return await self.call('gmail', 'gmail.users.messages.get', 'GET',
+                               f"{GMAIL_API_URL}/users/me/messages/{msg_id}",
+                               params=message_get_params(message_format, fields, metadata_headers))
+
+    async def get_attachment(self, message_id, attachment_id):
+        """Download an attachment into a spooled buffer like get_attachment(); the caller must close it"""
+        try:
+            with metrics.timer('operation_seconds', operation='get_attachment'):
+                attachment = await self.call(
+                    'gmail', 'gmail.users.messages.attachments.get', 'GET',
+                    f"{GMAIL_API_URL}/users/me/messages/{message_id}/attachments/{attachment_id}"
+                )
+            return decode_attachment(attachment)
+        except Exception as e:
+            logging.error(f"Error downloading attachment: {str(e)}")
+            return None
+
+    async def upload_file(self, source, folder_id, drive_id, file_name, mime_type):
+        """Upload an open binary file into a shared drive folder like upload_file_to_shared_drive()"""
+        # Tagged like create_drive_file, so a lost response is not retried into a duplicate
+        create_id, metadata = tag_created_file(upload_metadata(file_name, folder_id))
+        params = {'supportsAllDrives': True, 'fields': 'id,webViewLink'}
+        size = source.seek(0, os.SEEK_END)
+        source.seek(0)
+        try:
+            logging.info(f"Uploading file '{file_name}' to folder ID: {folder_id}")
+            with metrics.timer('operation_seconds', operation='upload_file_to_shared_drive'):
+                if size > RESUMABLE_UPLOAD_THRESHOLD:
+                    file = await self._upload_resumable(source, size, metadata, mime_type, params)
+                else:
+                    boundary = uuid.uuid4().hex
+                    body = (f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+                            f"{json.dumps(metadata)}\r\n--{boundary}\r\nContent-Type: {mime_type}\r\n\r\n").encode()
+                    body += source.read() + f"\r\n--{boundary}--".encode()
+                    file = await self.call('drive', 'drive.files.create', 'POST', f"{DRIVE_UPLOAD_URL}/files",
+                                           params={**params, 'uploadType': 'multipart'}, data=body,
+                                           headers={'Content-Type': f"multipart/related; boundary={boundary}"},
+                                           find_existing=lambda: self.find_created_file(create_id, drive_id))
+            metrics.inc('attachment_bytes_uploaded_total', size)
+            return uploaded_file(file)
+        except Exception as e:
+            return upload_failed(e, folder_id)
+
+    async def find_created_file(self, create_id, drive_id=None):
+        """find_created_file() on the async loop"""
+        response = await self.call('drive', 'drive.files.list', 'GET', f"{DRIVE_API_URL}/files",
+                                   params=created_file_query(create_id, drive_id, 'id,webViewLink'))
+        files = response.get('files', [])
+        return files[0] if files else None
+
+    async def _upload_resumable(self, source, size, metadata, mime_type, params):
+        # Opening a session creates no file, so it is safe to retry
+        _, headers, _ = await self.send(
+            'drive', 'drive.files.create', 'POST', f"{DRIVE_UPLOAD_URL}/files",
+            params={**params, 'uploadType': 'resumable'}, data=json.dumps(metadata).encode(),
+            headers={'Content-Type': 'application/json; charset=UTF-8', 'X-Upload-Content-Type': mime_type,
+                     'X-Upload-Content-Length': str(size)}, idempotent=True
+        )
+        session_url = headers['location']
+        offset = 0
+        while True:
+            chunk = source.read(UPLOAD_CHUNK_SIZE)
+            status, headers, body = await self.send(
+                'drive', 'drive.files.create', 'PUT', session_url, data=chunk,
+                headers={'Content-Range': f"bytes {offset}-{offset + len(chunk) - 1}/{size}"}
+            )
+            if status != 308:
+                return json.loads(body)
+            # Continue from the last byte Drive confirmed
+            received = headers.get('range')
+            offset = int(received.rsplit('-', 1)[1]) + 1 if received else 0
+            source.seek(offset)
+
+#----------------
+# Invoice Processing
+#----------------
+
+class SyncCheckpoint:
+    """Durable progress of one month's sync inside a background job.
+    
+    Entries are appended as JSON lines and fsynced before the work they record
+    is reported, so an attachment shown as uploaded survives a crash together
+    with its invoice record and Drive file ID. Kept in the job's checkpoint
+    directory as <YYYY-MM>.jsonl.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.entries = []
+        self._file = None
+        self._torn = False
+        self._lock = threading.Lock()
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except ValueError:
+                        # Only the last line can be cut short, by a crash while it was written
+                        pass
+                    self._torn = not line.endswith('\n')
+        except FileNotFoundError:
+            pass
+    
+    @classmethod
+    def for_job(cls, job_id, year, month):
+        return cls(os.path.join(job_manager.checkpoint_dir(job_id), f"{year:04d}-{month:02d}.jsonl"))
+    
+    def append(self, entry):
+        """Write an entry and flush it to disk"""
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, 'a')
+                if self._torn:
+                    self._file.write('\n')
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.entries.append(entry)
+    
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class ListingProgress:
+    """Finds the page a sync can list again from after an interruption.
+    
+    Listed messages are numbered in listing order and each carries a count of
+    unfinished work (its fetch, then one per attachment). Once every message
+    before a page is finished, that page's token is a safe point to resume
+    listing from, even while later messages are still in flight.
+    """
+    
+    def __init__(self, page_token=None):
+        self._page_token = page_token
+        self._pages = deque()
+        self._positions = {}
+        self._outstanding = {}
+        self._finished = set()
+        self._low = None
+        self._lock = threading.Lock()
+    
+    def page(self, position, next_page_token):
+        """Record a listed page by the position of its first message and the token of the page after it"""
+        with self._lock:
+            self._pages.append((position, self._page_token))
+            self._page_token = next_page_token
+            if self._low is None:
+                self._low = position
+    
+    def listed(self, msg_id, position):
+        with self._lock:
+            self._positions[msg_id] = position
+            self._outstanding[msg_id] = 1
+    
+    def track(self, msg_id):
+        """Count the fetch of a message that was not listed in this run"""
+        with self._lock:
+            self._outstanding[msg_id] = 1
+    
+    def add_work(self, msg_id, count):
+        with self._lock:
+            self._outstanding[msg_id] = self._outstanding.get(msg_id, 0) + count
+    
+    def skip(self, position):
+        """Finish a listed position that is handled elsewhere; returns a new resume point or None"""
+        with self._lock:
+            return self._finish_position(position)
+    
+    def finish(self, msg_id):
+        """Finish one unit of a message's work; returns a new (position, page_token) resume point or None"""
+        with self._lock:
+            remaining = self._outstanding.get(msg_id, 1) - 1
+            if remaining > 0:
+                self._outstanding[msg_id] = remaining
+                return None
+            self._outstanding.pop(msg_id, None)
+            position = self._positions.pop(msg_id, None)
+            return None if position is None else self._finish_position(position)
+    
+    def _finish_position(self, position):
+        self._finished.add(position)
+        while self._low in self._finished:
+            self._finished.remove(self._low)
+            self._low += 1
+        resume_point = None
+        while self._pages and self._pages[0][0] <= self._low:
+            resume_point = self._pages.popleft()
+        return resume_point
+
+class MonthSync:
+    """One run importing a user's invoices for a month into the shared drive.
+    
+    Holds the state the steps of a run share: the listing and its resume
+    position, the checkpoint, what earlier runs imported and the results so
+    far. fetch, download, upload and persist each handle one work item and
+    are driven by run_month_sync_threads; run_month_sync_async drives the
+    same run through fetch_async and import_async. finish records the
+    results once every item is done.
+    """
+    
+    def __init__(self, user_email, user_data, year, month, gmail_service, drive_service, force=False,
+                 progress=None, checkpoint=None):
+        self.user_email = user_email
+        self.user_data = user_data
+        self.year = year
+        self.month = month
+        self.gmail_service = gmail_service
+        self.drive_service = drive_service
+        self.force = force
+        self.report = progress or (lambda event: None)
+        self.checkpoint = checkpoint
+        
+        # Create start and end dates for the month
+        self.start_date = datetime(year, month, 1)
+        
+        # Determine the last day of the month
+        if month == 12:
+            next_month = datetime(year + 1, 1, 1)
+        else:
+            next_month = datetime(year, month + 1, 1)
+        self.end_date = next_month - timedelta(days=1)
+        self.month_name = self.start_date.strftime('%B %Y')
+        
+        # Uploads committed by an interrupted run, and messages it failed on
+        self.started, self.resume_from = None, None
+        self.committed = {}
+        retry_ids = []
+        for entry in (checkpoint.entries if checkpoint else []):
+            if entry['type'] == 'started':
+                self.started, self.resume_from = entry, None
+            elif entry['type'] == 'position':
+                if not self.resume_from or entry['messages_seen'] > self.resume_from['messages_seen']:
+                    self.resume_from = entry
+            elif entry['type'] == 'committed':
+                self.committed[(entry['message_id'], entry['attachment'])] = entry
+            elif entry['type'] == 'failed':
+                retry_ids.append(entry['message_id'])
+        self.retry_ids = list(dict.fromkeys(retry_ids))
+        
+        self.sync_mode = 'full'
+        self.pager = None
+        self.listing = None
+        self.messages = iter(())
+        self.first_message = None
+        self.current_history_id = None
+        self.folder_info = None
+        
+        # Messages and attachments imported by earlier runs
+        self.processed_index = {}
+        
+        # Results, tagged with their mailbox order since steps finish in any order
+        self.processed_files = []
+        self.new_invoices = []
+        self.message_attachments = {}
+        self.succeeded_keys = set()
+        self.skipped_count = 0
+        self.failed_count = 0
+        self._lock = threading.Lock()
+        self._folder_lock = threading.Lock()
+    
+    @property
+    def is_empty(self):
+        """True when nothing was listed and the interrupted run left nothing to finish"""
+        return self.first_message is None and not self.committed and not self.retry_ids
+    
+    def save(self, entry):
+        if self.checkpoint:
+            self.checkpoint.append(entry)
+    
+    def list_messages(self, incremental=True, max_messages=GMAIL_MAX_MESSAGES, mailbox_history_id=None):
+        """Start listing the month, from where the interrupted run got to if there was one.
+        
+        A month synced before only lists messages added since, unless
+        incremental is off, force is set or the saved history ID expired.
+        """
+        started, resume_from = self.started, self.resume_from
+        
+        # Capture the mailbox position before listing so mail arriving mid-run is seen next time
+        self.current_history_id = ((started and started['history_id']) or mailbox_history_id
+                                   or get_mailbox_history_id(self.gmail_service))
+        last_history_id = self.user_data.get('history_ids', {}).get(f"{self.year:04d}-{self.month:02d}")
+        
+        # A listing position only holds for the same search, or the same history ID
+        if started and started['mode'] == 'incremental' and started['since'] != last_history_id:
+            started, resume_from = None, None
+        page_token = resume_from['page_token'] if resume_from else None
+        self.listing = ListingProgress(page_token)
+        
+        if incremental and not self.force and last_history_id and (not started or started['mode'] == 'incremental'):
+            self.pager = HistoryPager(self.gmail_service, last_history_id, max_results=max_messages,
+                                      page_token=page_token, on_page=self._log_page)
+            if resume_from:
+                self.pager.messages_seen = resume_from['messages_seen']
+            self.messages = iter(self.pager)
+            try:
+                self.first_message = next(self.messages, None)
+                self.sync_mode = 'incremental'
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                logging.info(f"History ID {last_history_id} expired for {self.user_email}, running a full search")
+                started, resume_from = None, None
+                self.listing = ListingProgress()
+        
+        if self.sync_mode == 'full':
+            # Query Gmail for emails with attachments for the specified month
+            query = build_invoice_query(self.start_date, self.end_date)
+            self.pager = MessagePager(self.gmail_service, query, max_results=max_messages,
+                                      page_token=resume_from['page_token'] if resume_from else None,
+                                      on_page=self._log_page)
+            if resume_from:
+                self.pager.messages_seen = resume_from['messages_seen']
+            self.messages = iter(self.pager)
+            self.first_message = next(self.messages, None)
+        
+        if not started:
+            self.save({'type': 'started', 'mode': self.sync_mode, 'since': last_history_id,
+                       'history_id': self.current_history_id})
+    
+    def _log_page(self, page_progress):
+        logging.info(f"Listed page {page_progress['pages_fetched']} of invoice emails for "
+                     f"{self.month_name} ({page_progress['messages_listed']} messages so far)")
+        self.listing.page(page_progress['messages_seen'], self.pager.next_page_token)
+        self.report({'type': 'listed', **page_progress})
+    
+    def finish_empty(self):
+        """The result of a month with no invoice emails to look at"""
+        if self.current_history_id:
+            set_month_history_id(self.user_email, self.year, self.month, self.current_history_id)
+        return {
+            'success': True,
+            'message': f'No {"new " if self.sync_mode == "incremental" else ""}invoice emails found for '
+                       f'{self.month_name}.',
+            'count': 0,
+            'mode': self.sync_mode
+        }
+    
+    def prepare(self):
+        """Create the Drive folders and take over the interrupted run's uploads; False if the folders fail"""
+        # Create folder structure in Google Drive
+        self.folder_info = create_drive_folder_structure(
+            self.drive_service,
+            self.year,
+            self.month,
+            self.user_data['name']
+        )
+        if not self.folder_info:
+            return False
+        
+        self.processed_index = load_processed_index(self.user_email)
+        
+        # Uploads committed before an interruption are done; their records are stored
+        # below unless the interrupted run got as far as storing them itself
+        for (msg_id, key), entry in self.committed.items():
+            self.succeeded_keys.add((msg_id, key))
+            self.processed_files.append(((-1, len(self.processed_files)), entry['file']))
+            if entry['record'] and key not in self.processed_index.get(msg_id, {}).get('attachments', []):
+                self.new_invoices.append(((-1, len(self.new_invoices)), entry['record'], key))
+            self.report({'type': 'uploaded', **entry['file']})
+        if self.committed or self.retry_ids:
+            logging.info(f"Resuming {self.month_name} for {self.user_email} with {len(self.committed)} "
+                         f"uploaded invoices, {len(self.retry_ids)} messages to retry")
+        return True
+    
+    def refresh_folder_info(self, stale_folder_id):
+        """Re-resolve the folder structure once after Drive reports a cached folder missing"""
+        with self._folder_lock:
+            if self.folder_info['folder_id'] == stale_folder_id:
+                folder_cache.invalidate(stale_folder_id)
+                self.folder_info = create_drive_folder_structure(
+                    self.drive_service, self.year, self.month, self.user_data['name']
+                ) or self.folder_info
+            return self.folder_info
+    
+    def store_invoices(self, entries, processed):
+        """Categorize and record (order, record, attachment key) entries in mailbox order"""
+        records = [record for _, record, _ in sorted(entries, key=lambda entry: entry[0])]
+        get_category_engine().categorize(records)
+        record_processed(self.user_data['email'], records, processed)
+    
+    def store_batch(self):
+        """Store the new invoices once a full batch is waiting, marking their attachments imported"""
+        with self._lock:
+            if len(self.new_invoices) < PERSIST_BATCH_SIZE:
+                return
+            batch = self.new_invoices[:]
+            del self.new_invoices[:]
+        processed = {}
+        for _, record, key in batch:
+            processed.setdefault(record['message_id'], {'attachments': [], 'complete': False})['attachments'].append(key)
+        try:
+            self.store_invoices(batch, processed)
+        except Exception as e:
+            # Kept for the final write at the end of the run
+            logging.error(f"Error storing invoice batch: {str(e)}")
+            with self._lock:
+                self.new_invoices.extend(batch)
+    
+    def save_position(self, resume_point):
+        if resume_point:
+            self.save({'type': 'position', 'messages_seen': resume_point[0], 'page_token': resume_point[1]})
+    
+    def finish_work(self, msg_id):
+        """Finish a unit of a message's work, saving the new listing position once earlier pages are done"""
+        self.save_position(self.listing.finish(msg_id))
+    
+    def message_ids(self):
+        """Messages the interrupted run failed on, then the ones listed by this run"""
+        for msg_id in self.retry_ids:
+            self.listing.track(msg_id)
+            yield msg_id
+        retried = set(self.retry_ids)
+        for msg in itertools.chain([self.first_message] if self.first_message else [], self.messages):
+            position = self.pager.messages_seen - 1
+            if msg['id'] in retried:
+                self.save_position(self.listing.skip(position))
+                continue
+            self.listing.listed(msg['id'], position)
+            yield msg['id']
+    
+    def message_failed(self, msg_id):
+        """Count a message whose fetch failed; a resumed run fetches it again"""
+        with self._lock:
+            self.failed_count += 1
+        self.save({'type': 'failed', 'message_id': msg_id})
+        self.finish_work(msg_id)
+    
+    def skip_imported(self, msg_ids):
+        """Drop fully imported messages before their content is fetched"""
+        if self.force:
+            return msg_ids
+        pending_ids = [msg_id for msg_id in msg_ids if not self.processed_index.get(msg_id, {}).get('complete')]
+        with self._lock:
+            self.skipped_count += len(msg_ids) - len(pending_ids)
+        if len(pending_ids) < len(msg_ids):
+            self.report({'type': 'skipped', 'count': len(msg_ids) - len(pending_ids)})
+            for msg_id in set(msg_ids) - set(pending_ids):
+                self.finish_work(msg_id)
+        return pending_ids
+    
+    def attachment_items(self, chunk_index, msg_index, msg_id, message, email_data):
+        """Work items for the invoice attachments of a fetched message that still need importing"""
+        attachments = list_attachments(message) if email_data and email_data.get('has_attachments') else []
+        invoice_attachments = [attachment for attachment in attachments
+                               if attachment['mimeType'] in INVOICE_MIME_TYPES]
+        
+        with self._lock:
+            self.message_attachments[msg_id] = [attachment_key(attachment) for attachment in invoice_attachments]
+        
+        # Attachments recorded by an earlier run are not downloaded again
+        done_keys = set(self.processed_index.get(msg_id, {}).get('attachments', []))
+        
+        items = []
+        for attachment_index, attachment in enumerate(invoice_attachments):
+            already_processed = attachment_key(attachment) in done_keys
+            if (already_processed and not self.force) or (msg_id, attachment_key(attachment)) in self.committed:
+                continue
+            items.append({
+                'order': (chunk_index, msg_index, attachment_index),
+                'email_data': email_data,
+                'attachment': attachment,
+                'already_processed': already_processed,
+                # Generate filename with date info
+                'filename': f"{email_data['date'].strftime('%Y%m%d')}_{attachment['filename']}"
+            })
+        self.listing.add_work(msg_id, len(items))
+        return items
+    
+    def fetch(self, item):
+        """Fetch a (chunk index, message IDs) chunk, yielding the attachment items to download"""
+        chunk_index, msg_ids = item
+        
+        msg_ids = self.skip_imported(msg_ids)
+        if not msg_ids:
+            return
+        
+        # A search query has already applied the invoice criteria, but history
+        # lists every new message: filter those on headers first and fetch the
+        # attachment structure only for the ones that match
+        header_data = {}
+        if self.sync_mode == 'incremental':
+            headers_fetched = {}
+            batch_get_messages(
+                self.gmail_service,
+                msg_ids,
+                headers_fetched.__setitem__,
+                message_format='metadata',
+                fields=MESSAGE_METADATA_FIELDS,
+                metadata_headers=INVOICE_HEADERS
+            )
+            for msg_id, message in headers_fetched.items():
+                if message is None:
+                    self.message_failed(msg_id)
+                    continue
+                email_data = extract_email_data(message)
+                if matches_invoice_criteria(email_data, self.start_date, self.end_date):
+                    header_data[msg_id] = email_data
+                else:
+                    self.finish_work(msg_id)
+            msg_ids = [msg_id for msg_id in msg_ids if msg_id in header_data]
+        
+        fetched = {}
+        batch_get_messages(
+            self.gmail_service,
+            msg_ids,
+            fetched.__setitem__,
+            fields=MESSAGE_STRUCTURE_FIELDS if self.sync_mode == 'incremental' else MESSAGE_FULL_FIELDS
+        )
+        truncated_ids = [msg_id for msg_id, message in fetched.items() if parts_truncated(message)]
+        if truncated_ids:
+            batch_get_messages(self.gmail_service, truncated_ids, fetched.__setitem__, fields=MESSAGE_TREE_FIELDS)
+        
+        for msg_index, msg_id in enumerate(msg_ids):
+            try:
+                message = fetched.get(msg_id)
+                if not message:
+                    self.message_failed(msg_id)
+                    continue
+                
+                # Extract email data
+                email_data = header_data.get(msg_id) or extract_email_data(message)
+                items = self.attachment_items(chunk_index, msg_index, msg_id, message, email_data)
+            except Exception as e:
+                logging.error(f"Error processing message: {str(e)}")
+                self.message_failed(msg_id)
+                continue
+            yield from items
+            self.finish_work(msg_id)
+    
+    def fetch_failed(self, item, error):
+        """Fail every message of a chunk that fetch could not work through"""
+        _, msg_ids = item
+        for msg_id in msg_ids:
+            self.message_failed(msg_id)
+    
+    def download(self, item):
+        """Download an attachment into item['content']; False once a failed download is reported"""
+        item['content'] = get_attachment(
+            self.gmail_service,
+            item['email_data']['message_id'],
+            item['attachment']['id']
+        )
+        if not item['content']:
+            self.report_failure(item, 'download failed')
+            return False
+        self.extract(item, item['content'])
+        return True
+    
+    def extract(self, item, content):
+        # Parsed on the extraction pool while the upload runs; persist collects the result
+        item['sha256'], item['extraction'] = invoice_extractor.submit(content, item['attachment']['mimeType'])
+    
+    def upload(self, item):
+        """Upload a downloaded attachment into the month's folder; False once a failed upload is reported"""
+        content = item.pop('content')
+        mime_type = item['attachment']['mimeType']
+        try:
+            # Upload to Google Drive in the appropriate folder
+            target = self.folder_info
+            try:
+                item['result'] = upload_file_to_shared_drive(
+                    self.drive_service,
+                    content,
+                    target['folder_id'],
+                    target['drive_id'],
+                    item['filename'],
+                    mime_type
+                )
+            except FolderNotFoundError as e:
+                logging.warning(f"Cached folder {e.folder_id} is gone, resolving folder structure again")
+                target = self.refresh_folder_info(e.folder_id)
+                item['result'] = upload_file_to_shared_drive(
+                    self.drive_service,
+                    content,
+                    target['folder_id'],
+                    target['drive_id'],
+                    item['filename'],
+                    mime_type
+                )
+        finally:
+            # Release the buffer; a spilled temp file is deleted on close
+            content.close()
+        
+        if not item['result']:
+            self.report_failure(item, 'upload failed')
+            return False
+        return True
+    
+    def persist(self, item):
+        """Commit an uploaded attachment to the checkpoint and queue its invoice record for the store"""
+        email_data = item['email_data']
+        result = item['result']
+        fields = invoice_extractor.result(item['extraction'])
+        
+        # Queue a record for the store if not already processed
+        record = None
+        if not item['already_processed']:
+            record = {
+                'filename': item['filename'],
+                'sender': email_data['sender'],
+                'subject': email_data['subject'],
+                'received_date': email_data['date'].isoformat(),
+                'gdrive_link': result['web_link'],
+                'message_id': email_data['message_id'],
+                'attachment_name': item['attachment']['filename'],
+                'file_id': result['file_id'],
+                'sha256': item['sha256'],
+                'amount': fields.get('amount'),
+                'currency': fields.get('currency'),
+                'vendor': fields.get('vendor') or sender_name(email_data['sender'])
+            }
+        file_entry = {'name': item['filename'], 'link': result['web_link']}
+        
+        # Saved before it is reported so a resumed run never uploads it again
+        self.save({
+            'type': 'committed',
+            'message_id': email_data['message_id'],
+            'attachment': attachment_key(item['attachment']),
+            'file_id': result['file_id'],
+            'record': record,
+            'file': file_entry
+        })
+        
+        with self._lock:
+            self.succeeded_keys.add((email_data['message_id'], attachment_key(item['attachment'])))
+            if record:
+                self.new_invoices.append((item['order'], record, attachment_key(item['attachment'])))
+            self.processed_files.append((item['order'], file_entry))
+        self.store_batch()
+        
+        logging.info(f"Successfully processed invoice: {item['filename']}")
+        self.report({'type': 'uploaded', **file_entry})
+        self.finish_work(email_data['message_id'])
+    
+    def report_failure(self, item, error):
+        metrics.inc('invoices_failed_total')
+        self.save({'type': 'failed', 'message_id': item['email_data']['message_id']})
+        self.report({'type': 'failed', 'name': item['attachment']['filename'], 'error': str(error)})
+        self.finish_work(item['email_data']['message_id'])
+    
+    async def fetch_async(self, client, chunk_index, msg_index, msg_id):
+        """fetch for one message on the asyncio engine; returns the attachment items to import.
+        
+        Storage writes, checkpoint fsyncs and hashing run on worker threads
+        through asyncio.to_thread, so they never stall the other requests on the loop.
+        """
+        try:
+            # As in fetch, new history entries are filtered on their headers first
+            email_data = None
+            if self.sync_mode == 'incremental':
+                email_data = extract_email_data(await client.get_message(
+                    msg_id, 'metadata', MESSAGE_METADATA_FIELDS, INVOICE_HEADERS
+                ))
+                if not email_data or not matches_invoice_criteria(email_data, self.start_date, self.end_date):
+                    await asyncio.to_thread(self.finish_work, msg_id)
+                    return []
+            
+            with metrics.timer('pipeline_stage_seconds', stage='fetch'):
+                message = await client.get_message(
+                    msg_id, fields=MESSAGE_STRUCTURE_FIELDS if self.sync_mode == 'incremental' else MESSAGE_FULL_FIELDS
+                )
+                if parts_truncated(message):
+                    message = await client.get_message(msg_id, fields=MESSAGE_TREE_FIELDS)
+            email_data = email_data or extract_email_data(message)
+            items = self.attachment_items(chunk_index, msg_index, msg_id, message, email_data)
+        except Exception as e:
+            logging.error(f"Error getting email content for {msg_id}: {str(e)}")
+            await asyncio.to_thread(self.message_failed, msg_id)
+            return []
+        await asyncio.to_thread(self.finish_work, msg_id)
+        return items
+    
+    async def import_async(self, client, item):
+        """The download, upload and persist steps for one attachment on the asyncio engine"""
+        try:
+            with metrics.timer('pipeline_stage_seconds', stage='download'):
+                content = await client.get_attachment(item['email_data']['message_id'], item['attachment']['id'])
+            if not content:
+                await asyncio.to_thread(self.report_failure, item, 'download failed')
+                return
+            await asyncio.to_thread(self.extract, item, content)
+            
+            try:
+                with metrics.timer('pipeline_stage_seconds', stage='upload'):
+                    target = self.folder_info
+                    try:
+                        item['result'] = await client.upload_file(
+                            content, target['folder_id'], target['drive_id'], item['filename'],
+                            item['attachment']['mimeType']
+                        )
+                    except FolderNotFoundError as e:
+                        logging.warning(f"Cached folder {e.folder_id} is gone, resolving folder structure again")
+                        target = await asyncio.to_thread(self.refresh_folder_info, e.folder_id)
+                        item['result'] = await client.upload_file(
+                            content, target['folder_id'], target['drive_id'], item['filename'],
+                            item['attachment']['mimeType']
+                        )
+            finally:
+                content.close()
+            if not item['result']:
+                await asyncio.to_thread(self.report_failure, item, 'upload failed')
+                return
+            
+            # Wait for the extraction here rather than in a worker thread
+            done, _ = await asyncio.wait([asyncio.wrap_future(item['extraction'])], timeout=EXTRACTION_TIMEOUT)
+            if not done:
+                logging.warning(f"Invoice extraction did not finish for {item['filename']}")
+                item['extraction'] = Future()
+                item['extraction'].set_result({})
+            with metrics.timer('pipeline_stage_seconds', stage='persist'):
+                await asyncio.to_thread(self.persist, item)
+        except Exception as e:
+            logging.error(f"Error importing attachment {item['filename']}: {str(e)}")
+            metrics.inc('pipeline_stage_errors_total', stage='import')
+            await asyncio.to_thread(self.report_failure, item, e)
+    
+    def finish(self):
+        """Record which messages are complete and build the run's result"""
+        # A message is complete once every invoice attachment in it is imported;
+        # messages with failed attachments are fetched again next time
+        processed = {}
+        for msg_id, keys in self.message_attachments.items():
+            done_keys = set(self.processed_index.get(msg_id, {}).get('attachments', []))
+            imported = [key for key in keys if (msg_id, key) in self.succeeded_keys or key in done_keys]
+            processed[msg_id] = {'attachments': imported, 'complete': len(imported) == len(keys)}
+        
+        # Messages finished before an interruption and not fetched again had all their attachments committed
+        for msg_id, key in self.committed:
+            if msg_id not in self.message_attachments:
+                processed.setdefault(msg_id, {'attachments': [], 'complete': True})['attachments'].append(key)
+        
+        # Record the invoices not stored in a batch yet, and which messages are complete
+        self.store_invoices(self.new_invoices, processed)
+        
+        # Only move the sync position forward once nothing is left to retry
+        complete_run = (self.pager.exhausted and self.failed_count == 0
+                        and all(entry['complete'] for entry in processed.values()))
+        if complete_run and self.current_history_id:
+            set_month_history_id(self.user_email, self.year, self.month, self.current_history_id)
+        
+        # Report files in mailbox order regardless of completion order
+        processed_files = [entry for _, entry in sorted(self.processed_files, key=lambda pair: pair[0])]
+        processed_count = len(processed_files)
+        metrics.inc('invoices_processed_total', processed_count - len(self.committed))
+        metrics.inc('messages_skipped_total', self.skipped_count)
+        metrics.inc('messages_failed_total', self.failed_count)
+        
+        logging.info(f"Found {self.pager.messages_seen} potential invoice emails for {self.month_name} "
+                     f"across {self.pager.pages_fetched} pages")
+        
+        # Return success result with folder information
+        folder_link = None
+        if processed_count:
+            folder_id = self.folder_info['folder_id']
+            try:
+                # Get the folder link with support for shared drives
+                folder = self.drive_service.files().get(
+                    fileId=folder_id,
+                    fields='webViewLink,trashed',
+                    supportsAllDrives=True
+                ).execute()
+                folder_link = folder.get('webViewLink')
+                
+                # Make the next run look the folder up again instead of uploading into the trash
+                if folder.get('trashed'):
+                    folder_cache.invalidate(folder_id)
+            except HttpError as e:
+                if e.resp.status == 404:
+                    folder_cache.invalidate(folder_id)
+                logging.error(f"Error getting folder link: {str(e)}")
+            except Exception as e:
+                logging.error(f"Error getting folder link: {str(e)}")
+        
+        message = f'Successfully processed {processed_count} invoices for {self.month_name}.'
+        if self.skipped_count:
+            message += f' Skipped {self.skipped_count} emails that were already imported.'
+        
+        result = {
+            'success': True,
+            'message': message,
+            'count': processed_count,
+            'skipped': self.skipped_count,
+            'mode': self.sync_mode,
+            'files': processed_files,
+            'folder_link': folder_link
+        }
+        # A resumed job reuses this month's result instead of running it again
+        self.save({'type': 'finished', 'result': result})
+        return result
+
+def run_month_sync_threads(sync, chunks):
+    """Run a MonthSync with each step on its own PipelineStage: fetch -> download -> upload -> persist.
+    
+    Stages hand work to the next one through bounded queues.
+    """
+    def fetch(item):
+        for attachment_item in sync.fetch(item):
+            download_stage.put(attachment_item)
+    
+    def download(item):
+        if sync.download(item):
+            upload_stage.put(item)
+    
+    def upload(item):
+        if sync.upload(item):
+            persist_stage.put(item)
+    
+    persist_stage = PipelineStage('persist', sync.persist, PIPELINE_PERSIST_WORKERS,
+                                  on_error=sync.report_failure).start()
+    upload_stage = PipelineStage('upload', upload, PIPELINE_UPLOAD_WORKERS,
+                                 on_error=sync.report_failure).start()
+    download_stage = PipelineStage('download', download, PIPELINE_DOWNLOAD_WORKERS,
+                                   on_error=sync.report_failure).start()
+    fetch_stage = PipelineStage('fetch', fetch, PIPELINE_FETCH_WORKERS,
+                                on_error=sync.fetch_failed).start()
+    
+    try:
+        for chunk_index, msg_ids in enumerate(chunks):
+            fetch_stage.put((chunk_index, msg_ids))
+    finally:
+        # Drain the stages in order so every queued item reaches the end
+        for stage in (fetch_stage, download_stage, upload_stage, persist_stage):
+            stage.close()
+
+async def run_month_sync_async(sync, chunks):
+    """Run a MonthSync on the asyncio engine with up to ASYNC_MESSAGES_PER_SYNC messages in progress"""
+    client = AsyncGoogleClient(sync.user_email,
+                               credentials_from_dict(sync.user_data['google_credentials'], sync.user_email))
+    window = asyncio.Semaphore(ASYNC_MESSAGES_PER_SYNC)
+    attachment_budget = ByteBudget(ASYNC_ATTACHMENT_BYTES_PER_SYNC)
+    tasks = set()
+    
+    async def import_attachment(item):
+        async with attachment_budget.claim(item['attachment']['size']):
+            await sync.import_async(client, item)
+    
+    async def run_message(chunk_index, msg_index, msg_id):
+        try:
+            items = await sync.fetch_async(client, chunk_index, msg_index, msg_id)
+            await asyncio.gather(*(import_attachment(item) for item in items))
+        finally:
+            window.release()
+    
+    try:
+        # The pager makes blocking googleapiclient calls, so pages are read on a worker thread
+        for chunk_index in itertools.count():
+            msg_ids = await asyncio.to_thread(next, chunks, None)
+            if msg_ids is None:
+                break
+            for msg_index, msg_id in enumerate(await asyncio.to_thread(sync.skip_imported, msg_ids)):
+                await window.acquire()
+                task = asyncio.ensure_future(run_message(chunk_index, msg_index, msg_id))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks)
+
+def process_and_upload_invoices_by_month(user_email, year, month, max_messages=GMAIL_MAX_MESSAGES, force=False,
+                                         incremental=True, progress=None, mailbox_history_id=None, checkpoint=None):
+    """Process invoices for a specific month and year and save to shared drive.
+    
+    Messages already recorded in the user's processed index are skipped before
+    any download unless force is set. With incremental set, a month that was
+    synced before only looks at messages added to the mailbox since then.
+    progress, if given, is called with an event dict as work advances.
+    mailbox_history_id, if given, is used as the mailbox position captured
+    before listing instead of asking Gmail for it.
+    checkpoint, a SyncCheckpoint, records the run as it goes; if it holds an
+    interrupted run, its uploads are kept, its failed messages are retried and
+    listing continues from the last page all earlier messages of which were done.
+    """
+    logging.info(f"Processing invoices for user: {user_email} for {month}/{year}")
+    
+    # A finished run of the same job already has the result
+    finished = next((entry for entry in checkpoint.entries if entry['type'] == 'finished'), None) if checkpoint else None
+    if finished:
+        return finished['result']
+    
+    # Get user data
+    user_data = get_user_profile(user_email)
+    if not user_data or 'google_credentials' not in user_data:
+        return {
+            'success': False, 
+            'message': 'User credentials not found.'
+        }
+    
+    # Build Gmail service
+    gmail_service = build_gmail_service(user_data['google_credentials'], user_email)
+    if not gmail_service:
+        return {
+            'success': False, 
+            'message': 'Failed to build Gmail service.'
+        }
+    
+    # Build Drive service
+    drive_service = build_drive_service(user_data['google_credentials'], user_email)
+    if not drive_service:
+        return {
+            'success': False, 
+            'message': 'Failed to build Drive service.'
+        }
+    
+    sync = MonthSync(user_email, user_data, year, month, gmail_service, drive_service, force=force,
+                     progress=progress, checkpoint=checkpoint)
+    try:
+        sync.list_messages(incremental, max_messages, mailbox_history_id)
+        
+        # Peek at the first message so empty months skip the Drive setup
+        if sync.is_empty:
+            return sync.finish_empty()
+        
+        if not sync.prepare():
+            return {
+                'success': False,
+                'message': 'Failed to create folder structure in Google Drive.'
+            }
+        
+        chunks = chunked(sync.message_ids(), GMAIL_BATCH_SIZE)
+        if fetch_engine() == 'asyncio':
+            async_loop.run(run_month_sync_async(sync, chunks))
+        else:
+            run_month_sync_threads(sync, chunks)
+        return sync.finish()
+    except Exception as e:
+        logging.error(f"Error processing invoices: {str(e)}")
         return {
-            'folder_id': user_folder_id,
-            'drive_id': shared_drive_id
+            'success': False,
+            'message': f'Error processing invoices: {str(e)}'
         }
-            
-    except Exception as e:
-        logging.error(f"Error creating folder structure: {str(e)}")
-        return None
+    finally:
+        if checkpoint:
+            checkpoint.close()
 
-#----------------
-# Invoice Processing
-#----------------
+# Shared by every backfill in this process so parallel backfills cannot multiply the load
+backfill_slots = threading.BoundedSemaphore(BACKFILL_WORKERS)
 
-def process_and_upload_invoices_by_month(user_email, year, month):
-    """Process invoices for a specific month and year and save to shared drive"""
-    logging.info(f"Processing invoices for user: {user_email} for {month}/{year}")
+def parse_month(value):
+    """Parse a 'YYYY-MM' string into a (year, month) tuple"""
+    try:
+        parsed = datetime.strptime(str(value), '%Y-%m')
+    except ValueError:
+        raise ValueError(f"Invalid month '{value}', expected YYYY-MM")
+    return parsed.year, parsed.month
+
+def iter_months(start, end):
+    """Yield (year, month) pairs from start to end inclusive"""
+    year, month = start
+    while (year, month) <= end:
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+def backfill_invoices(user_email, start, end, max_messages=GMAIL_MAX_MESSAGES, force=False,
+                      incremental=True, progress=None, job_id=None):
+    """Process every month from start to end, given as (year, month) tuples, in parallel.
     
-    # Get user data
-    user_data = get_user_data(user_email)
-    if not user_data or 'google_credentials' not in user_data:
+    Each month is a shard run by process_and_upload_invoices_by_month. At most
+    BACKFILL_WORKERS shards run at once across all backfills in this process.
+    With job_id set, each month keeps a checkpoint in that job so a resumed
+    backfill skips finished months and continues the others.
+    Returns one report merging the per-month results.
+    """
+    report = progress or (lambda event: None)
+    months = list(iter_months(start, end))
+    if not months:
         return {
-            'success': False, 
-            'message': 'User credentials not found.'
+            'success': False,
+            'message': 'The backfill range is empty.'
+        }
+    if len(months) > BACKFILL_MAX_MONTHS:
+        return {
+            'success': False,
+            'message': f'A backfill can cover at most {BACKFILL_MAX_MONTHS} months.'
         }
     
-    # Build Gmail service
-    gmail_service = build_gmail_service(user_data['google_credentials'])
-    if not gmail_service:
+    user_data = get_user_profile(user_email)
+    if not user_data or 'google_credentials' not in user_data:
         return {
             'success': False, 
-            'message': 'Failed to build Gmail service.'
+            'message': 'User credentials not found.'
         }
     
-    # Build Drive service
-    drive_service = build_drive_service(user_data['google_credentials'])
-    if not drive_service:
+    # Shards share the pooled Gmail and Drive clients and one mailbox position
+    try:
+        gmail_service = build_gmail_service(user_data['google_credentials'], user_email)
+        mailbox_history_id = get_mailbox_history_id(gmail_service)
+    except Exception as e:
+        logging.error(f"Error starting backfill: {str(e)}")
         return {
-            'success': False, 
-            'message': 'Failed to build Drive service.'
+            'success': False,
+            'message': f'Error starting backfill: {str(e)}'
         }
     
-    # Create start and end dates for the month
-    start_date = datetime(year, month, 1)
+    logging.info(f"Backfilling {len(months)} months of invoices for user: {user_email}")
     
-    # Determine the last day of the month
-    if month == 12:
-        next_month = datetime(year + 1, 1, 1)
-    else:
-        next_month = datetime(year, month + 1, 1)
-    end_date = next_month - timedelta(days=1)
+    listed = {}
+    listed_lock = threading.Lock()
+    
+    def shard_progress(label):
+        def forward(event):
+            event = dict(event, month=label)
+            if event['type'] == 'listed':
+                # Job progress shows the total listed across all months
+                with listed_lock:
+                    listed[label] = event['messages_listed']
+                    report(dict(event, messages_listed=sum(listed.values())))
+            else:
+                report(event)
+        return forward
+    
+    def run_shard(year_month):
+        year, month = year_month
+        label = f"{year:04d}-{month:02d}"
+        with backfill_slots:
+            report({'type': 'month_started', 'month': label})
+            result = process_and_upload_invoices_by_month(
+                user_email,
+                year,
+                month,
+                max_messages=max_messages,
+                force=force,
+                incremental=incremental,
+                progress=shard_progress(label),
+                mailbox_history_id=mailbox_history_id,
+                checkpoint=SyncCheckpoint.for_job(job_id, year, month) if job_id else None
+            )
+        report({'type': 'month_finished', 'month': label, 'success': result['success'],
+                'count': result.get('count', 0)})
+        return result
     
-    # Query Gmail for emails with attachments for the specified month
-    query = f"has:attachment after:{start_date.strftime('%Y/%m/%d')} before:{end_date.strftime('%Y/%m/%d')} " \
-            f"(subject:invoice OR subject:receipt OR subject:bill OR subject:statement OR subject:payment)"
+    with ThreadPoolExecutor(max_workers=min(BACKFILL_WORKERS, len(months)),
+                            thread_name_prefix='backfill') as executor:
+        results = list(executor.map(run_shard, months))
     
+    # Merge the shards in calendar order
+    month_reports = []
+    files = []
+    for (year, month), result in zip(months, results):
+        month_reports.append({
+            'year': year,
+            'month': month,
+            'success': result['success'],
+            'message': result['message'],
+            'count': result.get('count', 0),
+            'skipped': result.get('skipped', 0),
+            'mode': result.get('mode'),
+            'folder_link': result.get('folder_link')
+        })
+        files.extend(result.get('files', []))
+    
+    processed_count = sum(entry['count'] for entry in month_reports)
+    skipped_count = sum(entry['skipped'] for entry in month_reports)
+    failed_months = [datetime(entry['year'], entry['month'], 1).strftime('%B %Y')
+                     for entry in month_reports if not entry['success']]
+    
+    period = f'{datetime(*months[0], 1).strftime("%B %Y")} to {datetime(*months[-1], 1).strftime("%B %Y")}'
+    message = f'Successfully processed {processed_count} invoices for {period}.'
+    if skipped_count:
+        message += f' Skipped {skipped_count} emails that were already imported.'
+    if failed_months:
+        message += f' Failed months: {", ".join(failed_months)}.'
+    
+    return {
+        'success': not failed_months,
+        'message': message,
+        'count': processed_count,
+        'skipped': skipped_count,
+        'months': month_reports,
+        'files': files
+    }
+
+#----------------
+# Background Jobs
+#----------------
+
+def is_process_alive(pid):
+    """Check whether a process with this PID is still running"""
     try:
-        results = gmail_service.users().messages().list(userId='me', q=query, maxResults=100).execute()
-        messages = results.get('messages', [])
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobManager:
+    """Runs long operations on a bounded thread pool and tracks their progress.
+    
+    Job state is written to DATA_DIR/jobs/<job_id>.json so any gunicorn worker
+    can answer status requests. Each user runs at most JOB_MAX_PER_USER jobs at
+    once in this process; further jobs wait in a per-user queue. Submitting a
+    job identical to one that is still queued or running returns that job.
+    Jobs keep checkpoints in DATA_DIR/jobs/<job_id>/ until they succeed, so a
+    failed job, or one whose worker died, can be resumed where it stopped.
+    """
+    
+    ACTIVE_STATUSES = ('queued', 'running')
+    
+    def __init__(self, max_workers=JOB_WORKERS, max_per_user=JOB_MAX_PER_USER):
+        self.max_workers = max_workers
+        self.max_per_user = max_per_user
+        self._executor = None
+        self._lock = threading.RLock()
+        self._jobs = {}
+        self._targets = {}
+        self._running = {}
+        self._pending = {}
+        self._last_flush = {}
+    
+    @property
+    def jobs_dir(self):
+        return os.path.join(DATA_DIR, 'jobs')
+    
+    def _path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+    
+    def checkpoint_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+    
+    def _get_executor(self):
+        # Created on first use so no threads exist before gunicorn forks
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        return self._executor
+    
+    def _save(self, job):
+        atomic_write_json(self._path(job['id']), job)
+        self._last_flush[job['id']] = time.time()
+    
+    def _load(self, job_id):
+        try:
+            with open(self._path(job_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _iter_saved_jobs(self):
+        if not os.path.isdir(self.jobs_dir):
+            return
+        for filename in os.listdir(self.jobs_dir):
+            if filename.endswith('.json') and not filename.startswith('.'):
+                job = self._load(filename[:-len('.json')])
+                if job:
+                    yield job
+    
+    def _is_active(self, job):
+        # A queued or running job whose worker process died is not active anymore
+        return job['status'] in self.ACTIVE_STATUSES and is_process_alive(job['pid'])
+    
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION
+        for job in self._iter_saved_jobs():
+            if not self._is_active(job) and job.get('updated_at', 0) < cutoff:
+                try:
+                    os.remove(self._path(job['id']))
+                except OSError:
+                    pass
+                shutil.rmtree(self.checkpoint_dir(job['id']), ignore_errors=True)
+    
+    def submit(self, user_email, kind, params, target):
+        """Queue target(progress, job_id) as a job, or return the matching active job.
         
-        if not messages:
-            return {
-                'success': True, 
-                'message': f'No invoice emails found for {start_date.strftime("%B %Y")}.', 
-                'count': 0
+        Returns (job, created).
+        """
+        with self._lock, file_lock(os.path.join(self.jobs_dir, 'submit')):
+            for job in self._iter_saved_jobs():
+                if (job['user_email'] == user_email and job['kind'] == kind
+                        and job['params'] == params and self._is_active(job)):
+                    return self.get(job['id']), False
+            
+            self._prune()
+            now = time.time()
+            job = {
+                'id': uuid.uuid4().hex,
+                'user_email': user_email,
+                'kind': kind,
+                'params': params,
+                'status': 'queued',
+                'pid': os.getpid(),
+                'created_at': now,
+                'updated_at': now,
+                'started_at': None,
+                'finished_at': None,
+                'progress': {'messages_listed': 0, 'uploaded': 0, 'failed': 0, 'skipped': 0},
+                'events': [],
+                'event_count': 0,
+                'result': None,
+                'error': None
             }
+            self._enqueue(job, target)
         
-        logging.info(f"Found {len(messages)} potential invoice emails for {start_date.strftime('%B %Y')}")
-        
-        # Create folder structure in Google Drive
-        folder_info = create_drive_folder_structure(
-            drive_service,
-            year,
-            month,
-            user_data['name']
-        )
-        
-        if not folder_info:
-            return {
-                'success': False,
-                'message': 'Failed to create folder structure in Google Drive.'
-            }
+        self._dispatch(user_email)
+        return self.get(job['id']), True
+    
+    def resume(self, job_id, target):
+        """Queue a failed or interrupted job again under its ID so it continues from its checkpoints.
         
-        invoices_folder_id = folder_info['folder_id']
-        drive_id = folder_info['drive_id']
+        Returns (job, resumed); a job that is still active or has succeeded is
+        returned as it is.
+        """
+        with self._lock, file_lock(os.path.join(self.jobs_dir, 'submit')):
+            job = self._jobs.get(job_id) or self._load(job_id)
+            if job is None:
+                return None, False
+            if job['status'] == 'succeeded' or self._is_active(job):
+                return self.get(job_id), False
+            
+            now = time.time()
+            job.update({
+                'status': 'queued',
+                'pid': os.getpid(),
+                'updated_at': now,
+                'started_at': None,
+                'finished_at': None,
+                'progress': {'messages_listed': 0, 'uploaded': 0, 'failed': 0, 'skipped': 0},
+                'result': None,
+                'error': None,
+                'resumed': job.get('resumed', 0) + 1
+            })
+            job['events'].append({'type': 'resumed', 'seq': job['event_count'], 'at': now})
+            job['event_count'] += 1
+            del job['events'][:-JOB_MAX_EVENTS]
+            self._enqueue(job, target)
         
-        # Process each message
-        processed_count = 0
-        processed_files = []
+        logging.info(f"Resuming job {job_id} ({job['kind']}) for {job['user_email']}")
+        self._dispatch(job['user_email'])
+        return self.get(job_id), True
+    
+    def _enqueue(self, job, target):
+        self._save(job)
+        self._jobs[job['id']] = job
+        self._targets[job['id']] = target
+        self._pending.setdefault(job['user_email'], deque()).append(job['id'])
+        metrics.gauge('jobs_queued', 1, kind=job['kind'])
+    
+    def _dispatch(self, user_email):
+        with self._lock:
+            pending = self._pending.get(user_email)
+            while pending and self._running.get(user_email, 0) < self.max_per_user:
+                job_id = pending.popleft()
+                self._running[user_email] = self._running.get(user_email, 0) + 1
+                self._get_executor().submit(self._run, job_id)
+    
+    def _run(self, job_id):
+        job = self._jobs[job_id]
+        target = self._targets.pop(job_id)
         
-        for msg in messages:
-            try:
-                # Get message content
-                message = get_email_content(gmail_service, msg['id'])
-                if not message:
-                    continue
-                    
-                # Extract email data
-                email_data = extract_email_data(message)
-                if not email_data or not email_data.get('has_attachments'):
-                    continue
-                    
-                # Find attachments
-                attachments = list_attachments(message)
-                if not attachments:
-                    continue
-                
-                # Find invoices already processed to avoid duplicates
-                existing_invoices = [inv for inv in user_data.get('invoices', []) 
-                                    if inv.get('message_id') == email_data['message_id']]
-                already_processed = len(existing_invoices) > 0
-                
-                # Process each attachment
-                for attachment in attachments:
-                    if attachment['mimeType'] in ['application/pdf', 'image/jpeg', 'image/png', 
-                                                 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', 
-                                                 'application/msword']:
-                        # Download attachment
-                        file_path = get_attachment(
-                            gmail_service, 
-                            email_data['message_id'], 
-                            attachment['id'],
-                            attachment['filename']
-                        )
-                        
-                        if file_path:
-                            # Generate filename with date info
-                            received_date = email_data['date'].strftime('%Y%m%d')
-                            new_filename = f"{received_date}_{attachment['filename']}"
-                            
-                            # Upload to Google Drive in the appropriate folder
-                            result = upload_file_to_shared_drive(
-                                drive_service, 
-                                file_path, 
-                                invoices_folder_id,
-                                drive_id,
-                                new_filename
-                            )
-                            
-                            if result:
-                                # Save to local JSON store if not already processed
-                                if not already_processed:
-                                    invoice_data = {
-                                        'filename': new_filename,
-                                        'sender': email_data['sender'],
-                                        'subject': email_data['subject'],
-                                        'received_date': email_data['date'].isoformat(),
-                                        'gdrive_link': result['web_link'],
-                                        'message_id': email_data['message_id']
-                                    }
-                                    add_invoice(user_data['email'], invoice_data)
-                                
-                                processed_count += 1
-                                processed_files.append({
-                                    'name': new_filename,
-                                    'link': result['web_link'],
-                                })
-                                
-                                logging.info(f"Successfully processed invoice: {new_filename}")
-                                
-                            # Clean up temp file
-                            if os.path.exists(file_path):
-                                os.remove(file_path)
-            except Exception as e:
-                logging.error(f"Error processing message: {str(e)}")
-                continue
+        with self._lock:
+            job['status'] = 'running'
+            job['started_at'] = job['updated_at'] = time.time()
+            self._save(job)
+        metrics.gauge('jobs_queued', -1, kind=job['kind'])
+        metrics.gauge('jobs_in_flight', 1, kind=job['kind'])
         
-        # Return success result with folder information
-        folder_link = None
         try:
-            # Get the folder link with support for shared drives
-            folder = drive_service.files().get(
-                fileId=invoices_folder_id, 
-                fields='webViewLink',
-                supportsAllDrives=True
-            ).execute()
-            folder_link = folder.get('webViewLink')
+            result = target(lambda event: self._record_event(job_id, event), job_id)
+            with self._lock:
+                job['result'] = result
+                job['status'] = 'succeeded' if result.get('success') else 'failed'
+            if job['status'] == 'succeeded':
+                # Everything is stored, so there is nothing left to resume
+                shutil.rmtree(self.checkpoint_dir(job_id), ignore_errors=True)
         except Exception as e:
-            logging.error(f"Error getting folder link: {str(e)}")
-        
-        return {
-            'success': True, 
-            'message': f'Successfully processed {processed_count} invoices for {start_date.strftime("%B %Y")}.', 
-            'count': processed_count,
-            'files': processed_files,
-            'folder_link': folder_link
-        }
-    except Exception as e:
-        logging.error(f"Error processing invoices: {str(e)}")
-        return {
-            'success': False, 
-            'message': f'Error processing invoices: {str(e)}'
-        }
+            logging.error(f"Job {job_id} failed: {str(e)}")
+            with self._lock:
+                job['status'] = 'failed'
+                job['error'] = str(e)
+        finally:
+            with self._lock:
+                job['finished_at'] = job['updated_at'] = time.time()
+                self._save(job)
+                del self._jobs[job_id]
+                self._last_flush.pop(job_id, None)
+                self._running[job['user_email']] -= 1
+            metrics.gauge('jobs_in_flight', -1, kind=job['kind'])
+            metrics.inc('jobs_total', kind=job['kind'], status=job['status'])
+            self._dispatch(job['user_email'])
+    
+    def _record_event(self, job_id, event):
+        with self._lock:
+            job = self._jobs[job_id]
+            progress = job['progress']
+            if event['type'] == 'listed':
+                progress['messages_listed'] = event['messages_listed']
+            elif event['type'] in ('uploaded', 'failed'):
+                progress[event['type']] += 1
+            elif event['type'] == 'skipped':
+                progress['skipped'] += event['count']
+            
+            job['events'].append(dict(event, seq=job['event_count'], at=time.time()))
+            job['event_count'] += 1
+            del job['events'][:-JOB_MAX_EVENTS]
+            job['updated_at'] = time.time()
+            
+            # Throttle rewrites of the job file; the final state is always saved
+            if time.time() - self._last_flush.get(job_id, 0) >= JOB_FLUSH_INTERVAL:
+                self._save(job)
+    
+    def get(self, job_id, since=0):
+        """Return a job's state with the events numbered since or later"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            job = json.loads(json.dumps(job)) if job else None
+        if job is None:
+            job = self._load(job_id)
+        if job is None:
+            return None
+        job['events'] = [event for event in job['events'] if event['seq'] >= since]
+        return self._with_liveness(job)
+    
+    def _with_liveness(self, job):
+        # A job whose worker process died while it was queued or running can be resumed
+        if job['status'] in self.ACTIVE_STATUSES and not self._is_active(job):
+            job['status'] = 'interrupted'
+        return job
+    
+    def list_jobs(self, user_email):
+        """List a user's saved jobs, newest first"""
+        jobs = [job for job in self._iter_saved_jobs() if job['user_email'] == user_email]
+        for job in jobs:
+            job['events'] = []
+            self._with_liveness(job)
+        return sorted(jobs, key=lambda job: job['created_at'], reverse=True)
+
+job_manager = JobManager()
+
+def job_response(job):
+    """Shape a job for the status API"""
+    return {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'params': job['params'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'events': job['events'],
+        'next_since': job['event_count'],
+        'result': job['result'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+        'resumable': job['status'] in ('failed', 'interrupted'),
+        'status_url': url_for('job_status', job_id=job['id']),
+        'resume_url': url_for('resume_job', job_id=job['id'])
+    }
+
+def job_target(user_email, kind, params):
+    """Build the callable that runs a job from its kind and params, to start or resume it"""
+    if kind == 'fetch_invoices':
+        return lambda progress, job_id: process_and_upload_invoices_by_month(
+            user_email,
+            progress=progress,
+            checkpoint=SyncCheckpoint.for_job(job_id, params['year'], params['month']),
+            **params
+        )
+    if kind == 'backfill':
+        return lambda progress, job_id: backfill_invoices(
+            user_email,
+            parse_month(params['start']),
+            parse_month(params['end']),
+            max_messages=params['max_messages'],
+            force=params['force'],
+            incremental=params['incremental'],
+            progress=progress,
+            job_id=job_id
+        )
+    raise ValueError(f"Unknown job kind '{kind}'")
+
+#----------------
+# Reports
+#----------------
+
+def email_domain(user_email):
+    return user_email.rsplit('@', 1)[-1].lower()
+
+def team_domain(user_email):
+    """The user's team, or None unless their email domain is one of the configured TEAM_DOMAINS"""
+    domain = email_domain(user_email)
+    if domain in TEAM_DOMAINS and domain not in PUBLIC_MAIL_DOMAINS:
+        return domain
+    return None
+
+def can_view_user(viewer_email, user_email):
+    """Whether viewer_email may see user_email's invoices: their own, or a teammate's"""
+    if viewer_email.lower() == user_email.lower():
+        return True
+    team = team_domain(viewer_email)
+    return team is not None and team == team_domain(user_email)
+
+def team_members(viewer_email):
+    """Stored users whose invoices viewer_email may see, just themselves outside a team"""
+    return sorted(user_email for user_email in list_users() if can_view_user(viewer_email, user_email))
+
+def user_categories(user_email):
+    """Invoice counts per category for one user, summed over their monthly rollups"""
+    totals = {}
+    for entry in load_rollups([user_email]).get(user_email, {}).values():
+        for category, count in entry['categories'].items():
+            totals[category] = totals.get(category, 0) + count
+    return totals
+
+def top_categories(categories, limit=3):
+    """Category names ordered by invoice count, most common first"""
+    return [name for name, _ in sorted(categories.items(), key=lambda item: (-item[1], item[0]))[:limit]]
+
+def reimbursement_rows(viewer_email, year=None, month=None):
+    """One row per team member and month, read from the rollups of the users viewer_email may see"""
+    rows = []
+    for user_email, periods in load_rollups().items():
+        if not can_view_user(viewer_email, user_email):
+            continue
+        for period, entry in periods.items():
+            period_year, period_month = int(period[:4]), int(period[5:7])
+            if (year and period_year != year) or (month and period_month != month):
+                continue
+            rows.append({
+                'email': user_email,
+                'year': period_year,
+                'month': period_month,
+                'invoice_count': entry['invoice_count'],
+                'totals': entry['totals'],
+                'categories': entry['categories'],
+                'top_categories': top_categories(entry['categories'])
+            })
+    # Totals in different currencies don't compare, so busiest members come first instead
+    rows.sort(key=lambda row: (-row['year'], -row['month'], -row['invoice_count'], row['email']))
+    return rows
+
+def invoice_summary(invoice):
+    """Shape a stored invoice for the report pages"""
+    return {
+        'id': invoice.get('id'),
+        'date': (invoice.get('received_date') or '')[:10],
+        'vendor': invoice.get('sender'),
+        'description': invoice.get('subject'),
+        'category': invoice.get('category'),
+        'amount': invoice.get('amount') or 0,
+        'currency': invoice.get('currency'),
+        'status': invoice.get('status', 'Pending'),
+        'filename': invoice.get('filename'),
+        'link': invoice.get('gdrive_link'),
+        'file_id': invoice.get('file_id')
+    }
+
+# Columns of CSV and JSON Lines exports; ZIP manifests add the file's path in the archive
+EXPORT_FIELDS = ['email', 'id', 'received_date', 'vendor', 'sender', 'subject', 'category', 'amount',
+                 'currency', 'filename', 'status', 'gdrive_link', 'file_id']
+
+# Export format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'zip': ('application/zip', 'zip')
+}
+
+def period_filters(year=None, month=None):
+    """Listing filters covering one month, one year or every invoice"""
+    if month and not year:
+        raise ValueError('month requires a year')
+    if not year:
+        return invoice_filters()
+    first_month, last_month = (month, month) if month else (1, 12)
+    last_day = calendar.monthrange(year, last_month)[1]
+    return invoice_filters(f"{year:04d}-{first_month:02d}-01", f"{year:04d}-{last_month:02d}-{last_day:02d}")
+
+def iter_filtered_invoices(user_email, filters, batch_size=EXPORT_BATCH_SIZE):
+    """Yield a user's invoices matching filters, newest first, reading one keyset page at a time"""
+    store = get_user_store()
+    position = None
+    while True:
+        invoices, has_more = store.query_invoices(user_email, filters, position, 'next', batch_size)
+        yield from invoices
+        if not has_more or not invoices:
+            return
+        position = invoice_sort_key(invoices[-1])
+
+def export_row(user_email, invoice):
+    """Flatten a stored invoice into the EXPORT_FIELDS columns"""
+    return {
+        'email': user_email,
+        'id': invoice.get('id'),
+        'received_date': invoice.get('received_date'),
+        'vendor': invoice.get('vendor') or sender_name(invoice.get('sender') or ''),
+        'sender': invoice.get('sender'),
+        'subject': invoice.get('subject'),
+        'category': invoice_category(invoice),
+        'amount': invoice.get('amount'),
+        'currency': invoice.get('currency'),
+        'filename': invoice.get('filename'),
+        'status': invoice.get('status', 'Pending'),
+        'gdrive_link': invoice.get('gdrive_link'),
+        'file_id': invoice.get('file_id')
+    }
+
+def csv_safe(row):
+    """Quote text cells that spreadsheet apps would evaluate as formulas, e.g. email subjects"""
+    return {key: "'" + value if isinstance(value, str) and value[:1] in ('=', '+', '-', '@', '\t', '\r') else value
+            for key, value in row.items()}
+
+def stream_csv(rows):
+    """Encode export rows as CSV in chunks of roughly EXPORT_CHUNK_SIZE bytes"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(csv_safe(row))
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+def stream_jsonl(rows):
+    """Encode export rows as JSON Lines in chunks of roughly EXPORT_CHUNK_SIZE bytes"""
+    lines, size = [], 0
+    for row in rows:
+        line = json.dumps(row) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield ''.join(lines).encode()
+            lines, size = [], 0
+    if lines:
+        yield ''.join(lines).encode()
+
+class ZipStreamBuffer:
+    """Write-only file that collects zipfile output until the response drains it.
+
+    It has no tell() or seek(), so zipfile writes a data descriptor after each
+    member instead of seeking back, and the archive can be sent as it is built.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """Yield everything written since the last drain"""
+        if self._chunks:
+            data = b''.join(self._chunks)
+            self._chunks = []
+            yield data
+
+def zip_member(path, invoice, size=0):
+    """ZipInfo for a file in an export archive, dated by the invoice's received date"""
+    try:
+        date_time = datetime.fromisoformat(invoice['received_date']).timetuple()[:6]
+    except (KeyError, TypeError, ValueError):
+        date_time = datetime.now().timetuple()[:6]
+    info = zipfile.ZipInfo(path, date_time=max(date_time, (1980, 1, 1, 0, 0, 0)))
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.file_size = size
+    return info
+
+def close_abandoned_download(future):
+    """Done-callback releasing the spooled buffer of a download nobody will read"""
+    if not future.cancelled() and future.exception() is None and future.result():
+        future.result().close()
+
+def stream_zip(invoices, service, user_email):
+    """Stream a ZIP of the invoices' Drive files, followed by an invoices.csv manifest.
+
+    invoices yields (owner email, invoice) pairs. Up to EXPORT_DOWNLOAD_WORKERS
+    downloads run ahead of the archive writer, each spooled to memory or a temp
+    file, so memory use does not grow with the number or size of the files.
+    Files that cannot be downloaded are listed in the manifest without a path.
+    """
+    invoices = iter(invoices)
+    sink = ZipStreamBuffer()
+    manifest = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_MEMORY_LIMIT, mode='w+', newline='')
+    manifest_writer = csv.DictWriter(manifest, EXPORT_FIELDS + ['archive_path'])
+    manifest_writer.writeheader()
+    executor = ThreadPoolExecutor(EXPORT_DOWNLOAD_WORKERS, thread_name_prefix='export')
+    pending = deque()
+
+    def fill():
+        for owner, invoice in itertools.islice(invoices, EXPORT_DOWNLOAD_WORKERS - len(pending)):
+            future = None
+            if invoice.get('file_id'):
+                future = executor.submit(download_drive_file, service, invoice['file_id'], user_email)
+            pending.append((owner, invoice, future))
+
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+            # Names only need to be unique within one person's month, which arrives in one run
+            folder, names = None, set()
+            fill()
+            while pending:
+                owner, invoice, future = pending.popleft()
+                fill()
+                buffer = future.result() if future else None
+                archive_path = ''
+                if buffer:
+                    with buffer:
+                        if (owner, invoice_period(invoice)) != folder:
+                            folder, names = (owner, invoice_period(invoice)), set()
+                        name = invoice.get('filename') or f"invoice-{invoice.get('id')}"
+                        stem, extension = os.path.splitext(name)
+                        for copy_number in itertools.count(2):
+                            if name not in names:
+                                break
+                            name = f"{stem} ({copy_number}){extension}"
+                        names.add(name)
+                        archive_path = f"{owner}/{invoice_period(invoice) or 'undated'}/{name}"
+
+                        size = buffer.seek(0, os.SEEK_END)
+                        buffer.seek(0)
+                        with archive.open(zip_member(archive_path, invoice, size), 'w') as member:
+                            while chunk := buffer.read(EXPORT_CHUNK_SIZE):
+                                member.write(chunk)
+                                yield from sink.drain()
+                else:
+                    logging.warning(f"Invoice {invoice.get('id')} of {owner} has no downloadable file to export")
+                manifest_writer.writerow({**csv_safe(export_row(owner, invoice)), 'archive_path': archive_path})
+                yield from sink.drain()
+
+            manifest.seek(0)
+            with archive.open(zip_member('invoices.csv', {}), 'w', force_zip64=True) as member:
+                while chunk := manifest.read(EXPORT_CHUNK_SIZE):
+                    member.write(chunk.encode())
+                    yield from sink.drain()
+        yield from sink.drain()
+    finally:
+        # Reached early when the client disconnects: drop downloads nobody will read,
+        # including the ones still running, once they finish
+        for _, _, future in pending:
+            if future and not future.cancel():
+                future.add_done_callback(close_abandoned_download)
+        executor.shutdown(wait=False, cancel_futures=True)
+        manifest.close()
+
+def export_invoices_response(user_emails, filters, export_format, download_name, user_email):
+    """Stream the matching invoices of user_emails, one user after another, as a download"""
+    invoices = ((owner, invoice) for owner in user_emails for invoice in iter_filtered_invoices(owner, filters))
+    if export_format == 'zip':
+        user_data = get_user_profile(user_email) or {}
+        service = build_drive_service(user_data.get('google_credentials'), user_email)
+        if not service:
+            return jsonify({'error': 'Google Drive is not connected'}), 401
+        chunks = stream_zip(invoices, service, user_email)
+    elif export_format == 'jsonl':
+        chunks = stream_jsonl(export_row(owner, invoice) for owner, invoice in invoices)
+    else:
+        chunks = stream_csv(export_row(owner, invoice) for owner, invoice in invoices)
+
+    def metered(chunks):
+        for chunk in chunks:
+            metrics.inc('export_bytes_total', len(chunk), format=export_format)
+            yield chunk
+
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    return Response(metered(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{download_name}.{extension}"',
+        # Let nginx pass the export through as it is generated instead of buffering it
+        'X-Accel-Buffering': 'no'
+    })
 
 #----------------
 # Routes
@@ -783,8 +5271,9 @@ def oauth2callback():
         # Store or update user credentials
         update_user_credentials(user_info['emailAddress'], credentials_dict)
         
-        # Store user info in session
+        # Store user info in session; only members of a configured team domain see the team pages
         session['user_email'] = user_info['emailAddress']
+        session['team_domain'] = team_domain(user_info['emailAddress'])
         
         return redirect(url_for('dashboard'))
     except Exception as e:
@@ -794,6 +5283,10 @@ def oauth2callback():
 @app.route('/logout')
 def logout():
     """Log out user"""
+    # Release pooled API clients held for this user
+    if 'user_email' in session:
+        service_pool.evict(session['user_email'])
+    
     # Clear session
     session.clear()
     return redirect(url_for('login'))
@@ -805,7 +5298,7 @@ def dashboard():
         return redirect(url_for('login'))
         
     # Get user data
-    user_data = get_user_data(session['user_email'])
+    user_data = get_user_profile(session['user_email'])
     if not user_data:
         return redirect(url_for('logout'))
     
@@ -835,15 +5328,342 @@ def fetch_invoices():
         
         year = int(data.get('year', datetime.now().year))
         month = int(data.get('month', datetime.now().month))
+        max_messages = int(data['max_messages']) if data.get('max_messages') else GMAIL_MAX_MESSAGES
+        force = bool(data.get('force', False))
+        incremental = bool(data.get('incremental', True))
+        user_email = session['user_email']
         
-        # Process the invoices for the specified month
-        result = process_and_upload_invoices_by_month(
-            session['user_email'], 
-            year, 
-            month
+        # Process the invoices for the specified month in the background
+        params = {
+            'year': year,
+            'month': month,
+            'max_messages': max_messages,
+            'force': force,
+            'incremental': incremental
+        }
+        job, created = job_manager.submit(
+            user_email,
+            'fetch_invoices',
+            params,
+            job_target(user_email, 'fetch_invoices', params)
         )
         
-        return jsonify(result)
+        return jsonify(job_response(job)), 202 if created else 200
+
+@app.route('/backfill', methods=['POST'])
+def backfill():
+    """Fetch and upload invoices for a range of months in one background job"""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    data = request.get_json() or {}
+    try:
+        start = parse_month(data.get('start'))
+        end = parse_month(data.get('end'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if start > end:
+        return jsonify({'error': 'start must not be after end'}), 400
+    
+    max_messages = int(data['max_messages']) if data.get('max_messages') else GMAIL_MAX_MESSAGES
+    force = bool(data.get('force', False))
+    incremental = bool(data.get('incremental', True))
+    user_email = session['user_email']
+    
+    params = {
+        'start': f"{start[0]:04d}-{start[1]:02d}",
+        'end': f"{end[0]:04d}-{end[1]:02d}",
+        'max_messages': max_messages,
+        'force': force,
+        'incremental': incremental
+    }
+    job, created = job_manager.submit(
+        user_email,
+        'backfill',
+        params,
+        job_target(user_email, 'backfill', params)
+    )
+    
+    return jsonify(job_response(job)), 202 if created else 200
+
+def render_invoice_list():
+    """Render one page of the user's invoices for the list and filter routes"""
+    if 'user_email' not in session:
+        return redirect(url_for('login'))
+    
+    user_email = session['user_email']
+    args = {key: request.args.get(key, '') for key in ('start_date', 'end_date', 'category', 'domain')}
+    try:
+        filters = invoice_filters(args['start_date'], args['end_date'], args['category'], args['domain'])
+    except ValueError:
+        return 'Invalid date, expected YYYY-MM-DD', 400
+    
+    page = max(request.args.get('page', 1, type=int), 1)
+    listing = list_invoice_page(user_email, filters, request.args.get('cursor'), request.args.get('direction'))
+    total_count = count_invoices(user_email, filters)
+    
+    # Page links carry the filters and the cursor of the neighbouring page; page is only for display
+    link_args = {key: value for key, value in args.items() if value}
+    next_url = prev_url = None
+    if listing['next_cursor']:
+        next_url = url_for(request.endpoint, cursor=listing['next_cursor'], page=page + 1, **link_args)
+    if listing['prev_cursor'] and page > 1:
+        prev_url = url_for(request.endpoint, cursor=listing['prev_cursor'], direction='prev', page=page - 1,
+                           **link_args)
+    
+    return render_template('invoices.html',
+                         invoices=listing['invoices'],
+                         total_count=total_count,
+                         total_pages=max(-(-total_count // INVOICES_PER_PAGE), 1),
+                         page=page,
+                         next_url=next_url,
+                         prev_url=prev_url,
+                         categories=sorted(user_categories(user_email)),
+                         selected_category=filters['category'],
+                         start_date=args['start_date'],
+                         end_date=args['end_date'])
+
+@app.route('/invoices')
+def list_invoices():
+    """Render the user's invoices, newest first"""
+    return render_invoice_list()
+
+@app.route('/invoices/filter')
+def filter_invoices():
+    """Render the user's invoices filtered by date range, category or sender domain"""
+    return render_invoice_list()
+
+@app.route('/categories')
+def list_categories():
+    """Render the user's invoice categories with counts"""
+    if 'user_email' not in session:
+        return redirect(url_for('login'))
+    
+    counts = user_categories(session['user_email'])
+    categories = [{'name': name, 'count': count}
+                  for name, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))]
+    return render_template('categories.html', categories=categories)
+
+@app.route('/categories/recategorize', methods=['POST'])
+def recategorize():
+    """Apply the current category rules to all of the user's invoices"""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    updated = recategorize_user_invoices(session['user_email'])
+    return jsonify({'success': True, 'updated': updated})
+
+@app.route('/reports')
+def reports():
+    """Render the reimbursement summary for the user's team"""
+    if 'user_email' not in session:
+        return redirect(url_for('login'))
+    
+    return render_template('reports.html',
+                         reimbursements=reimbursement_rows(session['user_email']),
+                         now=datetime.now(),
+                         month_names=list(calendar.month_name)[1:])
+
+@app.route('/team-invoices')
+def team_invoices():
+    """Render the team invoice search page"""
+    if 'user_email' not in session:
+        return redirect(url_for('login'))
+    
+    if not team_domain(session['user_email']):
+        return redirect(url_for('reports'))
+    
+    return render_template('team_invoices.html', current_year=datetime.now().year)
+
+@app.route('/api/person-invoices')
+def person_invoices():
+    """List a team member's invoices, optionally for one year and month"""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    user_email = request.args.get('email') or session['user_email']
+    year = request.args.get('year', type=int)
+    month = request.args.get('month', type=int)
+    
+    # Team members can only see colleagues from their own configured team domain
+    if not can_view_user(session['user_email'], user_email):
+        return jsonify({'error': 'Not allowed to view this user\'s invoices'}), 403
+    
+    def in_period(invoice):
+        period = invoice_period(invoice)
+        if not period:
+            return not (year or month)
+        return (not year or int(period[:4]) == year) and (not month or int(period[5:7]) == month)
+    
+    invoices = []
+    totals = {}
+    for invoice in iter_invoices(user_email):
+        if in_period(invoice):
+            invoices.append(invoice_summary(invoice))
+            add_to_totals(totals, invoice)
+    
+    return jsonify({
+        'email': user_email,
+        'invoices': invoices,
+        'count': len(invoices),
+        'totals': {currency: round(amount, 2) for currency, amount in totals.items()}
+    })
+
+def export_invoices(user_emails, name):
+    """Stream an export of user_emails' invoices for the requested format and period"""
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported export format '{export_format}', "
+                                 f"expected one of: {', '.join(EXPORT_FORMATS)}"}), 400
+
+    year = request.args.get('year', type=int)
+    month = request.args.get('month', type=int)
+    try:
+        filters = period_filters(year, month)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    period = f"{year:04d}-{month:02d}" if month else str(year or 'all')
+    return export_invoices_response(user_emails, filters, export_format, f"invoices-{name}-{period}",
+                                    session['user_email'])
+
+@app.route('/reports/person')
+def export_person_invoices():
+    """Download one team member's invoices as CSV, JSON Lines or a ZIP of their files"""
+    if 'user_email' not in session:
+        return redirect(url_for('login'))
+
+    user_email = request.args.get('email') or session['user_email']
+    if not can_view_user(session['user_email'], user_email):
+        return jsonify({'error': 'Not allowed to export this user\'s invoices'}), 403
+
+    return export_invoices([user_email], user_email.split('@')[0])
+
+@app.route('/reports/download')
+def export_team_invoices():
+    """Download the whole team's invoices as CSV, JSON Lines or a ZIP of their files"""
+    if 'user_email' not in session:
+        return redirect(url_for('login'))
+
+    # Outside a configured team domain this exports only the user's own invoices
+    team = team_domain(session['user_email'])
+    return export_invoices(team_members(session['user_email']), team or session['user_email'].split('@')[0])
+
+@app.route('/api/rollups')
+def team_rollups():
+    """Per-person monthly totals for the user's team, optionally for one year and month"""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    rows = reimbursement_rows(
+        session['user_email'],
+        year=request.args.get('year', type=int),
+        month=request.args.get('month', type=int)
+    )
+    return jsonify({'rows': rows})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report a background job's progress; pass since=<n> to get only newer events"""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    job = job_manager.get(job_id, since=request.args.get('since', 0, type=int))
+    if not job or job['user_email'] != session['user_email']:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(job_response(job))
+
+@app.route('/jobs/<job_id>/resume', methods=['POST'])
+def resume_job(job_id):
+    """Continue a failed or interrupted background job from its checkpoints"""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    job = job_manager.get(job_id)
+    if not job or job['user_email'] != session['user_email']:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] == 'succeeded':
+        return jsonify({'error': 'Job already finished'}), 409
+    
+    job, resumed = job_manager.resume(job_id, job_target(job['user_email'], job['kind'], job['params']))
+    return jsonify(job_response(job)), 202 if resumed else 200
+
+@app.route('/jobs')
+def list_jobs():
+    """List the current user's background jobs"""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    return jsonify({'jobs': [job_response(job) for job in job_manager.list_jobs(session['user_email'])]})
+
+@app.route('/api/google-stats')
+def google_api_stats():
+    """Report this worker's Google API request, throttle and retry counters"""
+    if 'user_email' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    
+    return jsonify({'pid': os.getpid(), 'apis': api_quota.stats()})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose every worker's metrics in the Prometheus text format"""
+    if not METRICS_TOKEN:
+        return Response('Metrics are disabled until METRICS_TOKEN is set\n', status=403, mimetype='text/plain')
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+#----------------
+# CLI Commands
+#----------------
+
+@app.cli.command('migrate-storage')
+def migrate_storage_command():
+    """Copy JSON user files into the SQLite database"""
+    store = get_user_store()
+    if not isinstance(store, SqliteUserStore):
+        store = SqliteUserStore(SQLITE_DB_PATH or os.path.join(DATA_DIR, 'invoices.db'))
+    migrated = migrate_json_to_sqlite(store)
+    print(f"Migrated {migrated} users to {store.path}")
+
+@app.cli.command('backfill')
+@click.argument('user_email')
+@click.argument('start')
+@click.argument('end')
+@click.option('--force', is_flag=True, help='Re-import emails that were already processed.')
+@click.option('--full', is_flag=True, help='Search whole months instead of syncing from the last history ID.')
+def backfill_command(user_email, start, end, force, full):
+    """Import invoices for every month from START to END (YYYY-MM)"""
+    try:
+        start_month, end_month = parse_month(start), parse_month(end)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    
+    def print_progress(event):
+        if event['type'] == 'month_finished':
+            status = 'done' if event['success'] else 'FAILED'
+            print(f"{event['month']}: {status}, {event['count']} invoices")
+    
+    result = backfill_invoices(user_email, start_month, end_month, force=force, incremental=not full,
+                               progress=print_progress)
+    print(result['message'])
+    if not result['success']:
+        raise SystemExit(1)
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the per-user monthly invoice rollups from stored invoices"""
+    users = rebuild_rollups()
+    print(f"Rebuilt rollups for {users} users")
+
+@app.cli.command('recategorize')
+@click.argument('user_email', required=False)
+def recategorize_command(user_email):
+    """Apply the current category rules to USER_EMAIL's invoices, or every user's"""
+    engine = get_category_engine()
+    for email_address in [user_email] if user_email else list_users():
+        print(f"{email_address}: {recategorize_user_invoices(email_address, engine)} invoices changed category")
 
 # Main entry point
 if __name__ == "__main__":
@@ -0,0 +1,593 @@
+"""Offline throughput benchmark for process_and_upload_invoices_by_month.
+
+Gmail and Drive are served by an in-process stand-in that replaces the HTTP
+transport under googleapiclient, so the real request path is measured:
+discovery-built services, HTTP batches, quota metering and retries, media
+uploads, extraction and storage. Only the network is fake.
+
+Each scenario runs in a fresh subprocess so peak RSS and caches are per
+scenario.
+
+With --startup, worker start-up is measured instead: each run is a fresh
+interpreter that imports the app and times its first responses, either cold
+(as a plain worker) or forked after warm_up() (as a preloaded gunicorn worker).
+
+Usage:
+    python benchmark.py                                   # 100, 1k and 10k messages
+    python benchmark.py --messages 1000 --latency-ms 20 --error-rate 0.01
+    python benchmark.py --output baseline.json            # save results
+    python benchmark.py --baseline baseline.json          # compare against saved results
+    python benchmark.py --startup                         # worker start-up times
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+from email.parser import FeedParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+BENCHMARK_USER = 'benchmark@example.com'
+BENCHMARK_YEAR = 2025
+BENCHMARK_MONTH = 10
+SENDERS = [
+    'AWS <no-reply@billing.aws.amazon.com>', 'GitHub <billing@github.com>', 'Uber Receipts <receipts@uber.com>',
+    'Stripe <invoices@stripe.com>', 'Acme Supplies <accounts@acme-supplies.com>'
+]
+
+#----------------
+# Google Stand-in
+#----------------
+
+def invoice_pdf(number, size):
+    """A one-page text PDF with a total, padded with a comment to about size bytes"""
+    content = zlib.compress(
+        b'BT /F1 12 Tf 72 720 Td (Acme Supplies Ltd) Tj 0 -14 Td (Invoice %d) Tj 0 -14 Td (Total: $%d.%02d) Tj ET'
+        % (number, 10 + number % 990, number % 100)
+    )
+    objects = [
+        b'<</Type/Catalog/Pages 2 0 R>>',
+        b'<</Type/Pages/Kids[3 0 R]/Count 1>>',
+        b'<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]/Resources<</Font<</F1 5 0 R>>>>/Contents 4 0 R>>',
+        b'<</Length %d/Filter/FlateDecode>>\nstream\n' % len(content) + content + b'\nendstream',
+        b'<</Type/Font/Subtype/Type1/BaseFont/Helvetica>>'
+    ]
+    # The padding goes before the objects, since readers look for the xref at the end of the file
+    padding = max(0, size - 400 - len(content))
+    pdf = bytearray(b'%PDF-1.4\n%' + b'0' * padding + b'\n')
+    offsets = []
+    for object_number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n' % object_number + body + b'\nendobj\n'
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer<</Size %d/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return bytes(pdf)
+
+class FakeGoogle:
+    """Answers the Gmail and Drive endpoints the pipeline calls, with configurable
+    latency, list page size, attachment size and error rate.
+
+    Counts every HTTP round trip and every API call; a batch is one round trip
+    but one API call per sub-request.
+    """
+
+    def __init__(self, messages, attachments_per_message=1, attachment_size=50 * 1024, page_size=500,
+                 latency=0.01, error_rate=0.0, seed=1):
+        self.messages = messages
+        self.attachments_per_message = attachments_per_message
+        self.attachment_size = attachment_size
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.round_trips = 0
+        self.api_calls = defaultdict(int)
+        self.errors = 0
+        self.bytes_uploaded = 0
+        self._folders = {}
+        self._files = 0
+        self._uploads = {}
+        self._lock = threading.Lock()
+        self.upload_url = 'https://www.googleapis.com/upload/drive/v3/files'
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        parsed = urlparse(uri)
+        if parsed.path == '/batch':
+            return self._batch(body, headers)
+        return self._call(method, parsed, body, headers or {})
+
+    def _fail(self):
+        with self._lock:
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def _call(self, method, parsed, body, headers):
+        path = unquote(parsed.path)
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        name, handler, args = self._route(method, path, query)
+        with self._lock:
+            self.api_calls[name] += 1
+
+        if name != 'oauth.token' and self._fail():
+            # Alternate between a rate limit and a backend error
+            if self.random.random() < 0.5:
+                return 429, {'retry-after': '0'}, {'error': {'code': 429, 'message': 'Rate Limit Exceeded',
+                                                             'errors': [{'reason': 'rateLimitExceeded'}]}}
+            return 503, {}, {'error': {'code': 503, 'message': 'Backend Error',
+                                       'errors': [{'reason': 'backendError'}]}}
+        return handler(query, body, headers, *args)
+
+    def _route(self, method, path, query):
+        routes = [
+            ('POST', r'/token', 'oauth.token', self._token),
+            ('GET', r'/gmail/v1/users/me/profile', 'gmail.profile', self._profile),
+            ('GET', r'/gmail/v1/users/me/messages', 'gmail.messages.list', self._list_messages),
+            ('GET', r'/gmail/v1/users/me/messages/([^/]+)/attachments/([^/]+)', 'gmail.attachments.get',
+             self._get_attachment),
+            ('GET', r'/gmail/v1/users/me/messages/([^/]+)', 'gmail.messages.get', self._get_message),
+            ('GET', r'/drive/v3/files', 'drive.files.list', self._list_files),
+            ('POST', r'/drive/v3/files', 'drive.files.create', self._create_folder),
+            ('POST', r'/upload/drive/v3/files', 'drive.files.upload', self._upload),
+            ('PUT', r'/upload/drive/v3/files', 'drive.files.upload_chunk', self._upload_chunk),
+            ('GET', r'/drive/v3/files/([^/]+)', 'drive.files.get', self._get_file),
+        ]
+        for route_method, pattern, name, handler in routes:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                return name, handler, match.groups()
+        raise ValueError(f"Unexpected request: {method} {path}")
+
+    def _batch(self, body, headers):
+        content_type = next(value for key, value in headers.items() if key.lower() == 'content-type')
+        parser = FeedParser()
+        parser.feed(f"content-type: {content_type}\r\n\r\n{body}")
+        parts = []
+        for part in parser.close().get_payload():
+            request_line = part.get_payload().split('\n', 1)[0].strip()
+            method, target, _ = request_line.split(' ')
+            status, _, payload = self._call(method, urlparse(target), None, {})
+            reason = {200: 'OK', 429: 'Too Many Requests', 503: 'Service Unavailable'}.get(status, 'Error')
+            parts.append(
+                f"--batch_boundary\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n"
+            )
+        content = ''.join(parts) + '--batch_boundary--\r\n'
+        return 200, {'content-type': 'multipart/mixed; boundary=batch_boundary'}, content
+
+    def _token(self, query, body, headers):
+        return 200, {}, {'access_token': 'benchmark-token', 'expires_in': 3600, 'token_type': 'Bearer'}
+
+    def _profile(self, query, body, headers):
+        return 200, {}, {'emailAddress': BENCHMARK_USER, 'historyId': '1000'}
+
+    def _list_messages(self, query, body, headers):
+        start = int(query.get('pageToken', 0))
+        end = min(self.messages, start + min(int(query.get('maxResults', 100)), self.page_size))
+        response = {
+            'messages': [{'id': f"{i:08x}", 'threadId': f"{i:08x}"} for i in range(start, end)],
+            'resultSizeEstimate': self.messages
+        }
+        if end < self.messages:
+            response['nextPageToken'] = str(end)
+        return 200, {}, response
+
+    def _get_message(self, query, body, headers, message_id):
+        number = int(message_id, 16)
+        received = datetime(BENCHMARK_YEAR, BENCHMARK_MONTH, 1) + timedelta(minutes=number % (28 * 24 * 60))
+        parts = [{'partId': '0', 'mimeType': 'text/plain', 'filename': '', 'body': {'size': 20}}]
+        for index in range(self.attachments_per_message):
+            parts.append({
+                'partId': str(index + 1),
+                'mimeType': 'application/pdf',
+                'filename': f"invoice_{number}_{index}.pdf",
+                'body': {'attachmentId': f"{message_id}-{index}", 'size': self.attachment_size}
+            })
+        return 200, {}, {
+            'id': message_id,
+            'payload': {
+                'mimeType': 'multipart/mixed',
+                'headers': [
+                    {'name': 'From', 'value': SENDERS[number % len(SENDERS)]},
+                    {'name': 'Subject', 'value': f"Invoice #{number}"},
+                    {'name': 'Date', 'value': received.strftime('%a, %d %b %Y %H:%M:%S +0000')}
+                ],
+                'parts': parts
+            }
+        }
+
+    def _get_attachment(self, query, body, headers, message_id, attachment_id):
+        number = int(message_id, 16) * self.attachments_per_message + int(attachment_id.rsplit('-', 1)[1])
+        data = invoice_pdf(number, self.attachment_size)
+        return 200, {}, {'size': len(data), 'data': base64.urlsafe_b64encode(data).decode()}
+
+    def _list_files(self, query, body, headers):
+        match = re.search(r"name='([^']*)'.*?(?:'([^']*)' in parents)?$", query.get('q', ''))
+        with self._lock:
+            folder_id = self._folders.get((match.group(1), match.group(2))) if match else None
+        return 200, {}, {'files': [{'id': folder_id}] if folder_id else []}
+
+    def _create_folder(self, query, body, headers):
+        metadata = json.loads(body)
+        with self._lock:
+            self._files += 1
+            folder_id = f"folder{self._files}"
+            parent = (metadata.get('parents') or [None])[0]
+            self._folders[(metadata['name'], parent)] = folder_id
+        return 200, {}, {'id': folder_id}
+
+    def _new_file(self, size):
+        with self._lock:
+            self._files += 1
+            self.bytes_uploaded += size
+            file_id = f"file{self._files}"
+        return {'id': file_id, 'webViewLink': f"https://drive.google.com/file/d/{file_id}/view"}
+
+    def _upload(self, query, body, headers):
+        if query.get('uploadType') == 'resumable':
+            with self._lock:
+                upload_id = str(len(self._uploads))
+                self._uploads[upload_id] = 0
+            location = f"{self.upload_url}?uploadType=resumable&upload_id={upload_id}"
+            return 200, {'location': location}, {}
+        return 200, {}, self._new_file(len(body or b''))
+
+    def _upload_chunk(self, query, body, headers):
+        content_range = next(value for key, value in headers.items() if key.lower() == 'content-range')
+        match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range)
+        end, total = int(match.group(2)), match.group(3)
+        if total != '*' and end + 1 == int(total):
+            return 200, {}, self._new_file(int(total))
+        return 308, {'range': f"bytes=0-{end}"}, {}
+
+    def _get_file(self, query, body, headers, file_id):
+        return 200, {}, {'webViewLink': f"https://drive.google.com/drive/folders/{file_id}", 'trashed': False}
+
+class FakeHttp:
+    """httplib2.Http stand-in that sends every request to a FakeGoogle"""
+
+    timeout = None
+
+    def __init__(self, google):
+        self.google = google
+        self.connections = {}
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        status, response_headers, payload = self.google.request(uri, method, body, headers or {})
+        # Imported here so --startup runs measure the app's own imports
+        import httplib2
+        response = httplib2.Response({'status': status, 'content-type': 'application/json', **response_headers})
+        if isinstance(payload, str):
+            return response, payload.encode()
+        return response, json.dumps(payload).encode()
+
+class FakeGoogleServer:
+    """Serves a FakeGoogle over local HTTP for the asyncio engine, which does not go through httplib2"""
+
+    def __init__(self, google):
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else None
+                status, headers, payload = google.request(f"{server_url}{self.path}", self.command, body,
+                                                          dict(self.headers))
+                content = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in {'content-type': 'application/json', **headers}.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        server_url = self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+#----------------
+# Scenario Runner
+#----------------
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run_scenario(config):
+    """Import a fresh app against the stand-in, process one month and return measurements"""
+    os.environ.setdefault('GOOGLE_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('GOOGLE_CLIENT_SECRET', 'benchmark')
+    os.environ['GOOGLE_SHARED_DRIVE_ID'] = 'benchmark-drive'
+    os.environ['STORAGE_BACKEND'] = config['storage']
+    os.environ['FETCH_ENGINE'] = config['engine']
+
+    import app
+
+    logging.getLogger().setLevel(config['log_level'])
+    app.DATA_DIR = tempfile.mkdtemp(prefix='invoice-benchmark-')
+
+    google = FakeGoogle(
+        config['messages'],
+        attachments_per_message=config['attachments'],
+        attachment_size=config['attachment_size'],
+        page_size=config['page_size'],
+        latency=config['latency_ms'] / 1000,
+        error_rate=config['error_rate'],
+        seed=config['seed']
+    )
+    app.build_http = lambda: FakeHttp(google)
+    if config['engine'] == 'asyncio':
+        server = FakeGoogleServer(google)
+        app.GMAIL_API_URL = f"{server.url}/gmail/v1"
+        app.DRIVE_API_URL = f"{server.url}/drive/v3"
+        app.DRIVE_UPLOAD_URL = f"{server.url}/upload/drive/v3"
+        google.upload_url = f"{app.DRIVE_UPLOAD_URL}/files"
+    if not config['quota']:
+        # Measure the pipeline itself rather than Google's per-user limits
+        app.api_quota = app.ApiQuota(rates={})
+
+    # Time every item handled by each pipeline stage
+    stage_timings = defaultdict(list)
+    timings_lock = threading.Lock()
+
+    class TimedStage(app.PipelineStage):
+        def __init__(self, name, handler, *args, **kwargs):
+            def timed(item):
+                start = time.perf_counter()
+                try:
+                    return handler(item)
+                finally:
+                    with timings_lock:
+                        stage_timings[name].append(time.perf_counter() - start)
+            super().__init__(name, timed, *args, **kwargs)
+
+    app.PipelineStage = TimedStage
+
+    app.update_user_credentials(BENCHMARK_USER, {
+        'token': 'benchmark-token',
+        'refresh_token': 'benchmark-refresh',
+        'scopes': [],
+        'expiry': (datetime.utcnow() + timedelta(days=1)).isoformat()
+    })
+    app.update_user_fields(BENCHMARK_USER, {'name': 'Benchmark User'})
+
+    start = time.perf_counter()
+    result = app.process_and_upload_invoices_by_month(BENCHMARK_USER, BENCHMARK_YEAR, BENCHMARK_MONTH)
+    elapsed = time.perf_counter() - start
+
+    # Stop the extraction processes so their peak memory is reported too
+    extractor_pool = app.invoice_extractor._pool
+    if extractor_pool:
+        extractor_pool.shutdown()
+
+    invoices = result.get('count') or 0
+    api_calls = sum(count for name, count in google.api_calls.items() if name != 'oauth.token')
+    return {
+        'config': config,
+        'success': result.get('success'),
+        'message': result.get('message'),
+        'invoices': invoices,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(config['messages'] / elapsed, 1),
+        'http_requests': google.round_trips,
+        'api_calls': api_calls,
+        'api_calls_per_invoice': round(api_calls / invoices, 2) if invoices else None,
+        'api_calls_by_method': dict(sorted(google.api_calls.items())),
+        'injected_errors': google.errors,
+        'retries': sum(counters['retries'] for counters in app.api_quota.stats().values()),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'extraction_peak_rss_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'stages': {
+            name: {
+                'items': len(values),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 2)
+            }
+            for name, values in stage_timings.items()
+        }
+    }
+
+def run_in_subprocess(config):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-scenario', json.dumps(config)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True
+    )
+    if output.returncode != 0:
+        raise RuntimeError(f"Scenario with {config['messages']} messages failed:\n{output.stderr}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def first_responses(app):
+    """Time a worker's first /login page, OAuth redirect and Gmail service build"""
+    timings = {}
+    client = app.app.test_client()
+    start = time.perf_counter()
+    client.get('/login')
+    timings['login_ms'] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    client.get('/authorize')
+    timings['authorize_ms'] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    credentials = app.credentials_from_dict({'token': 'benchmark-token', 'scopes': []})
+    app.build_google_service('gmail', 'v1', credentials)
+    timings['gmail_service_ms'] = (time.perf_counter() - start) * 1000
+    return timings
+
+def run_startup(mode):
+    """Import the app in this fresh interpreter and time a worker's first requests"""
+    os.environ.setdefault('GOOGLE_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('GOOGLE_CLIENT_SECRET', 'benchmark')
+    os.environ.setdefault('GOOGLE_REDIRECT_URI', 'http://localhost:5001/oauth2callback')
+
+    start = time.perf_counter()
+    import app
+    result = {'mode': mode, 'import_ms': (time.perf_counter() - start) * 1000}
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if mode == 'cold':
+        result.update(first_responses(app))
+        return result
+
+    # Preloaded: warm up as the gunicorn master does, then time a forked worker
+    start = time.perf_counter()
+    app.warm_up()
+    result['warm_up_ms'] = (time.perf_counter() - start) * 1000
+    read_fd, write_fd = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        timings = first_responses(app)
+        timings['worker_ready_ms'] = (time.perf_counter() - start) * 1000
+        os.write(write_fd, json.dumps(timings).encode())
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        result.update(json.loads(f.read()))
+    os.waitpid(pid, 0)
+    return result
+
+def startup_report(runs):
+    """Run --startup measurements in fresh interpreters and print the medians"""
+    results = {}
+    for mode in ('cold', 'preloaded'):
+        samples = []
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run-startup', mode],
+                cwd=tempfile.gettempdir(),
+                capture_output=True,
+                text=True
+            )
+            if output.returncode != 0:
+                raise RuntimeError(f"Start-up run ({mode}) failed:\n{output.stderr}")
+            samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+        results[mode] = {
+            key: round(percentile([sample[key] for sample in samples], 0.5), 1)
+            for key in samples[0] if key != 'mode'
+        }
+        print(f"{mode:>9}: " + ", ".join(f"{key[:-3]} {value} ms" for key, value in results[mode].items()))
+    return results
+
+def print_report(results, baseline=None):
+    # Only runs with the same settings are compared; results saved before --engine existed used threads
+    scenario_key = lambda config: json.dumps({key: value for key, value in {'engine': 'threads', **config}.items()
+                                              if key != 'log_level'}, sort_keys=True)
+    baseline_rates = {scenario_key(entry['config']): entry['messages_per_second'] for entry in (baseline or [])}
+
+    for result in results:
+        config = result['config']
+        line = (f"{config['messages']:>6} messages: {result['messages_per_second']:>8} msg/s in {result['seconds']}s, "
+                f"{result['api_calls_per_invoice']} API calls/invoice ({result['http_requests']} HTTP requests), "
+                f"peak RSS {result['peak_rss_mb']} MB (+{result['extraction_peak_rss_mb']} MB extraction)")
+        if result['injected_errors']:
+            line += f", {result['injected_errors']} injected errors, {result['retries']} retries"
+        previous = baseline_rates.get(scenario_key(config))
+        if previous:
+            line += f", {(result['messages_per_second'] - previous) / previous * 100:+.1f}% vs baseline"
+        print(line)
+        if not result['success']:
+            print(f"       FAILED: {result['message']}")
+        for name in ('fetch', 'download', 'upload', 'persist'):
+            stage = result['stages'].get(name)
+            if stage:
+                print(f"       {name:<8} {stage['items']:>6} items  p50 {stage['p50_ms']:>8} ms  p99 {stage['p99_ms']:>8} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='message counts to run, one scenario each')
+    parser.add_argument('--attachments', type=int, default=1, help='invoice attachments per message')
+    parser.add_argument('--attachment-size', type=int, default=50 * 1024, help='attachment size in bytes')
+    parser.add_argument('--page-size', type=int, default=500, help='largest messages.list page served')
+    parser.add_argument('--latency-ms', type=float, default=10, help='latency added to every HTTP request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of API calls answered 429/503')
+    parser.add_argument('--quota', action='store_true', help="enforce the app's per-user quota budgets")
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help='FETCH_ENGINE to run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING', help='app log level during the run')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='compare throughput with results saved by --output')
+    parser.add_argument('--startup', action='store_true', help='measure worker start-up instead of throughput')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per --startup mode')
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--run-startup', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(json.loads(args.run_scenario))))
+        return
+    if args.run_startup:
+        print(json.dumps(run_startup(args.run_startup)))
+        return
+    if args.startup:
+        results = startup_report(args.runs)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"Saved results to {args.output}")
+        return
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    results = []
+    for messages in args.messages:
+        config = {
+            'messages': messages,
+            'attachments': args.attachments,
+            'attachment_size': args.attachment_size,
+            'page_size': args.page_size,
+            'latency_ms': args.latency_ms,
+            'error_rate': args.error_rate,
+            'quota': args.quota,
+            'storage': args.storage,
+            'seed': args.seed,
+            'engine': args.engine,
+            'log_level': args.log_level
+        }
+        results.append(run_in_subprocess(config))
+        print_report(results[-1:], baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,14 @@
+"""gunicorn settings, picked up automatically from the working directory.
+
+The app is imported once in the master and warmed up before any worker is
+forked, so workers, including ones respawned after a crash, start with the
+Google client libraries and discovery documents already loaded.
+"""
+
+preload_app = True
+
+def when_ready(server):
+    # Runs in the master after the app is loaded and before workers are spawned
+    import app
+    app.warm_up()
+    server.log.info("Google client libraries and discovery documents preloaded")